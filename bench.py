@@ -0,0 +1,221 @@
+"""Micro-benchmarks for Taiyari's per-message text processing.
+
+Compares the current implementations in main.py with the ones they replaced, on speed and
+(for language detection) accuracy; pass -v to print misses. Run from the repository root:
+
+    python bench.py
+"""
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+os.environ['TAIYARI_OFFLINE'] = '1'  # Import main without crawling or starting background jobs
+import main
+
+
+# ==================== LEGACY IMPLEMENTATIONS ====================
+def legacy_detect_language(text):
+    """detect_language as it was before the compiled detector (substring scanning)"""
+    text_lower = text.lower()
+
+    es_words = ['hola', 'gracias', 'por favor', 'qué', 'cuál', 'cómo', 'dónde', 'cuándo', 'tiempo', 'entrega',
+                'pedido', 'envío', 'precio', 'quiero', 'puedo', 'necesito', 'tengo', 'está', 'son', 'tienen',
+                'buenas', 'buenos', 'días', 'tardes', 'noches', 'el', 'la', 'los', 'las', 'de', 'del']
+    es_count = sum(1 for w in es_words if w in text_lower)
+
+    en_words = ['hello', 'hi', 'thanks', 'please', 'what', 'which', 'how', 'where', 'when', 'delivery',
+                'order', 'shipping', 'price', 'want', 'can', 'need', 'have', 'is', 'are', 'the', 'a', 'an',
+                'good', 'morning', 'afternoon', 'evening', 'my', 'your', 'do', 'does']
+    en_count = sum(1 for w in en_words if w in text_lower)
+
+    de_words = ['hallo', 'danke', 'bitte', 'was', 'wie', 'wo', 'wann', 'lieferung', 'bestellung', 'versand',
+                'preis', 'ich', 'möchte', 'kann', 'brauche', 'habe', 'ist', 'sind', 'der', 'die', 'das',
+                'guten', 'morgen', 'tag', 'abend', 'mein', 'ihr']
+    de_count = sum(1 for w in de_words if w in text_lower)
+
+    it_words = ['ciao', 'grazie', 'per favore', 'cosa', 'quale', 'come', 'dove', 'quando', 'consegna',
+                'ordine', 'spedizione', 'prezzo', 'voglio', 'posso', 'ho bisogno', 'ho', 'è', 'sono',
+                'buongiorno', 'buonasera', 'il', 'la', 'i', 'le', 'di', 'del']
+    it_count = sum(1 for w in it_words if w in text_lower)
+
+    ar_indicators = ['مرحبا', 'شكرا', 'من فضلك', 'ماذا', 'كيف', 'أين', 'متى', 'التسليم', 'الطلب']
+    ar_count = sum(1 for w in ar_indicators if w in text)
+
+    scores = {'es': es_count, 'en': en_count, 'de': de_count, 'it': it_count, 'ar': ar_count}
+    max_lang = max(scores, key=scores.get)
+    max_score = scores[max_lang]
+
+    if max_score > 1:
+        return max_lang
+    return 'fr'
+
+
+def legacy_extract_text_from_html(html):
+    """DynamicRAG._extract_text_from_html as it was before lxml parsing (sixteen regex passes)"""
+    html = re.sub(r'<script[^>]*>.*?</script>', '', html, flags=re.DOTALL | re.IGNORECASE)
+    html = re.sub(r'<style[^>]*>.*?</style>', '', html, flags=re.DOTALL | re.IGNORECASE)
+    html = re.sub(r'<nav[^>]*>.*?</nav>', '', html, flags=re.DOTALL | re.IGNORECASE)
+    html = re.sub(r'<footer[^>]*>.*?</footer>', '', html, flags=re.DOTALL | re.IGNORECASE)
+    html = re.sub(r'<header[^>]*>.*?</header>', '', html, flags=re.DOTALL | re.IGNORECASE)
+    text = re.sub(r'<[^>]+>', ' ', html)
+    text = re.sub(r'\s+', ' ', text)
+    noise_patterns = [
+        r'Ignorer et passer au contenu',
+        r'Livraison gratuite.*?CHF \d+',
+        r'Pays/région.*?Langue',
+        r'Rechercher.*?Connexion',
+        r'Article ajouté au panier',
+        r'Procéder au paiement',
+        r'Continuer les achats',
+        r'© \d{4}.*?Shopify',
+        r'Moyens de paiement.*?Visa',
+    ]
+    for pattern in noise_patterns:
+        text = re.sub(pattern, '', text, flags=re.IGNORECASE | re.DOTALL)
+    return text.strip()
+
+
+def legacy_parse_html_page(html):
+    """Title, text and links the way _build_page_document used to get them (three separate scans)"""
+    match = re.search(r'<title[^>]*>([^<]+)</title>', html, re.IGNORECASE)
+    title = match.group(1).split('–')[0].split('|')[0].strip() if match else ""
+    return title, legacy_extract_text_from_html(html), re.findall(r'href=["\']([^"\']+)["\']', html)
+
+
+# ==================== SAMPLES ====================
+LANGUAGE_SAMPLES = [
+    ('fr', "Bonjour, quels sont les délais de livraison ?"),
+    ('fr', "Je voudrais savoir où en est ma commande"),
+    ('fr', "Combien coûte la livraison en Belgique ?"),
+    ('fr', "Est-ce que vous avez des bagues en argent ?"),
+    ('fr', "Merci beaucoup pour votre aide"),
+    ('fr', "Puis-je retourner un bracelet qui ne me plaît pas ?"),
+    ('fr', "c'est fait main ?"),
+    ('fr', "Salut ! Vous livrez en Suisse allemande ?"),
+    ('en', "Hello, how long does delivery take?"),
+    ('en', "Where is my order?"),
+    ('en', "Do you ship to Canada?"),
+    ('en', "I want to return a necklace"),
+    ('en', "Thanks a lot for the quick answer"),
+    ('en', "Are your earrings handmade?"),
+    ('en', "Can I pay with a credit card?"),
+    ('es', "Hola, ¿cuánto tiempo tarda el envío a España?"),
+    ('es', "Quiero devolver una pulsera"),
+    ('es', "¿Dónde está mi pedido?"),
+    ('es', "Gracias por la información"),
+    ('es', "¿Los collares están hechos a mano?"),
+    ('es', "Buenas tardes, necesito ayuda con un pago"),
+    ('de', "Hallo, wie lange dauert die Lieferung?"),
+    ('de', "Wo ist meine Bestellung?"),
+    ('de', "Ich möchte ein Armband zurückgeben"),
+    ('de', "Danke für die schnelle Antwort"),
+    ('de', "Versenden Sie auch nach Österreich?"),
+    ('de', "Ist der Schmuck handgemacht?"),
+    ('it', "Ciao, quanto tempo ci vuole per la consegna?"),
+    ('it', "Dove si trova il mio ordine?"),
+    ('it', "Vorrei restituire una collana"),
+    ('it', "Grazie mille per la risposta"),
+    ('it', "Spedite anche in Italia?"),
+    ('it', "Buongiorno, posso pagare con la carta?"),
+    ('pt', "Olá, quanto tempo demora a entrega?"),
+    ('pt', "Onde está a minha encomenda?"),
+    ('pt', "Obrigado pela ajuda"),
+    ('pt', "Vocês enviam para o Brasil?"),
+    ('nl', "Hallo, hoe lang duurt de levering?"),
+    ('nl', "Waar is mijn bestelling?"),
+    ('nl', "Bedankt voor de snelle reactie"),
+    ('ar', "مرحبا، كم يستغرق التسليم؟"),
+    ('ar', "أين طلبي؟"),
+    ('ru', "Здравствуйте, сколько стоит доставка?"),
+    ('zh', "你好，运费是多少？"),
+    ('ja', "こんにちは、配送にはどのくらいかかりますか？"),
+]
+
+
+def sample_shop_page(products=24):
+    """A stand-in for a Shopify collection page: theme scripts and JSON, header/nav/footer, product grid"""
+    theme_script = '<script>window.ShopifyAnalytics = ' + json.dumps({'meta': {'products': [
+        {'id': i, 'vendor': 'Marakame', 'variants': [{'id': i * 10 + v, 'price': 4500 + v, 'name': f'Bracelet {i}'}
+                                                    for v in range(4)]} for i in range(products)]}}) + ';</script>'
+    nav = '<nav class="menu">' + ''.join(f'<a href="/collections/{name}">{name.title()}</a>'
+                                         for name in ('bracelets', 'colliers', 'bagues', 'boucles', 'nouveautes')) + '</nav>'
+    grid = ''.join(
+        f'<div class="card"><a href="/products/bracelet-huichol-{i}"><img src="//cdn.shopify.com/{i}.jpg" alt="">'
+        f'<h3 class="card__heading">Bracelet huichol n°{i}</h3></a><p>Perles de verre tissées à la main par des '
+        f'artisans wixárika du Mexique. Motif peyotl, couleurs {i % 7 + 1}.</p><span class="price">CHF {45 + i}.00</span>'
+        f'<!-- card {i} --></div>' for i in range(products))
+    return (
+        '<!doctype html><html lang="fr"><head><meta charset="utf-8"><title>Bracelets – Marakame</title>'
+        '<link rel="canonical" href="https://marakame.ch/collections/bracelets">'
+        '<style>' + '.card{display:grid}' * 200 + '</style>' + theme_script * 3 + '</head><body>'
+        '<a class="skip-to-content-link" href="#MainContent">Ignorer et passer au contenu</a>'
+        '<div class="announcement">Livraison gratuite en Suisse dès CHF 80</div>'
+        '<header class="header"><a href="/">Marakame</a>' + nav + '<a href="/search">Rechercher</a>'
+        '<a href="/account/login">Connexion</a><a href="/cart">Panier</a></header>'
+        '<main id="MainContent"><h1>Bracelets</h1><p>Bijoux artisanaux huichols, faits main au Mexique.</p>'
+        + grid + '</main><footer><a href="/pages/faq">FAQ</a><a href="/policies/refund-policy">Retours</a>'
+        '<p>Moyens de paiement acceptés : Visa</p><p>© 2024 Marakame. Commerce électronique propulsé par Shopify</p>'
+        '</footer>' + theme_script + '</body></html>'
+    )
+
+
+# ==================== BENCHMARKS ====================
+def timed(function, inputs, repeat, rounds=5):
+    """Seconds per call, best of `rounds` (the minimum is the least disturbed by other load)"""
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for value in inputs:
+                function(value)
+        best = min(best, (time.perf_counter() - started) / (repeat * len(inputs)))
+    return best
+
+
+def report(legacy_seconds, current_seconds):
+    print(f"  legacy:  {legacy_seconds * 1e6:8.1f} us/call")
+    print(f"  current: {current_seconds * 1e6:8.1f} us/call  ({legacy_seconds / current_seconds:.1f}x)")
+
+
+def bench_language_detection(repeat=200):
+    print("detect_language")
+    texts = [text for _, text in LANGUAGE_SAMPLES]
+    report(timed(legacy_detect_language, texts, repeat), timed(main.detect_language, texts, repeat))
+
+    for label, function in (('legacy', legacy_detect_language), ('current', main.detect_language)):
+        wrong = [(expected, function(text), text) for expected, text in LANGUAGE_SAMPLES if function(text) != expected]
+        print(f"  {label} accuracy: {len(LANGUAGE_SAMPLES) - len(wrong)}/{len(LANGUAGE_SAMPLES)}")
+        if '-v' in sys.argv:
+            for expected, got, text in wrong:
+                print(f"    expected {expected}, got {got}: {text}")
+
+
+def bench_html_extraction(repeat=20):
+    """Saved pages can be passed on the command line (python bench.py pages/*.html)"""
+    paths = [path for pattern in sys.argv[1:] if pattern.endswith('.html') for path in glob.glob(pattern)]
+    pages = []
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            pages.append((os.path.basename(path), f.read()))
+    if not pages:
+        pages = [('generated collection page', sample_shop_page())]
+
+    print(f"parse_html_page (lxml {'available' if main.lxml else 'missing: regex fallback'})")
+    for name, html in pages:
+        print(f"  {name} ({len(html) // 1024} KB)")
+        report(timed(legacy_parse_html_page, [html], repeat), timed(main.parse_html_page, [html], repeat))
+        legacy_title, legacy_text, legacy_links = legacy_parse_html_page(html)
+        title, text, links = main.parse_html_page(html) or legacy_parse_html_page(html)
+        print(f"  title: {legacy_title!r} -> {title!r}")
+        print(f"  text: {len(legacy_text)} -> {len(text)} chars, links: {len(legacy_links)} -> {len(links)}")
+        if '-v' in sys.argv:
+            print(f"    legacy:  {legacy_text[:300]}")
+            print(f"    current: {text[:300]}")
+
+
+if __name__ == '__main__':
+    bench_language_detection()
+    bench_html_extraction()
@@ -1,11 +1,12 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import anthropic
 import os
 import re
-from collections import defaultdict
-from datetime import datetime, timedelta
+from collections import defaultdict, Counter, deque, OrderedDict
+from datetime import datetime, timedelta, timezone
 import requests
+import httpx
 import time
 import smtplib
 from email.mime.text import MIMEText
@@ -13,7 +14,47 @@ from email.mime.multipart import MIMEMultipart
 import uuid
 import threading
 import json
-from urllib.parse import urljoin, urlparse
+import copy
+import math
+import hashlib
+import bisect
+import csv
+import ipaddress
+import struct
+import sys
+import zlib
+import sqlite3
+import fcntl
+import queue
+import atexit
+import socket
+import base64
+from array import array
+import heapq
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin, urlparse, quote
+
+try:
+    # Optional: only needed for the sparse-matrix scoring engine (RAG_SCORING=csr) and fast batch search
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+try:
+    # Optional: single-pass HTML parsing for the crawler; without it pages go through the regex extractor
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+    etree = None
+
+try:
+    # Optional: only needed to read MaxMind .mmdb files (GEOIP_DB_PATH); CSV range files need nothing
+    import maxminddb
+except ImportError:
+    maxminddb = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'marakame-taiyari-secret-2024')
@@ -21,10 +62,19 @@ CORS(app, supports_credentials=True)
 
 # ==================== CONFIGURATION ====================
 ANTHROPIC_KEY = os.environ.get('ANTHROPIC_API_KEY')
+ANTHROPIC_BASE_URL = os.environ.get('ANTHROPIC_BASE_URL')  # e.g. a local stand-in server for testing
+ANTHROPIC_MODEL = os.environ.get('ANTHROPIC_MODEL', 'claude-sonnet-4-20250514')
+ANTHROPIC_TIMEOUT = float(os.environ.get('ANTHROPIC_TIMEOUT', 60))
 SHOPIFY_CLIENT_ID = os.environ.get('SHOPIFY_CLIENT_ID')
 SHOPIFY_CLIENT_SECRET = os.environ.get('SHOPIFY_CLIENT_SECRET')
 SHOPIFY_SHOP_URL = os.environ.get('SHOPIFY_SHOP_URL', '792489-4.myshopify.com')
 HUBSPOT_API_KEY = os.environ.get('HUBSPOT_API_KEY')
+HUBSPOT_CACHE_TTL = int(os.environ.get('HUBSPOT_CACHE_TTL', 600))  # Seconds a contact's emails are reused
+HUBSPOT_CACHE_SIZE = int(os.environ.get('HUBSPOT_CACHE_SIZE', 256))  # Contacts kept in memory
+HUBSPOT_MAX_EMAILS = 5
+SHOPIFY_ORDER_CACHE_TTL = int(os.environ.get('SHOPIFY_ORDER_CACHE_TTL', 60))  # Seconds a found order is reused
+SHOPIFY_ORDER_NEGATIVE_TTL = int(os.environ.get('SHOPIFY_ORDER_NEGATIVE_TTL', 300))  # Seconds a "no such order" is remembered
+SHOPIFY_ORDER_CACHE_SIZE = int(os.environ.get('SHOPIFY_ORDER_CACHE_SIZE', 512))
 
 # SMTP Config
 SMTP_HOST = os.environ.get('SMTP_HOST', 'mail.privateemail.com')
@@ -32,10 +82,55 @@ SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
 SMTP_USER = os.environ.get('SMTP_USER', 'hello@marakame.ch')
 SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
 SMTP_FROM = os.environ.get('SMTP_FROM', 'info@marakame.ch')
+# 'ssl' (implicit TLS), 'starttls' or 'none' (plain, e.g. a local SMTP stand-in); defaults from the port
+SMTP_SECURITY = os.environ.get('SMTP_SECURITY', 'ssl' if SMTP_PORT == 465 else 'starttls').lower()
+SMTP_IDLE_TIMEOUT = 60  # Seconds an idle pooled SMTP connection is kept open
 
 # Website to scrape
 WEBSITE_URL = 'https://marakame.ch'
 
+# Local storage for crawl state and index data
+RAG_DATA_DIR = os.environ.get('RAG_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rag_data'))
+
+# Website crawler
+CRAWL_MAX_PAGES = int(os.environ.get('CRAWL_MAX_PAGES', 50))
+CRAWL_CONCURRENCY = int(os.environ.get('CRAWL_CONCURRENCY', 8))  # Worker threads / pooled connections
+CRAWL_PER_HOST_CONCURRENCY = int(os.environ.get('CRAWL_PER_HOST_CONCURRENCY', 4))  # Max in-flight requests per host
+CRAWL_TIME_BUDGET = float(os.environ.get('CRAWL_TIME_BUDGET', 60))  # Seconds for a whole crawl
+CRAWL_REQUEST_TIMEOUT = 10
+
+# RAG storage backend: 'memory' (per-worker index + snapshot) or 'sqlite' (FTS5 database shared by all workers)
+RAG_BACKEND = os.environ.get('RAG_BACKEND', 'memory')
+RAG_SQLITE_PATH = os.path.join(RAG_DATA_DIR, 'rag.sqlite3')
+RAG_BUILDER_LOCK_PATH = os.path.join(RAG_DATA_DIR, 'builder.lock')
+
+# Shopify catalog sync (incremental via updated_at_min, full re-sync periodically)
+SHOPIFY_CATALOG_PATH = os.path.join(RAG_DATA_DIR, 'shopify_catalog.json')
+SHOPIFY_FULL_SYNC_INTERVAL = int(os.environ.get('SHOPIFY_FULL_SYNC_INTERVAL', 24 * 3600))
+SHOPIFY_PRODUCT_FIELDS = 'id,title,body_html,product_type,vendor,tags,variants,handle,updated_at'
+
+# Index snapshot (warm start for new workers)
+RAG_SNAPSHOT_PATH = os.path.join(RAG_DATA_DIR, 'index.snapshot')
+RAG_SNAPSHOT_MAGIC = b'TAIYARIX'
+RAG_SNAPSHOT_VERSION = 2
+
+# RAG ranking (BM25)
+RAG_BM25_K1 = float(os.environ.get('RAG_BM25_K1', 1.2))
+RAG_BM25_B = float(os.environ.get('RAG_BM25_B', 0.75))
+RAG_SHOPIFY_BOOST = float(os.environ.get('RAG_SHOPIFY_BOOST', 1.5))  # Product queries -> Shopify docs
+RAG_FAQ_BOOST = float(os.environ.get('RAG_FAQ_BOOST', 1.3))  # Question words -> FAQ docs
+RAG_PRODUCT_QUERY_WORDS = ['prix', 'price', 'coût', 'combien', 'acheter', 'buy']
+RAG_QUESTION_WORDS = ['comment', 'pourquoi', 'quand', 'how', 'why', 'when']
+RAG_PASSAGE_SIZE = int(os.environ.get('RAG_PASSAGE_SIZE', 700))  # Characters per indexed passage
+RAG_PASSAGE_OVERLAP = int(os.environ.get('RAG_PASSAGE_OVERLAP', 150))
+RAG_MAX_PASSAGES_PER_DOC = int(os.environ.get('RAG_MAX_PASSAGES_PER_DOC', 2))  # In one result list
+RAG_SCORING = os.environ.get('RAG_SCORING', 'postings')  # 'postings' or 'csr' (sparse matrix, needs numpy + scipy)
+RAG_QUERY_CACHE_SIZE = int(os.environ.get('RAG_QUERY_CACHE_SIZE', 512))  # Cached search results
+
+# Chat lookups (HubSpot, Shopify, RAG) run concurrently under one shared deadline
+CHAT_LOOKUP_DEADLINE = float(os.environ.get('CHAT_LOOKUP_DEADLINE', 4))  # Seconds; late lookups are left out of the context
+CHAT_LOOKUP_WORKERS = int(os.environ.get('CHAT_LOOKUP_WORKERS', 16))
+
 # Session timeout settings
 TIMEOUT_WARNING = 5 * 60
 TIMEOUT_CLOSE = 10 * 60
@@ -44,31 +139,774 @@ TIMEOUT_CLOSE = 10 * 60
 MAX_MESSAGES_PER_SESSION = 20
 MAX_SESSION_DURATION = 15 * 60  # 15 minutes
 
+# Session storage: 'memory' (per worker) or 'sqlite' (shared by all workers)
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'memory')
+SESSION_SQLITE_PATH = os.path.join(RAG_DATA_DIR, 'sessions.sqlite3')
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 2 * 3600))  # Seconds without activity before a session is dropped
+SESSION_MAX_COUNT = int(os.environ.get('SESSION_MAX_COUNT', 5000))  # Least recently active sessions go first
+
+# Outgoing emails are queued in a local SQLite outbox and sent by a single drainer
+EMAIL_OUTBOX_PATH = os.path.join(RAG_DATA_DIR, 'outbox.sqlite3')
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 6))
+EMAIL_RETRY_DELAY = int(os.environ.get('EMAIL_RETRY_DELAY', 30))  # Seconds before the first retry, doubled after each failure
+
 # Dashboard password (change this!)
 DASHBOARD_PASSWORD = os.environ.get('DASHBOARD_PASSWORD', 'marakame2024')
 
+# Unique visitors: 'hll' keeps fixed-size HyperLogLog sketches (~1.6% error), 'exact' keeps sets of IPs
+ANALYTICS_VISITOR_MODE = os.environ.get('ANALYTICS_VISITOR_MODE', 'hll').lower()
+ANALYTICS_HLL_PRECISION = int(os.environ.get('ANALYTICS_HLL_PRECISION', 12))  # 2^12 registers = 4 KB per sketch
+
+# Analytics events are appended to per-worker log segments, then folded into a shared rollup
+ANALYTICS_DIR = os.environ.get('ANALYTICS_DIR', os.path.join(RAG_DATA_DIR, 'analytics'))
+ANALYTICS_SEGMENT_SECONDS = int(os.environ.get('ANALYTICS_SEGMENT_SECONDS', 60))  # A worker seals its segment this often
+ANALYTICS_SEGMENT_MAX_BYTES = int(os.environ.get('ANALYTICS_SEGMENT_MAX_BYTES', 4 * 1024 * 1024))
+ANALYTICS_COMPACT_INTERVAL = int(os.environ.get('ANALYTICS_COMPACT_INTERVAL', 60))
+ANALYTICS_QUEUE_SIZE = 10000  # Events waiting for the writer; beyond this they are dropped, never blocking a request
+DASHBOARD_CACHE_SECONDS = int(os.environ.get('DASHBOARD_CACHE_SECONDS', 60))  # Dashboard numbers/page are recomputed this often
+
 # ==================== BLOCKED COUNTRIES ====================
+# Local IP-to-country database (CSV ranges or MaxMind .mmdb). Without it, lookups go to ip-api.com
+GEOIP_DB_PATH = os.environ.get('GEOIP_DB_PATH')
+IP_COUNTRY_CACHE_SIZE = int(os.environ.get('IP_COUNTRY_CACHE_SIZE', 10000))
+IP_COUNTRY_CACHE_TTL = int(os.environ.get('IP_COUNTRY_CACHE_TTL', 24 * 3600))
 BLOCKED_COUNTRIES = ['IN', 'PK', 'BD', 'NG', 'CI']  # India, Pakistan, Bangladesh, Nigeria, Côte d'Ivoire
 
+# ==================== CACHES ====================
+class LRUCache:
+    """Bounded, thread-safe LRU cache with optional expiry (ttl in seconds) and hit/miss/eviction counters"""
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, expires_at or None)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # Dropped to stay under maxsize
+        self.expirations = 0  # Dropped because their ttl ran out
+    
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or time.monotonic() < expires_at:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.expirations += 1
+            self.misses += 1
+            return default
+    
+    def set(self, key, value, ttl=None):
+        """Store value; ttl overrides the cache's default expiry for this entry"""
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[0] if entry is not None else default
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key: one caller does the work, the others wait for its result"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> {'done': Event, 'result', 'error'}
+        self.coalesced = 0
+    
+    def do(self, key, function, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        
+        try:
+            call['result'] = function(*args)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+# ==================== VISITOR SKETCHES ====================
+class HyperLogLog:
+    """Approximate distinct counter with a fixed memory ceiling.
+    
+    Starts sparse (the exact 64-bit hashes seen so far) and switches to 2^precision one-byte
+    registers once the hashes would take more room than the registers; from then on memory is
+    constant whatever the traffic. Sketches of the same precision merge losslessly.
+    """
+    def __init__(self, precision=None):
+        self.precision = precision or ANALYTICS_HLL_PRECISION
+        self.m = 1 << self.precision
+        self.hashes = set()  # Sparse mode
+        self.registers = None  # Dense mode: bytearray(m)
+    
+    @staticmethod
+    def _hash(item):
+        return int.from_bytes(hashlib.blake2b(str(item).encode('utf-8'), digest_size=8).digest(), 'big')
+    
+    def _add_hash(self, h):
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    def _densify(self):
+        self.registers = bytearray(self.m)
+        for h in self.hashes:
+            self._add_hash(h)
+        self.hashes = set()
+    
+    def add(self, item):
+        self.add_hash(self._hash(item))
+    
+    def add_hash(self, h):
+        """Add an item by its 64-bit hash (see visitor_hash)"""
+        if self.registers is not None:
+            self._add_hash(h)
+        else:
+            self.hashes.add(h)
+            if len(self.hashes) > self.m // 16:
+                self._densify()
+    
+    def update(self, other):
+        """Merge another sketch into this one (union of the counted items)"""
+        if other.precision != self.precision:
+            raise ValueError(f"Cannot merge HyperLogLog sketches of precision {self.precision} and {other.precision}")
+        if other.registers is None:
+            if self.registers is not None:
+                for h in other.hashes:
+                    self._add_hash(h)
+            else:
+                self.hashes |= other.hashes
+                if len(self.hashes) > self.m // 16:
+                    self._densify()
+            return
+        if self.registers is None:
+            self._densify()
+        self.registers = bytearray(map(max, self.registers, other.registers))
+    
+    def count(self):
+        if self.registers is None:
+            return len(self.hashes)
+        m = self.m
+        histogram = Counter(self.registers)
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(n * 2.0 ** -rank for rank, n in histogram.items())
+        zeros = histogram.get(0, 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # Linear counting is more accurate for small cardinalities
+        return int(round(estimate))
+    
+    def __len__(self):
+        return self.count()
+    
+    def to_json(self):
+        if self.registers is None:
+            return {'p': self.precision, 'hashes': sorted(self.hashes)}
+        return {'p': self.precision, 'registers': base64.b64encode(bytes(self.registers)).decode('ascii')}
+    
+    @classmethod
+    def from_json(cls, data):
+        sketch = cls(data['p'])
+        if 'registers' in data:
+            sketch.registers = bytearray(base64.b64decode(data['registers']))
+        else:
+            sketch.hashes = set(data['hashes'])
+        return sketch
+
+def visitor_hash(ip):
+    """What the visitor sets/sketches (and the analytics log) hold instead of raw IPs"""
+    return HyperLogLog._hash(ip)
+
+def new_visitor_set():
+    return set() if ANALYTICS_VISITOR_MODE == 'exact' else HyperLogLog()
+
+def add_visitor(visitors, h):
+    if isinstance(visitors, HyperLogLog):
+        visitors.add_hash(h)
+    else:
+        visitors.add(h)
+
+def visitor_count(visitors):
+    """Unique visitors held in an exact set or a HyperLogLog sketch (or an already computed count)"""
+    return visitors if isinstance(visitors, int) else len(visitors)
+
+def merge_visitors(visitor_sets):
+    """Union of several visitor sets/sketches, e.g. the daily ones of a week"""
+    merged = new_visitor_set()
+    for visitors in visitor_sets:
+        if isinstance(merged, set) and isinstance(visitors, HyperLogLog):
+            # Exact sets absorbed into a sketch (e.g. a rollup written in the other mode)
+            sketch = HyperLogLog(visitors.precision)
+            for h in merged:
+                sketch.add_hash(h)
+            merged = sketch
+        if isinstance(merged, set):
+            merged |= visitors
+        elif isinstance(visitors, HyperLogLog):
+            merged.update(visitors)
+        else:
+            for h in visitors:
+                merged.add_hash(h)
+    return merged
+
+def visitors_to_json(visitors):
+    if isinstance(visitors, HyperLogLog):
+        return visitors.to_json()
+    return sorted(visitors)
+
+def visitors_from_json(data):
+    """Load a stored set/sketch into the current ANALYTICS_VISITOR_MODE (a stored sketch stays a sketch)"""
+    visitors = new_visitor_set()
+    if isinstance(data, dict):
+        return HyperLogLog.from_json(data)
+    for h in data:
+        add_visitor(visitors, h)
+    return visitors
+
 # ==================== ANALYTICS DATA ====================
-analytics = {
-    'daily': defaultdict(lambda: {'visitors': set(), 'messages': 0, 'sessions': 0}),
-    'monthly': defaultdict(lambda: {'visitors': set(), 'messages': 0, 'sessions': 0}),
-    'blocked_ips': defaultdict(int),  # Count blocked attempts by country
-    'countries': defaultdict(lambda: {'visitors': set(), 'messages': 0}),  # Stats by country
-    'daily_countries': defaultdict(lambda: defaultdict(lambda: {'visitors': set(), 'messages': 0})),  # Daily stats by country
-    'csat': {
-        'ratings': [],  # List of {timestamp, rating, session_id, country}
-        'daily': defaultdict(lambda: {'1': 0, '2': 0, '3': 0}),  # Daily CSAT counts
-        'total': {'1': 0, '2': 0, '3': 0}  # Total CSAT counts
-    },
-    'total_visitors': set(),
-    'total_messages': 0,
-    'total_sessions': 0
-}
+def new_analytics_state():
+    return {
+        'daily': defaultdict(lambda: {'visitors': new_visitor_set(), 'messages': 0, 'sessions': 0}),
+        'monthly': defaultdict(lambda: {'visitors': new_visitor_set(), 'messages': 0, 'sessions': 0}),
+        'blocked_ips': defaultdict(int),  # Count blocked attempts by country
+        'countries': defaultdict(lambda: {'visitors': new_visitor_set(), 'messages': 0}),  # Stats by country
+        'daily_countries': defaultdict(lambda: defaultdict(lambda: {'visitors': new_visitor_set(), 'messages': 0})),  # Daily stats by country
+        'csat': {
+            'ratings': [],  # List of {timestamp, rating, session_id, country}
+            'daily': defaultdict(lambda: {'1': 0, '2': 0, '3': 0}),  # Daily CSAT counts
+            'total': {'1': 0, '2': 0, '3': 0}  # Total CSAT counts
+        },
+        'total_visitors': new_visitor_set(),
+        'total_messages': 0,
+        'total_sessions': 0
+    }
+
+def apply_analytics_event(state, event):
+    """Fold one logged event ('visit', 'session', 'csat' or 'blocked') into an analytics state"""
+    kind = event['e']
+    today = event['d']
+    month = today[:7]
+    
+    if kind == 'visit':
+        country_name = event['c']
+        for bucket in (state['daily'][today], state['monthly'][month],
+                       state['countries'][country_name], state['daily_countries'][today][country_name]):
+            add_visitor(bucket['visitors'], event['v'])
+            bucket['messages'] += 1
+        add_visitor(state['total_visitors'], event['v'])
+        state['total_messages'] += 1
+    
+    elif kind == 'session':
+        state['daily'][today]['sessions'] += 1
+        state['monthly'][month]['sessions'] += 1
+        state['total_sessions'] += 1
+    
+    elif kind == 'csat':
+        rating_str = str(event['r'])
+        state['csat']['ratings'].append({
+            'timestamp': event['t'],
+            'rating': event['r'],
+            'session_id': event['s'],
+            'country': event['c'],
+            'date': today
+        })
+        if rating_str in state['csat']['daily'][today]:
+            state['csat']['daily'][today][rating_str] += 1
+        if rating_str in state['csat']['total']:
+            state['csat']['total'][rating_str] += 1
+    
+    elif kind == 'blocked':
+        state['blocked_ips'][f"{today}_{event['cc']}"] += 1
+
+def analytics_state_to_json(state):
+    def bucket_to_json(bucket):
+        return dict(bucket, visitors=visitors_to_json(bucket['visitors']))
+    
+    return {
+        'daily': {day: bucket_to_json(b) for day, b in state['daily'].items()},
+        'monthly': {month: bucket_to_json(b) for month, b in state['monthly'].items()},
+        'blocked_ips': dict(state['blocked_ips']),
+        'countries': {country: bucket_to_json(b) for country, b in state['countries'].items()},
+        'daily_countries': {
+            day: {country: bucket_to_json(b) for country, b in countries.items()}
+            for day, countries in state['daily_countries'].items()
+        },
+        'csat': {
+            'ratings': state['csat']['ratings'],
+            'daily': dict(state['csat']['daily']),
+            'total': state['csat']['total']
+        },
+        'total_visitors': visitors_to_json(state['total_visitors']),
+        'total_messages': state['total_messages'],
+        'total_sessions': state['total_sessions']
+    }
+
+def analytics_state_from_json(data):
+    state = new_analytics_state()
+    
+    def bucket_from_json(bucket):
+        return dict(bucket, visitors=visitors_from_json(bucket['visitors']))
+    
+    for key in ('daily', 'monthly', 'countries'):
+        for name, bucket in data.get(key, {}).items():
+            state[key][name] = bucket_from_json(bucket)
+    for day, countries in data.get('daily_countries', {}).items():
+        for country, bucket in countries.items():
+            state['daily_countries'][day][country] = bucket_from_json(bucket)
+    state['blocked_ips'].update(data.get('blocked_ips', {}))
+    csat = data.get('csat', {})
+    state['csat']['ratings'] = csat.get('ratings', [])
+    state['csat']['daily'].update(csat.get('daily', {}))
+    state['csat']['total'].update(csat.get('total', {}))
+    if 'total_visitors' in data:
+        state['total_visitors'] = visitors_from_json(data['total_visitors'])
+    state['total_messages'] = data.get('total_messages', 0)
+    state['total_sessions'] = data.get('total_sessions', 0)
+    return state
+
+class AnalyticsLog:
+    """Durable analytics shared by all workers: append-only event segments folded into a rollup.
+    
+    Requests only put events on a queue. A writer thread per worker appends them as JSON lines
+    to its own segment ('<worker>-<seq>.open'), sealed into '<worker>-<seq>.log' every
+    ANALYTICS_SEGMENT_SECONDS. A compactor (whichever worker holds compact.lock) folds sealed
+    segments into rollup.json and deletes them; the rollup records the segments it has folded,
+    so a crash between the two steps doesn't count them twice. view() is the rollup plus every
+    segment not folded yet, i.e. all workers and restarts. It is maintained incrementally: the
+    rollup is reloaded only when the compactor rewrites it, and segments are read from where the
+    previous call stopped.
+    
+    Without a usable directory, events are applied to an in-process state instead.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{int(time.time())}"
+        self.queue = queue.Queue(maxsize=ANALYTICS_QUEUE_SIZE)
+        self.dropped = 0
+        self.local_state = None
+        self._local_lock = threading.Lock()
+        self._segment = None
+        self._segment_path = None
+        self._segment_opened = 0
+        self._write_lock = threading.Lock()  # The writer thread and flush() at exit share the segment
+        self._sequence = 0
+        self._started = False
+        self.rollup_path = os.path.join(directory, 'rollup.json') if directory else None
+        self._view_lock = threading.Lock()
+        self._view_state = None
+        self._view_rollup = None  # (inode, mtime, size) of the rollup the view was built on
+        self._view_folded = set()
+        self._view_offsets = {}  # Segment stem -> bytes already applied to the view
+        self.lock_path = os.path.join(directory, 'compact.lock') if directory else None
+        
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except (OSError, TypeError) as e:
+            print(f"DEBUG: Analytics: no usable log directory ({e}), keeping analytics in memory only")
+            self.directory = None
+            self.local_state = new_analytics_state()
+    
+    # ---- Writing ----
+    def append(self, event):
+        """Record an event; never blocks the request"""
+        if self.directory is None:
+            with self._local_lock:
+                apply_analytics_event(self.local_state, event)
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+    
+    def start(self):
+        if self.directory is None or self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._writer_loop, name='analytics-writer', daemon=True).start()
+        threading.Thread(target=self._compactor_loop, name='analytics-compactor', daemon=True).start()
+        atexit.register(self.flush)
+    
+    def _open_segment(self):
+        self._sequence += 1
+        self._segment_path = os.path.join(self.directory, f"{self.worker_id}-{self._sequence:06d}.open")
+        self._segment = open(self._segment_path, 'a', encoding='utf-8')
+        self._segment_opened = time.monotonic()
+    
+    def _seal_segment(self):
+        if self._segment is None:
+            return
+        segment, self._segment = self._segment, None  # Whatever happens below, the next write opens a new segment
+        segment.close()
+        try:
+            os.replace(self._segment_path, self._segment_path[:-len('.open')] + '.log')
+        except FileNotFoundError:
+            pass  # Another worker's compactor took it for a dead worker's segment and sealed it already
+    
+    def _write(self, events):
+        if self._segment is not None and not os.path.exists(self._segment_path):
+            # Sealed by another worker's compactor while this one was idle: its events may be folded already
+            self._segment.close()
+            self._segment = None
+        if self._segment is None:
+            self._open_segment()
+        self._segment.write(''.join(json.dumps(event, separators=(',', ':'), ensure_ascii=False) + '\n' for event in events))
+        self._segment.flush()
+        if self._segment.tell() >= ANALYTICS_SEGMENT_MAX_BYTES:
+            self._seal_segment()
+    
+    def _drain(self, block):
+        events = []
+        try:
+            events.append(self.queue.get(timeout=1) if block else self.queue.get_nowait())
+            while len(events) < 1000:
+                events.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return events
+    
+    def _writer_loop(self):
+        while True:
+            try:
+                events = self._drain(block=True)
+                with self._write_lock:
+                    if events:
+                        self._write(events)
+                    if self._segment is not None and time.monotonic() - self._segment_opened >= ANALYTICS_SEGMENT_SECONDS:
+                        self._seal_segment()
+            except Exception as e:
+                print(f"DEBUG: Analytics writer error: {e}")
+                time.sleep(1)
+    
+    def flush(self):
+        """Write out whatever is queued and seal the current segment (at exit)"""
+        try:
+            with self._write_lock:
+                events = self._drain(block=False)
+                while events:
+                    self._write(events)
+                    events = self._drain(block=False)
+                self._seal_segment()
+        except Exception as e:
+            print(f"DEBUG: Analytics flush error: {e}")
+    
+    # ---- Reading ----
+    def _segments(self):
+        """Segment files in event order: (name, path)"""
+        try:
+            names = sorted(name for name in os.listdir(self.directory) if name.endswith(('.log', '.open')))
+        except OSError:
+            return []
+        return [(name, os.path.join(self.directory, name)) for name in names]
+    
+    @staticmethod
+    def _read_from(path, offset=0):
+        """Events on the complete lines after byte `offset` of a segment, and the offset after them
+        (a writer may be in the middle of the last line)"""
+        events = []
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return events, offset
+    
+    def _rollup_version(self):
+        try:
+            info = os.stat(self.rollup_path)
+        except OSError:
+            return None
+        return info.st_ino, info.st_mtime_ns, info.st_size
+    
+    def _load_rollup(self):
+        try:
+            with open(self.rollup_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return new_analytics_state(), set()
+        except (OSError, ValueError) as e:
+            print(f"DEBUG: Analytics rollup unreadable: {e}")
+            return new_analytics_state(), set()
+        return analytics_state_from_json(data.get('state', {})), set(data.get('folded', []))
+    
+    def view(self):
+        """Merged analytics across workers and restarts.
+        
+        The returned state is this worker's copy and keeps being updated in place by later calls.
+        Without a directory it is a snapshot instead: requests keep appending to the live state.
+        """
+        if self.directory is None:
+            with self._local_lock:
+                return copy.deepcopy(self.local_state)
+        with self._view_lock:
+            version = self._rollup_version()
+            if self._view_state is None or version != self._view_rollup:
+                # First call, or the compactor folded segments: start over from the new rollup
+                self._view_state, self._view_folded = self._load_rollup()
+                self._view_rollup = version
+                self._view_offsets = {}
+            
+            stems = set()
+            for name, path in self._segments():
+                stem = name.rsplit('.', 1)[0]
+                if stem in self._view_folded:
+                    continue
+                stems.add(stem)
+                events, self._view_offsets[stem] = self._read_from(path, self._view_offsets.get(stem, 0))
+                for event in events:
+                    apply_analytics_event(self._view_state, event)
+            # Forget segments that are gone (folded and deleted by the compactor)
+            self._view_offsets = {stem: offset for stem, offset in self._view_offsets.items() if stem in stems}
+            return self._view_state
+    
+    # ---- Compaction ----
+    def _compactor_loop(self):
+        while True:
+            time.sleep(ANALYTICS_COMPACT_INTERVAL)
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"DEBUG: Analytics compaction error: {e}")
+    
+    def compact(self):
+        """Fold sealed segments into the rollup; only one worker at a time does it"""
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            
+            # Segments left open by a worker that died (crash, redeploy) are sealed as they are
+            stale_after = time.time() - 3 * max(ANALYTICS_SEGMENT_SECONDS, ANALYTICS_COMPACT_INTERVAL)
+            for name, path in self._segments():
+                if name.endswith('.open') and path != self._segment_path and os.path.getmtime(path) < stale_after:
+                    os.replace(path, path[:-len('.open')] + '.log')
+            
+            segments = [(name, path) for name, path in self._segments() if name.endswith('.log')]
+            state, folded = self._load_rollup()
+            # Forget segments that were folded and deleted already
+            folded &= {name[:-len('.log')] for name, _ in segments}
+            
+            started = time.monotonic()
+            new_segments = [(name, path) for name, path in segments if name[:-len('.log')] not in folded]
+            if new_segments:
+                for name, path in new_segments:
+                    for event in self._read_from(path)[0]:
+                        apply_analytics_event(state, event)
+                    folded.add(name[:-len('.log')])
+                
+                tmp_path = self.rollup_path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'state': analytics_state_to_json(state), 'folded': sorted(folded),
+                               'compacted_at': datetime.now().isoformat()}, f, ensure_ascii=False, separators=(',', ':'))
+                os.replace(tmp_path, self.rollup_path)
+                print(f"DEBUG: Analytics: folded {len(new_segments)} segments in {time.monotonic() - started:.2f}s")
+            
+            # Including segments folded by a compaction that died before deleting them
+            for _, path in segments:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            return True
+    
+    def stats(self):
+        return {
+            'directory': self.directory,
+            'queued': self.queue.qsize(),
+            'dropped': self.dropped
+        }
 
-# Cache for IP to country mapping (avoid repeated API calls)
-ip_country_cache = {}
+analytics_log = AnalyticsLog(ANALYTICS_DIR)
+
+# ==================== GEOLOCATION ====================
+class GeoIPDatabase:
+    """In-memory IP-to-country lookup over sorted integer ranges (binary search, no network I/O).
+    
+    Reads CSV range files, one range per row, IPv4 and IPv6 mixed:
+        start,end,country_code[,country_name]   (dotted/colon addresses or integers, e.g. DB-IP, IP2Location)
+        network,country_code[,country_name]     (CIDR, e.g. 1.2.3.0/24)
+    Rows that don't parse (headers, comments) are skipped.
+    """
+    UNKNOWN = {'code': 'XX', 'name': 'Unknown'}
+    IPV4_MAPPED = 0xFFFF << 32
+    
+    def __init__(self):
+        # Per IP version: range starts, range ends and an index into self.countries, all sorted by start
+        self.starts = {4: [], 6: []}
+        self.ends = {4: [], 6: []}
+        self.country_ids = {4: [], 6: []}
+        self.countries = []
+    
+    @classmethod
+    def from_csv(cls, path):
+        db = cls()
+        country_index = {}
+        ranges = {4: [], 6: []}
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.reader(f):
+                parsed = cls._parse_row([field.strip() for field in row])
+                if not parsed:
+                    continue
+                version, start, end, code, name = parsed
+                key = (code, name)
+                if key not in country_index:
+                    country_index[key] = len(db.countries)
+                    db.countries.append({'code': code, 'name': name})
+                ranges[version].append((start, end, country_index[key]))
+        
+        for version, rows in ranges.items():
+            rows.sort()
+            db.starts[version] = [row[0] for row in rows]
+            db.ends[version] = [row[1] for row in rows]
+            db.country_ids[version] = [row[2] for row in rows]
+        return db
+    
+    @staticmethod
+    def _parse_address(value, version=None):
+        if value.isdigit():
+            number = int(value)
+            return (version or (4 if number < 2 ** 32 else 6)), number
+        address = ipaddress.ip_address(value)
+        return address.version, int(address)
+    
+    @classmethod
+    def _parse_row(cls, row):
+        if not row or not row[0] or row[0].startswith('#'):
+            return None
+        try:
+            if '/' in row[0]:
+                network = ipaddress.ip_network(row[0], strict=False)
+                version, start, end = network.version, int(network.network_address), int(network.broadcast_address)
+                rest = row[1:]
+            else:
+                version, start = cls._parse_address(row[0])
+                _, end = cls._parse_address(row[1], version)
+                rest = row[2:]
+        except (ValueError, IndexError):
+            return None
+        if version == 6 and cls.IPV4_MAPPED <= start and end < cls.IPV4_MAPPED + 2 ** 32:
+            # IPv6 files list IPv4 ranges as ::ffff:a.b.c.d
+            version, start, end = 4, start - cls.IPV4_MAPPED, end - cls.IPV4_MAPPED
+        
+        code = rest[0].upper() if rest else ''
+        if len(code) != 2 or code == '-':
+            return None
+        name = rest[1] if len(rest) > 1 and rest[1] and rest[1] != '-' else code
+        return version, start, end, code, name
+    
+    def lookup(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return self.UNKNOWN
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        
+        version, number = address.version, int(address)
+        i = bisect.bisect_right(self.starts[version], number) - 1
+        if i >= 0 and number <= self.ends[version][i]:
+            return self.countries[self.country_ids[version][i]]
+        return self.UNKNOWN
+    
+    def __len__(self):
+        return len(self.starts[4]) + len(self.starts[6])
+
+class MaxMindGeoIPDatabase:
+    """Same interface as GeoIPDatabase, backed by a MaxMind/DB-IP .mmdb file (requires maxminddb)"""
+    def __init__(self, path):
+        self.reader = maxminddb.open_database(path)
+    
+    def lookup(self, ip):
+        try:
+            record = self.reader.get(ip)
+        except ValueError:
+            record = None
+        country = (record or {}).get('country') or (record or {}).get('registered_country')
+        if not country or not country.get('iso_code'):
+            return GeoIPDatabase.UNKNOWN
+        return {'code': country['iso_code'], 'name': country.get('names', {}).get('en', country['iso_code'])}
+    
+    def describe(self):
+        return f"{self.reader.metadata().database_type} database"
+
+def load_geoip_database(path):
+    """Load the configured IP-to-country database, or None (lookups then fall back to ip-api.com)"""
+    if not path:
+        return None
+    try:
+        started = time.monotonic()
+        if path.endswith('.mmdb'):
+            if maxminddb is None:
+                print(f"DEBUG: GeoIP: {path} is an MMDB file but the maxminddb package is not installed")
+                return None
+            db = MaxMindGeoIPDatabase(path)
+            loaded = db.describe()
+        else:
+            db = GeoIPDatabase.from_csv(path)
+            if not len(db):
+                raise ValueError("no usable IP ranges in the file")
+            loaded = f"{len(db)} ranges"
+        print(f"DEBUG: GeoIP: loaded {loaded} from {path} in {time.monotonic() - started:.1f}s")
+        return db
+    except Exception as e:
+        # Best effort: a missing, unreadable or corrupt file (e.g. maxminddb.InvalidDatabaseError) means ip-api.com
+        print(f"DEBUG: GeoIP: could not load {path}: {e}")
+        return None
+
+geoip = load_geoip_database(GEOIP_DB_PATH)
+
+# Cache for IP to country mapping (avoid repeated API calls), bounded so bot traffic can't grow it forever
+ip_country_cache = LRUCache(IP_COUNTRY_CACHE_SIZE, ttl=IP_COUNTRY_CACHE_TTL)
 
 def get_client_ip():
     """Get the real client IP address"""
@@ -82,9 +920,15 @@ def get_client_ip():
     return request.remote_addr
 
 def get_country_from_ip(ip):
-    """Get country code and name from IP using free API"""
-    if ip in ip_country_cache:
-        return ip_country_cache[ip]
+    """Get country code and name from IP: local database if configured, else the free ip-api.com API"""
+    cached = ip_country_cache.get(ip)
+    if cached is not None:
+        return cached
+    
+    if geoip is not None:
+        result = geoip.lookup(ip)
+        ip_country_cache.set(ip, result)
+        return result
     
     try:
         # Use ip-api.com (free, no key required, 45 requests/minute)
@@ -95,334 +939,1261 @@ def get_country_from_ip(ip):
                 'code': data.get('countryCode', 'XX'),
                 'name': data.get('country', 'Unknown')
             }
-            ip_country_cache[ip] = result
+            ip_country_cache.set(ip, result)
             return result
     except:
         pass
     return {'code': 'XX', 'name': 'Unknown'}
 
-def is_ip_blocked(ip):
-    """Check if IP is from a blocked country"""
-    if ip in ['127.0.0.1', 'localhost', '::1']:
-        return False  # Allow localhost
+def is_ip_blocked(ip):
+    """Check if IP is from a blocked country"""
+    if ip in ['127.0.0.1', 'localhost', '::1']:
+        return False  # Allow localhost
+    
+    country_data = get_country_from_ip(ip)
+    if country_data['code'] in BLOCKED_COUNTRIES:
+        # Track blocked attempts
+        analytics_log.append({'e': 'blocked', 'd': datetime.now().strftime('%Y-%m-%d'), 'cc': country_data['code']})
+        return True
+    return False
+
+def track_visitor(ip, session_id):
+    """Track visitor for analytics (daily, monthly, by country, total)"""
+    country_data = get_country_from_ip(ip)
+    analytics_log.append({
+        'e': 'visit',
+        'd': datetime.now().strftime('%Y-%m-%d'),
+        'v': visitor_hash(ip),
+        'c': country_data['name']
+    })
+
+def track_new_session(ip):
+    """Track new session"""
+    analytics_log.append({'e': 'session', 'd': datetime.now().strftime('%Y-%m-%d')})
+
+def track_csat(rating, session_id, ip):
+    """Track CSAT rating"""
+    country_data = get_country_from_ip(ip)
+    analytics_log.append({
+        'e': 'csat',
+        'd': datetime.now().strftime('%Y-%m-%d'),
+        't': datetime.now().isoformat(),
+        'r': rating,
+        's': session_id,
+        'c': country_data['name']
+    })
+
+# ==================== LANGUAGE DETECTION & TRANSLATION ====================
+# Words that give a language away: function words, greetings and the shop's vocabulary.
+# Words shared by several languages count for each of them, split evenly.
+LANGUAGE_WORDS = {
+    'fr': """le la les un une des du de et est sont je tu vous nous il elle pour avec dans sur pas ne que qui quoi
+             quel quels quelle quelles comment combien où quand bonjour bonsoir salut merci plaît svp livraison commande
+             délai délais prix bijou bijoux bague collier bracelet boucles oreilles retour paiement envoyer suisse
+             ai mon ma mes votre vos aussi très bien peux puis voudrais veux avez êtes faire fait main est-ce c'est""",
+    'en': """the an and is are you we it for with in on not what which how much many where when hello hi hey thanks
+             thank please good morning afternoon evening delivery shipping order price jewelry jewellery ring necklace
+             bracelet earrings return refund payment want can need have has my your do does would could made hand also
+             very switzerland""",
+    'es': """el la los las un una unos de del es son yo usted ustedes nosotros para con en por no que qué cuál cómo
+             cuánto cuánta dónde cuándo hola gracias favor buenos buenas días tardes noches entrega envío envio pedido
+             precio joyas joyería pulsera collar anillo aretes pendientes devolución pago quiero puedo necesito tengo
+             está están tienen mi mis su hacer hecho mano también muy bien suiza españa""",
+    'de': """der die das ein eine und ist sind ich sie wir es für mit in auf nicht was welche wie viel wo wann hallo
+             guten tag morgen abend danke bitte lieferung versand bestellung preis schmuck ring kette armband ohrringe
+             rückgabe zahlung möchte kann brauche habe hat mein meine ihr ihre auch sehr gut handgemacht schweiz""",
+    'it': """il lo la gli le un una è sono io lei noi per con in su non che cosa quale come quanto dove quando ciao
+             buongiorno buonasera grazie favore consegna spedizione ordine prezzo gioielli anello collana braccialetto
+             orecchini reso pagamento voglio posso ho bisogno mio mia suo anche molto bene fatto mano svizzera""",
+    'pt': """os as um uma é são eu você vocês nós para com em não que qual como quanto onde quando olá obrigado
+             obrigada favor bom dia boa tarde noite entrega envio pedido encomenda preço joias anel colar pulseira
+             brincos devolução pagamento quero posso preciso tenho meu minha seu também muito feito mão suíça""",
+    'nl': """de het een en is zijn ik jij wij voor met in op niet wat welke hoe veel waar wanneer hallo goedemorgen
+             goedemiddag dank bedankt alstublieft graag levering verzending bestelling prijs sieraden ring ketting
+             armband oorbellen retour betaling wil kan nodig heb mijn uw ook zeer heel handgemaakt zwitserland""",
+}
+
+# Typical customer messages, only used to build the character n-gram profiles
+LANGUAGE_SAMPLES = {
+    'fr': "Bonjour, quels sont les délais de livraison pour la France ? Je voudrais commander un collier fait main.",
+    'en': "Hello, how long does shipping take to the United States? I would like to order a handmade necklace.",
+    'es': "Hola, ¿cuánto tarda el envío a España? Me gustaría pedir un collar hecho a mano, gracias.",
+    'de': "Guten Tag, wie lange dauert die Lieferung nach Deutschland? Ich möchte eine handgemachte Kette bestellen.",
+    'it': "Buongiorno, quanto tempo ci vuole per la spedizione in Italia? Vorrei ordinare una collana fatta a mano.",
+    'pt': "Olá, quanto tempo demora a entrega para Portugal? Gostaria de encomendar um colar feito à mão, obrigado.",
+    'nl': "Hallo, hoe lang duurt de verzending naar Nederland? Ik wil graag een handgemaakte ketting bestellen.",
+}
+
+# Non-Latin scripts identify the language on their own (Japanese before Chinese: it mixes kana with kanji)
+LANGUAGE_SCRIPTS = [
+    ('ar', re.compile(r'[\u0600-\u06FF\u0750-\u077F]')),
+    ('ru', re.compile(r'[\u0400-\u04FF]')),
+    ('he', re.compile(r'[\u0590-\u05FF]')),
+    ('el', re.compile(r'[\u0370-\u03FF]')),
+    ('ja', re.compile(r'[\u3040-\u30FF]')),
+    ('zh', re.compile(r'[\u4E00-\u9FFF]')),
+    ('ko', re.compile(r'[\uAC00-\uD7AF]')),
+    ('th', re.compile(r'[\u0E00-\u0E7F]')),
+    ('hi', re.compile(r'[\u0900-\u097F]')),
+]
+
+class LanguageDetector:
+    """Language identification built once at import: script check, then word lookups, then n-grams.
+    
+    1. A message mostly written in a non-Latin script gets that script's language.
+    2. Each token is looked up in a word -> {language: weight} table (one dict lookup per token).
+    3. If no language clearly wins, character trigram profiles decide between the candidates.
+    Messages with no evidence at all, or too short to judge ("no", "Hallo"), keep the conversation's
+    previous language; the first message of a conversation falls back to French, the shop's language.
+    """
+    DEFAULT = 'fr'
+    MIN_SIMILARITY = 0.05
+    MIN_TOKENS = 2  # A single word is shared by too many languages ("no", "si", "hallo") to be trusted
+    TOKEN_RE = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?")
+    NOISE_RE = re.compile(r'\S+@\S+|https?://\S+|www\.\S+')  # Emails and URLs say nothing about the language
+    LATIN_RE = re.compile(r'[a-zA-Z\u00C0-\u024F]')
+    
+    def __init__(self, words, samples, scripts):
+        self.scripts = scripts
+        self.non_latin = re.compile('|'.join(pattern.pattern for _, pattern in scripts))
+        self.languages = sorted(words)
+        
+        # word -> ((language, weight), ...)
+        owners = defaultdict(list)
+        for language, text in words.items():
+            for word in set(text.split()):
+                owners[word].append(language)
+        self.word_weights = {word: tuple((language, 1.0 / len(langs)) for language in langs)
+                             for word, langs in owners.items()}
+        
+        self.profiles = {}
+        for language in self.languages:
+            tokens = words[language].split() + self.tokenize(samples.get(language, ''))
+            profile = self._trigrams(tokens)
+            self.profiles[language] = (profile, math.sqrt(sum(n * n for n in profile.values())))
+    
+    @classmethod
+    def tokenize(cls, text):
+        return [token for token in cls.TOKEN_RE.findall(text.lower()) if len(token) > 1]
+    
+    @staticmethod
+    def _trigrams(tokens):
+        grams = Counter()
+        for token in tokens:
+            padded = f" {token} "
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        return grams
+    
+    def _script_language(self, text):
+        if not self.non_latin.search(text):
+            return None
+        latin = len(self.LATIN_RE.findall(text))
+        for language, pattern in self.scripts:
+            count = len(pattern.findall(text))
+            if count and count >= latin:
+                return language
+        return None
+    
+    def word_scores(self, tokens):
+        scores = defaultdict(float)
+        for token in tokens:
+            for language, weight in self.word_weights.get(token, ()):
+                scores[language] += weight
+        return scores
+    
+    def ngram_scores(self, tokens, candidates=None):
+        grams = self._trigrams(tokens)
+        norm = math.sqrt(sum(n * n for n in grams.values()))
+        if not norm:
+            return {}
+        scores = {}
+        for language in candidates or self.languages:
+            profile, profile_norm = self.profiles[language]
+            dot = sum(n * profile[gram] for gram, n in grams.items() if gram in profile)
+            scores[language] = dot / (norm * profile_norm)
+        return scores
+    
+    def detect(self, text, previous=None):
+        script_language = self._script_language(text)
+        if script_language:
+            return script_language
+        
+        tokens = self.tokenize(self.NOISE_RE.sub(' ', text))
+        if len(tokens) < self.MIN_TOKENS:
+            return previous or self.DEFAULT
+        
+        scores = self.word_scores(tokens)
+        if scores:
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            best_language, best_score = ranked[0]
+            runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+            if best_score >= 1 and best_score > runner_up:
+                return best_language
+            if scores.get(self.DEFAULT) == best_score:
+                return self.DEFAULT  # Ambiguous words only ("la", "de"...): stay with the shop's language
+            # Close call: let the n-grams pick among the languages that scored
+            candidates = [language for language, score in ranked if score >= runner_up]
+        else:
+            candidates = None
+        
+        similarities = self.ngram_scores(tokens, candidates)
+        if similarities:
+            language, similarity = max(similarities.items(), key=lambda item: item[1])
+            if similarity >= self.MIN_SIMILARITY:
+                return language
+        return self.DEFAULT
+
+language_detector = LanguageDetector(LANGUAGE_WORDS, LANGUAGE_SAMPLES, LANGUAGE_SCRIPTS)
+
+def detect_language(text, previous=None):
+    """Detect language of the text; previous is the conversation's language so far, kept for short replies"""
+    return language_detector.detect(text, previous)
+
+RAG_QUERY_TRANSLATIONS = {
+    'es': {
+        'tiempo de entrega': 'délai de livraison',
+        'entrega': 'livraison',
+        'envío': 'livraison expédition',
+        'envio': 'livraison expédition',
+        'precio': 'prix',
+        'pedido': 'commande',
+        'pulsera': 'bracelet',
+        'pulseras': 'bracelets',
+        'collar': 'collier',
+        'collares': 'colliers',
+        'anillo': 'bague',
+        'anillos': 'bagues',
+        'pendientes': 'boucles oreilles',
+        'aretes': 'boucles oreilles',
+        'joyería': 'bijoux',
+        'artesanal': 'artisanal',
+        'hecho a mano': 'fait main',
+        'cuánto': 'combien',
+        'cómo': 'comment',
+        'dónde': 'où',
+        'cuándo': 'quand',
+        'qué': 'quoi',
+        'comprar': 'acheter',
+        'devolver': 'retourner',
+        'devolución': 'retour',
+        'pago': 'paiement',
+        'tarjeta': 'carte',
+        'suiza': 'suisse',
+        'españa': 'espagne europe international',
+        'spain': 'espagne europe international',
+        'mexico': 'mexique international',
+        'méxico': 'mexique international',
+        'estados unidos': 'usa international',
+        'francia': 'france europe',
+        'alemania': 'allemagne europe',
+        'italia': 'italie europe',
+        'internacional': 'international',
+        'gratis': 'gratuit',
+        'gratuito': 'gratuit',
+        'hacen': 'font faire',
+        'entregas': 'livraisons livraison'
+    },
+    'en': {
+        'delivery time': 'délai de livraison',
+        'delivery': 'livraison',
+        'shipping': 'livraison expédition',
+        'price': 'prix',
+        'order': 'commande',
+        'bracelet': 'bracelet',
+        'bracelets': 'bracelets',
+        'necklace': 'collier',
+        'necklaces': 'colliers',
+        'ring': 'bague',
+        'rings': 'bagues',
+        'earrings': 'boucles oreilles',
+        'jewelry': 'bijoux',
+        'handmade': 'fait main',
+        'artisan': 'artisanal',
+        'how much': 'combien',
+        'how': 'comment',
+        'where': 'où',
+        'when': 'quand',
+        'what': 'quoi',
+        'buy': 'acheter',
+        'return': 'retour',
+        'payment': 'paiement',
+        'card': 'carte',
+        'switzerland': 'suisse',
+        'international': 'international',
+        'free': 'gratuit'
+    },
+    'de': {
+        'lieferzeit': 'délai de livraison',
+        'lieferung': 'livraison',
+        'versand': 'livraison expédition',
+        'preis': 'prix',
+        'bestellung': 'commande',
+        'armband': 'bracelet',
+        'armbänder': 'bracelets',
+        'halskette': 'collier',
+        'kette': 'collier',
+        'ring': 'bague',
+        'ohrringe': 'boucles oreilles',
+        'schmuck': 'bijoux',
+        'handgemacht': 'fait main',
+        'wie viel': 'combien',
+        'wie': 'comment',
+        'wo': 'où',
+        'wann': 'quand',
+        'was': 'quoi',
+        'kaufen': 'acheter',
+        'rückgabe': 'retour',
+        'zahlung': 'paiement',
+        'karte': 'carte',
+        'schweiz': 'suisse',
+        'international': 'international',
+        'kostenlos': 'gratuit'
+    },
+    'it': {
+        'tempo di consegna': 'délai de livraison',
+        'consegna': 'livraison',
+        'spedizione': 'livraison expédition',
+        'prezzo': 'prix',
+        'ordine': 'commande',
+        'bracciale': 'bracelet',
+        'bracciali': 'bracelets',
+        'collana': 'collier',
+        'collane': 'colliers',
+        'anello': 'bague',
+        'anelli': 'bagues',
+        'orecchini': 'boucles oreilles',
+        'gioielli': 'bijoux',
+        'fatto a mano': 'fait main',
+        'artigianale': 'artisanal',
+        'quanto': 'combien',
+        'come': 'comment',
+        'dove': 'où',
+        'quando': 'quand',
+        'cosa': 'quoi',
+        'comprare': 'acheter',
+        'reso': 'retour',
+        'pagamento': 'paiement',
+        'carta': 'carte',
+        'svizzera': 'suisse',
+        'internazionale': 'international',
+        'gratuito': 'gratuit'
+    }
+}
+
+
+def translate_to_french_for_rag(text, source_lang):
+    """Translate common e-commerce terms to French for better RAG matching"""
+    if source_lang not in RAG_QUERY_TRANSLATIONS:
+        return text
+
+    translated = text.lower()
+    for source_term, french_term in RAG_QUERY_TRANSLATIONS[source_lang].items():
+        translated = translated.replace(source_term, french_term)
+
+    # Also keep original text for combined search
+    return f"{translated} {text}"
+
+# ==================== DYNAMIC RAG ====================
+def tokenize(text):
+    text = text.lower()
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return [w for w in text.split() if len(w) > 2]
+
+def split_passages(text, size=None, overlap=None):
+    """Split text into overlapping [start, end) character spans, cut at paragraph/sentence/word boundaries"""
+    size = size or RAG_PASSAGE_SIZE
+    overlap = RAG_PASSAGE_OVERLAP if overlap is None else overlap
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            # Break as late as possible in the second half of the window
+            for separator in ('\n', '. ', ' '):
+                cut = text.rfind(separator, start + size // 2, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        spans.append((start, end))
+        if end >= len(text):
+            break
+        # Step back by `overlap` characters, starting the next passage on a word boundary
+        space = text.find(' ', max(end - overlap, start + 1), end)
+        start = space + 1 if space != -1 else end
+    return spans
+
+class RAGIndex:
+    """One generation of the RAG index: documents, their passages, postings and BM25 statistics.
+    
+    Documents are split into overlapping passages addressed by (document, start, end) offsets
+    into the document content; passages are what gets indexed and ranked.
+    A generation is filled once, then published by DynamicRAG and never mutated again,
+    so readers holding a reference always see a complete, consistent snapshot.
+    """
+    def __init__(self, generation=0):
+        self.generation = generation
+        self.documents = []
+        self.doc_passages = []  # Per document: (first passage id, passage count)
+        self.passages = []  # Per passage: (document index, start, end)
+        self.passage_terms = []  # Term counts per passage, reused when the document is carried over
+        self.index = defaultdict(list)  # word -> [(passage_id, term frequency)]
+        self.passage_lengths = []
+        self.passage_norms = []  # BM25 length normalization, one per passage
+        self.idf = {}
+        self.avg_passage_length = 0.0
+    
+    def add_document(self, doc, passages=None):
+        """Add one document; pass `passages` [(start, end, terms)] to reuse a previous split. Call finalize() when done"""
+        if passages is None:
+            # Title words count as extra occurrences in every passage of the document
+            title_words = tokenize(doc['title']) if doc.get('title') else []
+            passages = [
+                (start, end, Counter(tokenize(doc['content'][start:end]) + title_words))
+                for start, end in split_passages(doc['content'])
+            ]
+        
+        doc_index = len(self.documents)
+        self.documents.append(doc)
+        self.doc_passages.append((len(self.passages), len(passages)))
+        for start, end, terms in passages:
+            passage_id = len(self.passages)
+            self.passages.append((doc_index, start, end))
+            self.passage_terms.append(terms)
+            for word, tf in terms.items():
+                self.index[word].append((passage_id, tf))
+            self.passage_lengths.append(sum(terms.values()))
+    
+    def add_documents(self, docs):
+        """Add documents to the index"""
+        for doc in docs:
+            self.add_document(doc)
+        self.finalize()
+    
+    def finalize(self):
+        self._compute_stats()
+    
+    def csr_scorer(self):
+        """The CSRScorer for this generation, built on first use (generations never change afterwards)"""
+        scorer = getattr(self, '_csr_scorer', None)
+        if scorer is None:
+            scorer = self._csr_scorer = CSRScorer(self)
+        return scorer
+    
+    def document_passages(self, doc_index):
+        """The [(start, end, terms)] of a document, in the form add_document() accepts"""
+        first, count = self.doc_passages[doc_index]
+        return [
+            (start, end, self.passage_terms[passage_id])
+            for passage_id, (_, start, end) in enumerate(self.passages[first:first + count], first)
+        ]
+    
+    def passage(self, passage_id):
+        """The passage as a document dict: parent fields, the passage text as content, and its offset"""
+        doc_index, start, end = self.passages[passage_id]
+        doc = self.documents[doc_index]
+        return dict(doc, content=doc['content'][start:end], offset=start)
+    
+    def save(self, path, last_update=None):
+        """Write the generation to a compact binary snapshot (atomic replace).
+        
+        Layout: magic, u16 version, u32 header length, JSON header, then the sections listed in
+        the header: zlib-compressed documents and vocabulary, and raw uint32/uint16 arrays for
+        postings offsets, passage ids, term frequencies, passage lengths and passage addresses.
+        """
+        vocabulary = list(self.index)
+        offsets, passage_ids, tfs = array('I', [0]), array('I'), array('H')
+        for word in vocabulary:
+            for passage_id, tf in self.index[word]:
+                passage_ids.append(passage_id)
+                tfs.append(min(tf, 0xFFFF))
+            offsets.append(len(passage_ids))
+        
+        sections = [
+            ('documents', zlib.compress(json.dumps(self.documents, ensure_ascii=False).encode('utf-8'))),
+            ('vocabulary', zlib.compress('\n'.join(vocabulary).encode('utf-8'))),
+            ('offsets', offsets.tobytes()),
+            ('passage_ids', passage_ids.tobytes()),
+            ('tfs', tfs.tobytes()),
+            ('passage_lengths', array('I', self.passage_lengths).tobytes()),
+            ('passage_docs', array('I', [p[0] for p in self.passages]).tobytes()),
+            ('passage_starts', array('I', [p[1] for p in self.passages]).tobytes()),
+            ('passage_ends', array('I', [p[2] for p in self.passages]).tobytes()),
+        ]
+        header = json.dumps({
+            'generation': self.generation,
+            'last_update': last_update.isoformat() if last_update else None,
+            'byteorder': sys.byteorder,
+            'sections': [[name, len(data)] for name, data in sections]
+        }).encode('utf-8')
+        
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(RAG_SNAPSHOT_MAGIC + struct.pack('<HI', RAG_SNAPSHOT_VERSION, len(header)) + header)
+            for _, data in sections:
+                f.write(data)
+        os.replace(tmp_path, path)
+    
+    @classmethod
+    def load(cls, path):
+        """Load a snapshot written by save(). Returns (index, last_update) or None if missing/incompatible"""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        
+        prefix_len = len(RAG_SNAPSHOT_MAGIC) + 6
+        if data[:len(RAG_SNAPSHOT_MAGIC)] != RAG_SNAPSHOT_MAGIC:
+            return None
+        version, header_len = struct.unpack('<HI', data[len(RAG_SNAPSHOT_MAGIC):prefix_len])
+        if version != RAG_SNAPSHOT_VERSION:
+            print(f"DEBUG RAG: Ignoring snapshot version {version} (expected {RAG_SNAPSHOT_VERSION})")
+            return None
+        header = json.loads(data[prefix_len:prefix_len + header_len])
+        
+        view = memoryview(data)
+        position = prefix_len + header_len
+        sections = {}
+        for name, length in header['sections']:
+            sections[name] = view[position:position + length]
+            position += length
+        
+        def read_array(typecode, name):
+            values = array(typecode)
+            values.frombytes(sections[name])
+            if header['byteorder'] != sys.byteorder:
+                values.byteswap()
+            return values
+        
+        index = cls(header['generation'])
+        index.documents = json.loads(zlib.decompress(sections['documents']))
+        vocabulary = zlib.decompress(sections['vocabulary']).decode('utf-8').split('\n') if index.documents else []
+        offsets, passage_ids, tfs = read_array('I', 'offsets'), read_array('I', 'passage_ids'), read_array('H', 'tfs')
+        index.passage_lengths = list(read_array('I', 'passage_lengths'))
+        index.passages = list(zip(read_array('I', 'passage_docs'), read_array('I', 'passage_starts'), read_array('I', 'passage_ends')))
+        
+        # Passages of a document are contiguous
+        passage_counts = Counter(doc_index for doc_index, _, _ in index.passages)
+        first = 0
+        for doc_index in range(len(index.documents)):
+            index.doc_passages.append((first, passage_counts[doc_index]))
+            first += passage_counts[doc_index]
+        
+        index.passage_terms = [Counter() for _ in index.passages]
+        for word_id, word in enumerate(vocabulary):
+            postings = list(zip(passage_ids[offsets[word_id]:offsets[word_id + 1]], tfs[offsets[word_id]:offsets[word_id + 1]]))
+            index.index[word] = postings
+            for passage_id, tf in postings:
+                index.passage_terms[passage_id][word] = tf
+        index.finalize()
+        
+        last_update = datetime.fromisoformat(header['last_update']) if header['last_update'] else None
+        return index, last_update
+    
+    def _compute_stats(self):
+        """Precompute IDF and per-passage BM25 norms so queries only touch their postings"""
+        total_passages = len(self.passages)
+        if not total_passages:
+            return
+        
+        self.avg_passage_length = sum(self.passage_lengths) / total_passages or 1.0
+        self.passage_norms = [
+            RAG_BM25_K1 * (1 - RAG_BM25_B + RAG_BM25_B * length / self.avg_passage_length)
+            for length in self.passage_lengths
+        ]
+        self.idf = {
+            word: math.log(1 + (total_passages - len(postings) + 0.5) / (len(postings) + 0.5))
+            for word, postings in self.index.items()
+        }
+    
+    def score(self, query_words):
+        """BM25 scores for the given query words: {passage_id: score}"""
+        scores = defaultdict(float)
+        
+        # BM25: idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+        k1_plus_1 = RAG_BM25_K1 + 1
+        for word in query_words:
+            postings = self.index.get(word)
+            if not postings:
+                continue
+            idf = self.idf[word]
+            for passage_id, tf in postings:
+                scores[passage_id] += idf * tf * k1_plus_1 / (tf + self.passage_norms[passage_id])
+        return scores
+
+def content_hash(doc):
+    """Stable hash of what gets indexed for a document, used to skip unchanged content"""
+    return hashlib.sha1(f"{doc.get('title', '')}\n{doc['content']}".encode('utf-8')).hexdigest()
+
+class JSONFileStore:
+    """A dict persisted as a JSON file (atomic replace on save)"""
+    label = 'state'
+    
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.load()
+    
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            print(f"DEBUG RAG: Could not load {self.label}: {e}")
+            self.entries = {}
+    
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"DEBUG RAG: Could not save {self.label}: {e}")
+
+class CrawlStateStore(JSONFileStore):
+    """Per-URL crawl state (ETag, Last-Modified, content hash, outgoing links)"""
+    label = 'crawl state'
+    
+    def get(self, url):
+        return self.entries.get(url, {})
+    
+    def set(self, url, entry):
+        self.entries[url] = entry
+    
+    def remove(self, url):
+        self.entries.pop(url, None)
+
+class ShopifyCatalogStore(JSONFileStore):
+    """Local copy of the Shopify catalog: {'products': {id: product}, 'synced_at': ..., 'full_synced_at': ...}"""
+    label = 'Shopify catalog'
+    
+    @property
+    def products(self):
+        return self.entries.setdefault('products', {})
+
+class CSRScorer:
+    """Sparse-matrix BM25 engine over one RAGIndex generation.
+    
+    The full BM25 weight of every (term, passage) pair is precomputed into a term x passage CSR
+    matrix, so scoring a query is a sparse row-vector product and a batch of queries is one
+    sparse matrix product. Top-k selection uses argpartition instead of sorting all candidates.
+    """
+    BATCH_SIZE = 256  # Queries scored per dense (queries x passages) block
+    
+    def __init__(self, index):
+        self.index = index
+        self.vocabulary = {word: term_id for term_id, word in enumerate(index.index)}
+        passage_count = len(index.passages)
+        norms = np.asarray(index.passage_norms, dtype=np.float64) if passage_count else np.zeros(0)
+        
+        indptr = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        indices, tfs, idfs = [], [], []
+        for term_id, (word, postings) in enumerate(index.index.items()):
+            indptr[term_id + 1] = indptr[term_id] + len(postings)
+            for passage_id, tf in postings:
+                indices.append(passage_id)
+                tfs.append(tf)
+            idfs.append(np.full(len(postings), index.idf.get(word, 0.0)))
+        
+        indices = np.asarray(indices, dtype=np.int64)
+        tfs = np.asarray(tfs, dtype=np.float64)
+        idfs = np.concatenate(idfs) if idfs else np.zeros(0)
+        weights = idfs * tfs * (RAG_BM25_K1 + 1) / (tfs + norms[indices]) if len(indices) else np.zeros(0)
+        self.matrix = sparse.csr_matrix((weights, indices, indptr), shape=(len(self.vocabulary), passage_count))
+        
+        docs = [index.documents[doc_index] for doc_index, _, _ in index.passages]
+        self.is_shopify = np.array([doc.get('source') == 'shopify' for doc in docs], dtype=bool)
+        self.is_faq = np.array([doc.get('category') == 'faq' or doc.get('source') == 'faq' for doc in docs], dtype=bool)
+    
+    def score_batch(self, query_words_list, shopify_boosts, faq_boosts):
+        """Dense (queries x passages) score matrix for a list of query word sets and their boosts"""
+        indptr, columns = [0], []
+        for query_words in query_words_list:
+            columns.extend(self.vocabulary[word] for word in query_words if word in self.vocabulary)
+            indptr.append(len(columns))
+        queries = sparse.csr_matrix(
+            (np.ones(len(columns)), np.asarray(columns, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(query_words_list), len(self.vocabulary))
+        )
+        scores = (queries @ self.matrix).toarray()
+        scores *= np.where(self.is_shopify, np.asarray(shopify_boosts)[:, None], 1.0)
+        scores *= np.where(self.is_faq, np.asarray(faq_boosts)[:, None], 1.0)
+        return scores
+    
+    def top_k(self, scores, k):
+        """[(passage_id, score)] of the k best positive scores in a 1-D score row, best first"""
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(int(passage_id), float(scores[passage_id])) for passage_id in candidates]
+    
+    def search_batch(self, query_words_list, top_k, shopify_boosts, faq_boosts):
+        """Ranked [(passage, score)] lists for many queries, scored BATCH_SIZE queries at a time"""
+        results = []
+        for first in range(0, len(query_words_list), self.BATCH_SIZE):
+            block = slice(first, first + self.BATCH_SIZE)
+            scores = self.score_batch(query_words_list[block], shopify_boosts[block], faq_boosts[block])
+            for row in scores:
+                results.append(limit_passages_per_document(
+                    lambda n, row=row: self.top_k(row, n), top_k, self.index.passage
+                ))
+        return results
+
+def limit_passages_per_document(fetch, top_k, resolve=None):
+    """The best top_k (passage, score) pairs, at most RAG_MAX_PASSAGES_PER_DOC per document.
+    
+    fetch(n) returns the n best (candidate, score) pairs, best first; resolve() turns a candidate
+    into its passage (default: candidates are passages). The pool starts at top_k * the cap and is
+    fetched again, larger, while a few long documents crowd out everything else: fewer than top_k
+    survive the cap but there are more candidates. A cap of 0 or less means no cap.
+    """
+    if top_k <= 0:
+        return []
+    cap = RAG_MAX_PASSAGES_PER_DOC if RAG_MAX_PASSAGES_PER_DOC > 0 else None
+    pool = top_k * cap if cap else top_k
+    while True:
+        ranked = fetch(pool)
+        per_document = defaultdict(int)
+        results = []
+        for candidate, score in ranked:
+            passage = resolve(candidate) if resolve else candidate
+            if cap and per_document[passage['id']] >= cap:
+                continue
+            per_document[passage['id']] += 1
+            results.append((passage, score))
+            if len(results) >= top_k:
+                return results
+        if len(ranked) < pool or not cap:
+            return results  # Every candidate seen (without a cap, the first top_k are the answer)
+        pool *= 4
+
+class MemoryIndexBackend:
+    """Default RAG backend: RAGIndex generations in process memory, persisted as a snapshot"""
+    name = 'memory'
+    is_shared = False
+    
+    def __init__(self, snapshot_path=RAG_SNAPSHOT_PATH, scoring=RAG_SCORING):
+        self.snapshot_path = snapshot_path
+        self.current = RAGIndex()  # Published generation, replaced atomically by apply_changes()
+        self.last_update = None
+        self.use_csr = scoring == 'csr' and np is not None
+        if scoring == 'csr' and np is None:
+            print("DEBUG RAG: RAG_SCORING=csr needs numpy and scipy, using postings scoring")
+    
+    @property
+    def documents(self):
+        return self.current.documents
+    
+    @property
+    def generation(self):
+        return self.current.generation
+    
+    def document_count(self):
+        return len(self.current.documents)
+    
+    def apply_changes(self, upserts=(), removals=()):
+        """Publish a new generation that adds/replaces `upserts` and drops the ids in `removals`.
+        
+        Documents are matched on their 'id'. Carried-over documents keep their passages and
+        term counts, so only the upserted documents are split and tokenized.
+        """
+        current = self.current
+        dropped = set(removals) | {doc['id'] for doc in upserts}
+        new_index = RAGIndex(current.generation + 1)
+        for doc_index, doc in enumerate(current.documents):
+            if doc.get('id') not in dropped:
+                new_index.add_document(doc, current.document_passages(doc_index))
+        for doc in upserts:
+            new_index.add_document(doc)
+        new_index.finalize()
+        self.current = new_index
+    
+    def search(self, query_words, top_k, shopify_boost=1.0, faq_boost=1.0):
+        """Return [(passage, score)] for the best top_k passages"""
+        # Read the published generation once; a concurrent update cannot change it under us
+        index = self.current
+        if self.use_csr:
+            return index.csr_scorer().search_batch([query_words], top_k, [shopify_boost], [faq_boost])[0]
+        
+        scores = index.score(query_words)
+        
+        if shopify_boost != 1.0 or faq_boost != 1.0:
+            for passage_id in scores:
+                doc = index.documents[index.passages[passage_id][0]]
+                if doc.get('source') == 'shopify':
+                    scores[passage_id] *= shopify_boost
+                if doc.get('category') == 'faq' or doc.get('source') == 'faq':
+                    scores[passage_id] *= faq_boost
+        
+        return limit_passages_per_document(
+            lambda n: heapq.nlargest(n, scores.items(), key=lambda x: x[1]), top_k, index.passage
+        )
+    
+    def search_batch(self, query_words_list, top_k, shopify_boosts, faq_boosts):
+        """search() for many queries at once: one sparse matrix product when numpy/scipy are available"""
+        if np is not None:
+            return self.current.csr_scorer().search_batch(list(query_words_list), top_k, list(shopify_boosts), list(faq_boosts))
+        return [
+            self.search(query_words, top_k, shopify_boost, faq_boost)
+            for query_words, shopify_boost, faq_boost in zip(query_words_list, shopify_boosts, faq_boosts)
+        ]
+    
+    def mark_updated(self, when):
+        self.last_update = when
+        try:
+            started = time.monotonic()
+            self.current.save(self.snapshot_path, when)
+            print(f"DEBUG RAG: Snapshot saved (generation {self.generation}) in {(time.monotonic() - started) * 1000:.0f}ms")
+        except Exception as e:
+            print(f"DEBUG RAG: Could not save snapshot: {e}")
+    
+    def restore(self):
+        """Publish the on-disk snapshot, if any, so searches work before the first refresh"""
+        try:
+            started = time.monotonic()
+            loaded = RAGIndex.load(self.snapshot_path)
+            if not loaded:
+                return False
+            self.current, self.last_update = loaded
+            print(f"DEBUG RAG: Snapshot loaded (generation {self.generation}, {self.document_count()} documents) "
+                  f"in {(time.monotonic() - started) * 1000:.0f}ms")
+            return True
+        except Exception as e:
+            print(f"DEBUG RAG: Could not load snapshot: {e}")
+            return False
+
+class SQLiteStore:
+    """Base for the stores kept in a SQLite file shared by all workers: WAL mode, one connection per thread"""
     
-    country_data = get_country_from_ip(ip)
-    if country_data['code'] in BLOCKED_COUNTRIES:
-        # Track blocked attempts
-        today = datetime.now().strftime('%Y-%m-%d')
-        analytics['blocked_ips'][f"{today}_{country_data['code']}"] += 1
-        return True
-    return False
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection().execute('PRAGMA journal_mode=WAL')
+    
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads: one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
 
-def track_visitor(ip, session_id):
-    """Track visitor for analytics"""
-    today = datetime.now().strftime('%Y-%m-%d')
-    month = datetime.now().strftime('%Y-%m')
+class SQLiteFTSBackend(SQLiteStore):
+    """RAG backend storing document passages in a SQLite FTS5 table ranked with bm25().
     
-    # Get country
-    country_data = get_country_from_ip(ip)
-    country_name = country_data['name']
+    The database is shared by all gunicorn workers: one builder (holding RAG_BUILDER_LOCK_PATH)
+    writes each refresh in a single transaction, and every worker reads concurrently in WAL mode.
+    """
+    name = 'sqlite'
+    is_shared = True
+    META_TTL = 5  # Seconds to cache generation/last_update between reads
+    SCHEMA_VERSION = 2  # Stored in PRAGMA user_version; older databases are rebuilt
     
-    # Track daily
-    analytics['daily'][today]['visitors'].add(ip)
-    analytics['daily'][today]['messages'] += 1
+    def __init__(self, path=RAG_SQLITE_PATH):
+        super().__init__(path)
+        self._meta = None
+        self._meta_read_at = 0
+        conn = self._connection()
+        with conn:
+            if conn.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                for table in ('documents_fts', 'passages_fts', 'passages', 'documents', 'meta'):
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.execute("""CREATE TABLE IF NOT EXISTS documents (
+                rowid INTEGER PRIMARY KEY, doc_id TEXT UNIQUE, source TEXT, category TEXT, hash TEXT, data TEXT)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS passages (
+                rowid INTEGER PRIMARY KEY, doc_rowid INTEGER, start INTEGER, end INTEGER)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS passages_doc ON passages (doc_rowid)")
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS passages_fts USING fts5(title, content)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
     
-    # Track monthly
-    analytics['monthly'][month]['visitors'].add(ip)
-    analytics['monthly'][month]['messages'] += 1
+    def refresh_meta(self):
+        """Forget the cached generation/last_update so the next read sees other workers' writes"""
+        self._meta = None
     
-    # Track by country (total)
-    analytics['countries'][country_name]['visitors'].add(ip)
-    analytics['countries'][country_name]['messages'] += 1
+    def _read_meta(self):
+        if self._meta is None or time.monotonic() - self._meta_read_at > self.META_TTL:
+            rows = self._connection().execute("SELECT key, value FROM meta").fetchall()
+            self._meta = dict(rows)
+            self._meta_read_at = time.monotonic()
+        return self._meta
     
-    # Track by country (daily)
-    analytics['daily_countries'][today][country_name]['visitors'].add(ip)
-    analytics['daily_countries'][today][country_name]['messages'] += 1
+    @property
+    def documents(self):
+        rows = self._connection().execute("SELECT data FROM documents ORDER BY rowid").fetchall()
+        return [json.loads(data) for (data,) in rows]
     
-    # Track total
-    analytics['total_visitors'].add(ip)
-    analytics['total_messages'] += 1
-
-def track_new_session(ip):
-    """Track new session"""
-    today = datetime.now().strftime('%Y-%m-%d')
-    month = datetime.now().strftime('%Y-%m')
+    @property
+    def generation(self):
+        return int(self._read_meta().get('generation', 0))
     
-    analytics['daily'][today]['sessions'] += 1
-    analytics['monthly'][month]['sessions'] += 1
-    analytics['total_sessions'] += 1
-
-def track_csat(rating, session_id, ip):
-    """Track CSAT rating"""
-    today = datetime.now().strftime('%Y-%m-%d')
-    country_data = get_country_from_ip(ip)
+    @property
+    def last_update(self):
+        value = self._read_meta().get('last_update')
+        return datetime.fromisoformat(value) if value else None
     
-    rating_str = str(rating)
+    def document_count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
     
-    # Store detailed rating
-    analytics['csat']['ratings'].append({
-        'timestamp': datetime.now().isoformat(),
-        'rating': rating,
-        'session_id': session_id,
-        'country': country_data['name'],
-        'date': today
-    })
+    def apply_changes(self, upserts=(), removals=()):
+        """Add/replace `upserts` and drop the ids in `removals` in one transaction (readers see all or nothing)"""
+        conn = self._connection()
+        with conn:
+            for doc_id in list(removals) + [doc['id'] for doc in upserts]:
+                row = conn.execute("SELECT rowid FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+                if row:
+                    conn.execute("DELETE FROM passages_fts WHERE rowid IN (SELECT rowid FROM passages WHERE doc_rowid = ?)", row)
+                    conn.execute("DELETE FROM passages WHERE doc_rowid = ?", row)
+                    conn.execute("DELETE FROM documents WHERE rowid = ?", row)
+            for doc in upserts:
+                cursor = conn.execute(
+                    "INSERT INTO documents (doc_id, source, category, hash, data) VALUES (?, ?, ?, ?, ?)",
+                    (doc['id'], doc.get('source', ''), doc.get('category', ''), doc.get('hash'),
+                     json.dumps(doc, ensure_ascii=False))
+                )
+                doc_rowid = cursor.lastrowid
+                for start, end in split_passages(doc['content']):
+                    cursor = conn.execute("INSERT INTO passages (doc_rowid, start, end) VALUES (?, ?, ?)", (doc_rowid, start, end))
+                    conn.execute("INSERT INTO passages_fts (rowid, title, content) VALUES (?, ?, ?)",
+                                 (cursor.lastrowid, doc.get('title', ''), doc['content'][start:end]))
+            conn.execute("""INSERT INTO meta (key, value) VALUES ('generation', '1')
+                ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1""")
+        self.refresh_meta()
+    
+    def search(self, query_words, top_k, shopify_boost=1.0, faq_boost=1.0):
+        """Return [(passage, score)] for the best top_k passages"""
+        if not query_words:
+            return []
+        match = ' OR '.join(f'"{word}"' for word in query_words)
+        return limit_passages_per_document(lambda n: self._ranked(match, n, shopify_boost, faq_boost), top_k)
+    
+    def _ranked(self, match, limit, shopify_boost, faq_boost):
+        """The `limit` best matching passages as [(passage, score)], best first"""
+        # bm25() is negative (lower is better), so multiplying by a boost > 1 ranks a passage higher
+        rows = self._connection().execute("""
+            SELECT p.doc_rowid, d.data, p.start, p.end, bm25(passages_fts, 2.0, 1.0)
+                * (CASE WHEN d.source = 'shopify' THEN ? ELSE 1.0 END)
+                * (CASE WHEN d.source = 'faq' OR d.category = 'faq' THEN ? ELSE 1.0 END) AS rank
+            FROM passages_fts
+            JOIN passages p ON p.rowid = passages_fts.rowid
+            JOIN documents d ON d.rowid = p.doc_rowid
+            WHERE passages_fts MATCH ?
+            ORDER BY rank LIMIT ?""", (shopify_boost, faq_boost, match, limit)).fetchall()
+        
+        docs = {}
+        ranked = []
+        for doc_rowid, data, start, end, rank in rows:
+            if doc_rowid not in docs:
+                docs[doc_rowid] = json.loads(data)
+            doc = docs[doc_rowid]
+            ranked.append((dict(doc, content=doc['content'][start:end], offset=start), -rank))
+        return ranked
+    
+    def search_batch(self, query_words_list, top_k, shopify_boosts, faq_boosts):
+        return [
+            self.search(query_words, top_k, shopify_boost, faq_boost)
+            for query_words, shopify_boost, faq_boost in zip(query_words_list, shopify_boosts, faq_boosts)
+        ]
     
-    # Update daily counts
-    if rating_str in analytics['csat']['daily'][today]:
-        analytics['csat']['daily'][today][rating_str] += 1
+    def mark_updated(self, when):
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_update', ?)", (when.isoformat(),))
+        self.refresh_meta()
     
-    # Update total counts
-    if rating_str in analytics['csat']['total']:
-        analytics['csat']['total'][rating_str] += 1
+    def restore(self):
+        # The database is already on disk; nothing to load
+        return self.document_count() > 0
 
-# ==================== LANGUAGE DETECTION & TRANSLATION ====================
-def detect_language(text):
-    """Detect language of the text"""
-    text_lower = text.lower()
-    
-    # Spanish indicators
-    es_words = ['hola', 'gracias', 'por favor', 'qué', 'cuál', 'cómo', 'dónde', 'cuándo', 'tiempo', 'entrega', 
-                'pedido', 'envío', 'precio', 'quiero', 'puedo', 'necesito', 'tengo', 'está', 'son', 'tienen',
-                'buenas', 'buenos', 'días', 'tardes', 'noches', 'el', 'la', 'los', 'las', 'de', 'del']
-    es_count = sum(1 for w in es_words if w in text_lower)
-    
-    # English indicators
-    en_words = ['hello', 'hi', 'thanks', 'please', 'what', 'which', 'how', 'where', 'when', 'delivery', 
-                'order', 'shipping', 'price', 'want', 'can', 'need', 'have', 'is', 'are', 'the', 'a', 'an',
-                'good', 'morning', 'afternoon', 'evening', 'my', 'your', 'do', 'does']
-    en_count = sum(1 for w in en_words if w in text_lower)
-    
-    # German indicators
-    de_words = ['hallo', 'danke', 'bitte', 'was', 'wie', 'wo', 'wann', 'lieferung', 'bestellung', 'versand',
-                'preis', 'ich', 'möchte', 'kann', 'brauche', 'habe', 'ist', 'sind', 'der', 'die', 'das',
-                'guten', 'morgen', 'tag', 'abend', 'mein', 'ihr']
-    de_count = sum(1 for w in de_words if w in text_lower)
-    
-    # Italian indicators
-    it_words = ['ciao', 'grazie', 'per favore', 'cosa', 'quale', 'come', 'dove', 'quando', 'consegna',
-                'ordine', 'spedizione', 'prezzo', 'voglio', 'posso', 'ho bisogno', 'ho', 'è', 'sono',
-                'buongiorno', 'buonasera', 'il', 'la', 'i', 'le', 'di', 'del']
-    it_count = sum(1 for w in it_words if w in text_lower)
-    
-    # Arabic indicators (transliterated common words)
-    ar_indicators = ['مرحبا', 'شكرا', 'من فضلك', 'ماذا', 'كيف', 'أين', 'متى', 'التسليم', 'الطلب']
-    ar_count = sum(1 for w in ar_indicators if w in text)
-    
-    # Find highest score
-    scores = {'es': es_count, 'en': en_count, 'de': de_count, 'it': it_count, 'ar': ar_count}
-    max_lang = max(scores, key=scores.get)
-    max_score = scores[max_lang]
-    
-    # Return detected language if score > 1, else default to French
-    if max_score > 1:
-        return max_lang
-    return 'fr'
+def create_rag_backend():
+    if RAG_BACKEND == 'sqlite':
+        try:
+            return SQLiteFTSBackend()
+        except (sqlite3.Error, OSError) as e:
+            print(f"DEBUG RAG: SQLite FTS5 backend unavailable ({e}), using in-memory index")
+    return MemoryIndexBackend()
 
-def translate_to_french_for_rag(text, source_lang):
-    """Translate common e-commerce terms to French for better RAG matching"""
-    translations = {
-        'es': {
-            'tiempo de entrega': 'délai de livraison',
-            'entrega': 'livraison',
-            'envío': 'livraison expédition',
-            'envio': 'livraison expédition',
-            'precio': 'prix',
-            'pedido': 'commande',
-            'pulsera': 'bracelet',
-            'pulseras': 'bracelets',
-            'collar': 'collier',
-            'collares': 'colliers',
-            'anillo': 'bague',
-            'anillos': 'bagues',
-            'pendientes': 'boucles oreilles',
-            'aretes': 'boucles oreilles',
-            'joyería': 'bijoux',
-            'artesanal': 'artisanal',
-            'hecho a mano': 'fait main',
-            'cuánto': 'combien',
-            'cómo': 'comment',
-            'dónde': 'où',
-            'cuándo': 'quand',
-            'qué': 'quoi',
-            'comprar': 'acheter',
-            'devolver': 'retourner',
-            'devolución': 'retour',
-            'pago': 'paiement',
-            'tarjeta': 'carte',
-            'suiza': 'suisse',
-            'españa': 'espagne europe international',
-            'spain': 'espagne europe international',
-            'mexico': 'mexique international',
-            'méxico': 'mexique international',
-            'estados unidos': 'usa international',
-            'francia': 'france europe',
-            'alemania': 'allemagne europe',
-            'italia': 'italie europe',
-            'internacional': 'international',
-            'gratis': 'gratuit',
-            'gratuito': 'gratuit',
-            'hacen': 'font faire',
-            'entregas': 'livraisons livraison'
-        },
-        'en': {
-            'delivery time': 'délai de livraison',
-            'delivery': 'livraison',
-            'shipping': 'livraison expédition',
-            'price': 'prix',
-            'order': 'commande',
-            'bracelet': 'bracelet',
-            'bracelets': 'bracelets',
-            'necklace': 'collier',
-            'necklaces': 'colliers',
-            'ring': 'bague',
-            'rings': 'bagues',
-            'earrings': 'boucles oreilles',
-            'jewelry': 'bijoux',
-            'handmade': 'fait main',
-            'artisan': 'artisanal',
-            'how much': 'combien',
-            'how': 'comment',
-            'where': 'où',
-            'when': 'quand',
-            'what': 'quoi',
-            'buy': 'acheter',
-            'return': 'retour',
-            'payment': 'paiement',
-            'card': 'carte',
-            'switzerland': 'suisse',
-            'international': 'international',
-            'free': 'gratuit'
-        },
-        'de': {
-            'lieferzeit': 'délai de livraison',
-            'lieferung': 'livraison',
-            'versand': 'livraison expédition',
-            'preis': 'prix',
-            'bestellung': 'commande',
-            'armband': 'bracelet',
-            'armbänder': 'bracelets',
-            'halskette': 'collier',
-            'kette': 'collier',
-            'ring': 'bague',
-            'ohrringe': 'boucles oreilles',
-            'schmuck': 'bijoux',
-            'handgemacht': 'fait main',
-            'wie viel': 'combien',
-            'wie': 'comment',
-            'wo': 'où',
-            'wann': 'quand',
-            'was': 'quoi',
-            'kaufen': 'acheter',
-            'rückgabe': 'retour',
-            'zahlung': 'paiement',
-            'karte': 'carte',
-            'schweiz': 'suisse',
-            'international': 'international',
-            'kostenlos': 'gratuit'
-        },
-        'it': {
-            'tempo di consegna': 'délai de livraison',
-            'consegna': 'livraison',
-            'spedizione': 'livraison expédition',
-            'prezzo': 'prix',
-            'ordine': 'commande',
-            'bracciale': 'bracelet',
-            'bracciali': 'bracelets',
-            'collana': 'collier',
-            'collane': 'colliers',
-            'anello': 'bague',
-            'anelli': 'bagues',
-            'orecchini': 'boucles oreilles',
-            'gioielli': 'bijoux',
-            'fatto a mano': 'fait main',
-            'artigianale': 'artisanal',
-            'quanto': 'combien',
-            'come': 'comment',
-            'dove': 'où',
-            'quando': 'quand',
-            'cosa': 'quoi',
-            'comprare': 'acheter',
-            'reso': 'retour',
-            'pagamento': 'paiement',
-            'carta': 'carte',
-            'svizzera': 'suisse',
-            'internazionale': 'international',
-            'gratuito': 'gratuit'
-        }
-    }
-    
-    if source_lang not in translations:
-        return text
+# ==================== HTML EXTRACTION ====================
+HTML_DROPPED_TAGS = ('script', 'style', 'nav', 'header', 'footer')
+HTML_DROPPED_RE = re.compile(r'<(script|style|nav|footer|header)\b[^>]*>.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+HTML_TITLE_RE = re.compile(r'<title[^>]*>([^<]+)</title>', re.IGNORECASE)
+HTML_HREF_RE = re.compile(r'href=["\']([^"\']+)["\']')
+# Common Shopify navigation text, as (literal start, pattern): a pattern only runs if its start occurs in the page
+HTML_NOISE_PATTERNS = [
+    (start.lower(), re.compile(start + rest, re.IGNORECASE | re.DOTALL)) for start, rest in [
+        ('Ignorer et passer au contenu', ''),
+        ('Livraison gratuite', r'.*?CHF \d+'),
+        ('Pays/région', r'.*?Langue'),
+        ('Rechercher', r'.*?Connexion'),
+        ('Article ajouté au panier', ''),
+        ('Procéder au paiement', ''),
+        ('Continuer les achats', ''),
+        ('©', r' \d{4}.*?Shopify'),
+        ('Moyens de paiement', r'.*?Visa'),
+    ]
+]
+
+if lxml is not None:
+    HTML_PARSER = etree.HTMLParser(remove_comments=True, remove_pis=True, no_network=True, encoding='utf-8')
+    HTML_HREF_XPATH = etree.XPath('//@href', smart_strings=False)
+
+def strip_page_noise(text):
+    """Remove theme boilerplate (skip link, cart drawer, payment icons...) from extracted page text"""
+    lowered = text.lower()
+    for start, pattern in HTML_NOISE_PATTERNS:
+        if start in lowered:
+            text = pattern.sub('', text)
+    return text.strip()
+
+def clean_page_title(title):
+    """Page title without the " – Marakame" / " | Shop" suffix"""
+    if not title:
+        return ""
+    return title.split('–')[0].split('|')[0].strip()
+
+def parse_html_page(html):
+    """Parse a page once with lxml: returns (title, text, hrefs), or None if lxml is missing or can't parse it.
     
-    translated = text.lower()
-    for source_term, french_term in translations[source_lang].items():
-        translated = translated.replace(source_term, french_term)
+    Links are collected before the script/style/nav/header/footer subtrees are dropped from the
+    text: the site navigation is where the crawler finds most pages.
+    """
+    if lxml is None:
+        return None
+    try:
+        root = etree.fromstring(html.encode('utf-8'), HTML_PARSER)
+    except (ValueError, etree.LxmlError):
+        return None
+    if root is None:
+        return None  # Empty page
     
-    # Also keep original text for combined search
-    return f"{translated} {text}"
+    hrefs = HTML_HREF_XPATH(root)
+    title = clean_page_title(root.findtext('.//title'))
+    etree.strip_elements(root, *HTML_DROPPED_TAGS, with_tail=False)
+    text = ' '.join(' '.join(root.itertext()).split())
+    return title, strip_page_noise(text), hrefs
+
+# Essential information that must always be available: indexed for search and sent in the cached system prompt
+STATIC_FAQ = [
+    {
+        'id': 'faq:livraison',
+        'content': """DÉLAIS DE LIVRAISON - DELIVERY TIME - TIEMPO DE ENTREGA - LIEFERZEIT:
+
+SUISSE (Switzerland/Suiza/Schweiz):
+- Délai: 2 à 5 jours ouvrables
+- Frais: CHF 7.90 (GRATUIT dès CHF 80 d'achat)
+
+INTERNATIONAL (tous les autres pays du monde / all other countries / todos los demás países):
+France, Espagne, Allemagne, Italie, USA, Canada, Mexique, Royaume-Uni, Belgique, Pays-Bas, Autriche, Portugal, Japon, Chine, Australie, Brésil, Argentine, Colombie, Chili, et tous les autres pays...
+- Délai: 5 à 10 jours ouvrables
+- Frais de livraison internationale applicables
+
+IMPORTANT: 
+- Toutes les commandes sont expédiées sous 24-48h après validation du paiement
+- Nous livrons dans le monde entier / We ship worldwide / Enviamos a todo el mundo""",
+        'source': 'faq',
+        'url': 'https://marakame.ch/pages/faq'
+    },
+    {
+        'id': 'faq:paiement',
+        'content': """MÉTHODES DE PAIEMENT - PAYMENT METHODS - MÉTODOS DE PAGO:
+- Carte de crédit (Visa, Mastercard, American Express)
+- PayPal
+- TWINT (Suisse uniquement)
+- Virement bancaire
+Toutes les transactions sont sécurisées et cryptées.""",
+        'source': 'faq',
+        'url': 'https://marakame.ch/pages/faq'
+    },
+    {
+        'id': 'faq:retours',
+        'content': """RETOURS ET ÉCHANGES - RETURNS - DEVOLUCIONES:
+- Retour gratuit sous 14 jours
+- Article non porté, dans son emballage d'origine
+- Remboursement sous 5-7 jours ouvrables après réception
+- Pour initier un retour: info@marakame.ch""",
+        'source': 'faq',
+        'url': 'https://marakame.ch/pages/faq'
+    },
+    {
+        'id': 'faq:a-propos',
+        'content': """À PROPOS DE MARAKAME - ABOUT - SOBRE NOSOTROS:
+Marakame est une boutique suisse spécialisée dans les bijoux et accessoires artisanaux faits main.
+Nos bracelets sont créés par des artisans au Mexique, utilisant des techniques traditionnelles.
+Chaque pièce est unique et fabriquée avec amour et savoir-faire.""",
+        'source': 'faq',
+        'url': 'https://marakame.ch/pages/about'
+    },
+    {
+        'id': 'faq:contact',
+        'content': """CONTACT:
+- Email: info@marakame.ch
+- Site web: https://marakame.ch
+- Basé en Suisse
+Pour toute question sur une commande, fournir le numéro de commande ou l'email utilisé.""",
+        'source': 'faq',
+        'url': 'https://marakame.ch/pages/contact'
+    },
+    {
+        'id': 'faq:suivi',
+        'content': """SUIVI DE COMMANDE - ORDER TRACKING - SEGUIMIENTO:
+Une fois la commande expédiée, vous recevrez un email avec le numéro de suivi.
+Suivez votre colis via le lien dans l'email de confirmation d'expédition.""",
+        'source': 'faq',
+        'url': 'https://marakame.ch/pages/faq'
+    }
+]
 
-# ==================== DYNAMIC RAG ====================
 class DynamicRAG:
-    def __init__(self):
-        self.documents = []
-        self.index = defaultdict(list)
-        self.last_update = None
+    def __init__(self, backend=None):
+        self.backend = backend or create_rag_backend()
         self.update_interval = 3600  # 1 hour
         self.is_updating = False
+        self._update_lock = threading.Lock()
+        self.crawl_state = CrawlStateStore(os.path.join(RAG_DATA_DIR, 'crawl_state.json'))
+        self.shopify_catalog = ShopifyCatalogStore(SHOPIFY_CATALOG_PATH)
+        self.scrape_complete = {}  # source -> whether the last scrape saw everything (safe to prune)
+        self.query_cache = LRUCache(RAG_QUERY_CACHE_SIZE)  # Keys include the generation they were computed on
+    
+    @property
+    def documents(self):
+        return self.backend.documents
+    
+    @property
+    def generation(self):
+        return self.backend.generation
+    
+    @property
+    def last_update(self):
+        return self.backend.last_update
+    
+    def document_count(self):
+        return self.backend.document_count()
     
     def needs_update(self):
         if self.last_update is None:
             return True
         return (datetime.now() - self.last_update).total_seconds() > self.update_interval
     
-    def _tokenize(self, text):
-        text = text.lower()
-        text = re.sub(r'[^\w\s]', ' ', text)
-        return [w for w in text.split() if len(w) > 2]
-    
     def _extract_text_from_html(self, html):
-        """Extract clean text from HTML"""
-        # Remove script and style elements
-        html = re.sub(r'<script[^>]*>.*?</script>', '', html, flags=re.DOTALL | re.IGNORECASE)
-        html = re.sub(r'<style[^>]*>.*?</style>', '', html, flags=re.DOTALL | re.IGNORECASE)
-        html = re.sub(r'<nav[^>]*>.*?</nav>', '', html, flags=re.DOTALL | re.IGNORECASE)
-        html = re.sub(r'<footer[^>]*>.*?</footer>', '', html, flags=re.DOTALL | re.IGNORECASE)
-        html = re.sub(r'<header[^>]*>.*?</header>', '', html, flags=re.DOTALL | re.IGNORECASE)
-        # Remove HTML tags
-        text = re.sub(r'<[^>]+>', ' ', html)
-        # Clean up whitespace
-        text = re.sub(r'\s+', ' ', text)
-        # Remove common navigation text
-        noise_patterns = [
-            r'Ignorer et passer au contenu',
-            r'Livraison gratuite.*?CHF \d+',
-            r'Pays/région.*?Langue',
-            r'Rechercher.*?Connexion',
-            r'Article ajouté au panier',
-            r'Procéder au paiement',
-            r'Continuer les achats',
-            r'© \d{4}.*?Shopify',
-            r'Moyens de paiement.*?Visa',
-        ]
-        for pattern in noise_patterns:
-            text = re.sub(pattern, '', text, flags=re.IGNORECASE | re.DOTALL)
-        return text.strip()
+        """Extract clean text from HTML with regexes (fallback when lxml is unavailable)"""
+        text = HTML_TAG_RE.sub(' ', HTML_DROPPED_RE.sub('', html))
+        return strip_page_noise(' '.join(text.split()))
     
     def _get_page_title(self, html):
         """Extract page title"""
-        match = re.search(r'<title[^>]*>([^<]+)</title>', html, re.IGNORECASE)
-        if match:
-            title = match.group(1).split('–')[0].split('|')[0].strip()
-            return title
-        return ""
+        match = HTML_TITLE_RE.search(html)
+        return clean_page_title(match.group(1)) if match else ""
+    
+    def _normalize_crawl_url(self, url):
+        """Return the canonical URL to crawl, or None if it should be skipped"""
+        parsed = urlparse(url)
+        if parsed.netloc and 'marakame.ch' not in parsed.netloc:
+            return None
+        url = url.split('?')[0].split('#')[0]
+        
+        # Skip certain URLs
+        skip_patterns = ['/account', '/cart', '/checkout', '/cdn/', '.jpg', '.png', '.gif', '.css', '.js']
+        if any(p in url.lower() for p in skip_patterns):
+            return None
+        return url
+    
+    def _fetch_page(self, client, url, host_slots, deadline, validators):
+        """Fetch one page (runs in a crawler worker thread), conditionally if we have validators.
+        
+        Returns {'status': ...} with 'html', 'etag' and 'last_modified' for a 200, or None on error.
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        
+        try:
+            with host_slots[urlparse(url).netloc]:
+                response = client.get(url, headers=headers, timeout=min(CRAWL_REQUEST_TIMEOUT, remaining))
+            if response.status_code != 200:
+                return {'status': response.status_code}
+            return {
+                'status': 200,
+                'html': response.text,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            }
+        except Exception as e:
+            print(f"DEBUG RAG: Error scraping {url}: {e}")
+            return None
+    
+    def _build_page_document(self, url, html):
+        """Turn a fetched page into a RAG document (or None) plus the links found on it"""
+        parsed = parse_html_page(html)
+        if parsed:
+            title, content, hrefs = parsed
+        else:
+            title = self._get_page_title(html)
+            content = self._extract_text_from_html(html)
+            hrefs = HTML_HREF_RE.findall(html)
+        
+        doc = None
+        if len(content) > 100:  # Only add pages with substantial content
+            # Determine category
+            category = 'general'
+            if '/faq' in url:
+                category = 'faq'
+            elif '/collections/' in url or '/products/' in url:
+                category = 'produits'
+            elif '/histoire' in url:
+                category = 'histoire'
+            elif '/policies/' in url:
+                category = 'politique'
+            
+            doc = {
+                'id': url,
+                'content': content,  # Split into passages at indexing time
+                'url': url,
+                'title': title,
+                'category': category,
+                'source': 'website'
+            }
+            print(f"DEBUG RAG: Scraped {url} ({len(content)} chars)")
+        
+        # Find more links
+        links = []
+        for link in hrefs:
+            full_url = urljoin(url, link)
+            if 'marakame.ch' in full_url:
+                links.append(full_url)
+        return doc, links
     
     def scrape_website(self):
-        """Scrape all pages from marakame.ch"""
+        """Crawl marakame.ch concurrently.
+        
+        Up to CRAWL_CONCURRENCY fetches run in parallel over one keep-alive connection pool,
+        with at most CRAWL_PER_HOST_CONCURRENCY in flight per host. The crawl stops when
+        CRAWL_MAX_PAGES URLs have been fetched or CRAWL_TIME_BUDGET seconds have elapsed.
+        
+        Pages are fetched conditionally (ETag / Last-Modified from the crawl state); a 304 or an
+        identical content hash reuses the already indexed document instead of re-parsing it.
+        """
         print("DEBUG RAG: Starting website scrape...")
+        started = time.monotonic()
+        deadline = started + CRAWL_TIME_BUDGET
         documents = []
         visited = set()
-        to_visit = [WEBSITE_URL]
+        to_visit = deque([WEBSITE_URL])
+        previous_docs = {doc['id']: doc for doc in self.documents if doc.get('source') == 'website'}
+        stats = defaultdict(int)
         
         # Key pages to definitely scrape
         key_pages = [
@@ -443,337 +2214,532 @@ class DynamicRAG:
         headers = {
             'User-Agent': 'Mozilla/5.0 (compatible; TaiyariBot/1.0; +https://marakame.ch)'
         }
+        limits = httpx.Limits(max_connections=CRAWL_CONCURRENCY, max_keepalive_connections=CRAWL_CONCURRENCY)
+        host_slots = defaultdict(lambda: threading.BoundedSemaphore(CRAWL_PER_HOST_CONCURRENCY))
+        client = httpx.Client(headers=headers, limits=limits, follow_redirects=True)
+        executor = ThreadPoolExecutor(max_workers=CRAWL_CONCURRENCY, thread_name_prefix='crawler')
+        pending = {}  # future -> url
         
-        while to_visit and len(visited) < 50:  # Limit to 50 pages
-            url = to_visit.pop(0)
-            
-            # Normalize URL
-            parsed = urlparse(url)
-            if parsed.netloc and 'marakame.ch' not in parsed.netloc:
-                continue
-            url = url.split('?')[0].split('#')[0]
-            
-            if url in visited:
-                continue
-            
-            # Skip certain URLs
-            skip_patterns = ['/account', '/cart', '/checkout', '/cdn/', '.jpg', '.png', '.gif', '.css', '.js']
-            if any(p in url.lower() for p in skip_patterns):
-                continue
-            
-            visited.add(url)
-            
-            try:
-                response = requests.get(url, headers=headers, timeout=10)
-                if response.status_code != 200:
-                    continue
+        try:
+            while (to_visit or pending) and time.monotonic() < deadline:
+                # Keep the pool busy with not-yet-visited URLs
+                while to_visit and len(pending) < CRAWL_CONCURRENCY and len(visited) < CRAWL_MAX_PAGES:
+                    url = self._normalize_crawl_url(to_visit.popleft())
+                    if not url or url in visited:
+                        continue
+                    # Create the host slot here: defaultdict is not safe to populate from workers
+                    host_slots[urlparse(url).netloc]
+                    visited.add(url)
+                    state = self.crawl_state.get(url)
+                    # A 304 is only useful if we still hold the page's document (or know it had none)
+                    validators = state if url in previous_docs or state.get('hash') is None else {}
+                    future = executor.submit(self._fetch_page, client, url, host_slots, deadline, validators)
+                    pending[future] = url
                 
-                html = response.text
-                title = self._get_page_title(html)
-                content = self._extract_text_from_html(html)
+                if not pending:
+                    break
                 
-                if len(content) > 100:  # Only add pages with substantial content
-                    # Determine category
-                    category = 'general'
-                    if '/faq' in url:
-                        category = 'faq'
-                    elif '/collections/' in url or '/products/' in url:
-                        category = 'produits'
-                    elif '/histoire' in url:
-                        category = 'histoire'
-                    elif '/policies/' in url:
-                        category = 'politique'
+                done, _ = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = pending.pop(future)
+                    result = future.result()
+                    state = self.crawl_state.get(url)
                     
-                    documents.append({
-                        'content': content[:3000],  # Limit content size
-                        'url': url,
-                        'title': title,
-                        'category': category,
-                        'source': 'website'
-                    })
-                    print(f"DEBUG RAG: Scraped {url} ({len(content)} chars)")
-                
-                # Find more links
-                links = re.findall(r'href=["\']([^"\']+)["\']', html)
-                for link in links:
-                    full_url = urljoin(url, link)
-                    if 'marakame.ch' in full_url and full_url not in visited:
-                        to_visit.append(full_url)
-                
-            except Exception as e:
-                print(f"DEBUG RAG: Error scraping {url}: {e}")
+                    if result is None or result['status'] not in (200, 304, 404, 410):
+                        # Transient failure: keep what we had
+                        doc, links = previous_docs.get(url), state.get('links', [])
+                        stats['failed'] += 1
+                    elif result['status'] == 304:
+                        doc, links = previous_docs.get(url), state.get('links', [])
+                        stats['not_modified'] += 1
+                    elif result['status'] in (404, 410):
+                        self.crawl_state.remove(url)
+                        continue
+                    else:
+                        doc, links = self._build_page_document(url, result['html'])
+                        page_hash = content_hash(doc) if doc else None
+                        if doc and url in previous_docs and previous_docs[url].get('hash') == page_hash:
+                            doc = previous_docs[url]
+                            stats['unchanged'] += 1
+                        elif doc:
+                            doc['hash'] = page_hash
+                            stats['changed'] += 1
+                        self.crawl_state.set(url, {
+                            'etag': result['etag'],
+                            'last_modified': result['last_modified'],
+                            'hash': page_hash,
+                            'links': links
+                        })
+                    
+                    if doc:
+                        documents.append(doc)
+                    to_visit.extend(link for link in links if link not in visited)
+            
+            self.scrape_complete['website'] = not pending and (not to_visit or len(visited) >= CRAWL_MAX_PAGES)
+            if pending:
+                print(f"DEBUG RAG: Crawl time budget exhausted, dropping {len(pending)} in-flight pages")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            client.close()
         
-        print(f"DEBUG RAG: Website scrape complete. {len(documents)} pages scraped.")
+        elapsed = time.monotonic() - started
+        print(f"DEBUG RAG: Website scrape complete. {len(documents)} pages kept ({len(visited)} fetched in {elapsed:.1f}s: "
+              f"{stats['changed']} new/changed, {stats['unchanged']} same content, {stats['not_modified']} not modified, {stats['failed']} failed).")
         return documents
     
-    def scrape_shopify_products(self):
-        """Scrape products from Shopify"""
-        print("DEBUG RAG: Starting Shopify scrape...")
-        documents = []
+    def _fetch_shopify_products(self, headers, params):
+        """Yield every product matching params, following the Link header's cursor pagination"""
+        url = f'https://{SHOPIFY_SHOP_URL}/admin/api/2024-01/products.json'
+        params = dict(params, limit=250)
+        retries = 0
+        while url:
+            response = requests.get(url, headers=headers, params=params, timeout=15)
+            if response.status_code == 429 and retries < 3:
+                # Rate limited: wait as instructed, then retry the same page
+                retries += 1
+                time.sleep(float(response.headers.get('Retry-After', 2)))
+                continue
+            if response.status_code != 200:
+                raise RuntimeError(f"Shopify API error: {response.status_code}")
+            retries = 0
+            yield from response.json().get('products', [])
+            # The next-page URL already carries the cursor and the original parameters
+            url = response.links.get('next', {}).get('url')
+            params = None
+    
+    def _sync_shopify_catalog(self, headers):
+        """Bring the local catalog up to date. Returns how many products were downloaded"""
+        catalog = self.shopify_catalog
+        products = catalog.products
+        sync_started = datetime.now(timezone.utc)
+        full_synced_at = catalog.entries.get('full_synced_at')
         
-        token = get_shopify_token()
-        if not token:
-            print("DEBUG RAG: No Shopify token available")
-            return documents
+        needs_full_sync = (
+            not products or not catalog.entries.get('synced_at') or not full_synced_at
+            or (sync_started - datetime.fromisoformat(full_synced_at)).total_seconds() > SHOPIFY_FULL_SYNC_INTERVAL
+        )
+        if needs_full_sync:
+            fetched = {str(p['id']): p for p in self._fetch_shopify_products(headers, {'fields': SHOPIFY_PRODUCT_FIELDS})}
+            products.clear()
+            products.update(fetched)
+            catalog.entries['full_synced_at'] = sync_started.isoformat()
+            downloaded = len(fetched)
+        else:
+            # Only products changed since the last sync (with some overlap for clock skew)
+            since = datetime.fromisoformat(catalog.entries['synced_at']) - timedelta(minutes=5)
+            changed = list(self._fetch_shopify_products(
+                headers, {'fields': SHOPIFY_PRODUCT_FIELDS, 'updated_at_min': since.isoformat()}
+            ))
+            for product in changed:
+                products[str(product['id'])] = product
+            # updated_at_min does not report deletions: prune against the (cheap) list of live ids
+            live_ids = {str(p['id']) for p in self._fetch_shopify_products(headers, {'fields': 'id'})}
+            for product_id in list(products):
+                if product_id not in live_ids:
+                    del products[product_id]
+            downloaded = len(changed)
         
-        headers = {
-            'X-Shopify-Access-Token': token,
-            'Content-Type': 'application/json'
-        }
+        catalog.entries['synced_at'] = sync_started.isoformat()
+        catalog.save()
+        return downloaded
+    
+    def _product_to_document(self, product):
+        title = product.get('title', '')
+        description = product.get('body_html') or ''
+        # Clean HTML from description
+        description = re.sub(r'<[^>]+>', ' ', description)
+        description = re.sub(r'\s+', ' ', description).strip()
         
-        try:
-            # Get all products
-            url = f'https://{SHOPIFY_SHOP_URL}/admin/api/2024-01/products.json?limit=250'
-            response = requests.get(url, headers=headers, timeout=15)
-            
-            if response.status_code == 200:
-                products = response.json().get('products', [])
-                print(f"DEBUG RAG: Found {len(products)} Shopify products")
-                
-                for product in products:
-                    title = product.get('title', '')
-                    description = product.get('body_html', '')
-                    # Clean HTML from description
-                    description = re.sub(r'<[^>]+>', ' ', description)
-                    description = re.sub(r'\s+', ' ', description).strip()
-                    
-                    product_type = product.get('product_type', '')
-                    vendor = product.get('vendor', '')
-                    tags = ', '.join(product.get('tags', []))
-                    
-                    # Get price from first variant
-                    variants = product.get('variants', [])
-                    price = variants[0].get('price', '') if variants else ''
-                    
-                    # Get product URL
-                    handle = product.get('handle', '')
-                    product_url = f"https://marakame.ch/products/{handle}"
-                    
-                    content = f"""Produit: {title}
+        product_type = product.get('product_type', '')
+        # The REST API returns tags as one comma-separated string
+        tags = product.get('tags', '')
+        if isinstance(tags, list):
+            tags = ', '.join(tags)
+        
+        # Get price from first variant
+        variants = product.get('variants', [])
+        price = variants[0].get('price', '') if variants else ''
+        
+        # Get product URL
+        handle = product.get('handle', '')
+        product_url = f"https://marakame.ch/products/{handle}"
+        
+        content = f"""Produit: {title}
 Description: {description}
 Type: {product_type}
 Prix: {price} CHF
 Tags: {tags}
 Disponible sur: {product_url}"""
-                    
-                    documents.append({
-                        'content': content,
-                        'url': product_url,
-                        'title': title,
-                        'category': 'produit',
-                        'source': 'shopify',
-                        'price': price
-                    })
-            else:
-                print(f"DEBUG RAG: Shopify API error: {response.status_code}")
         
-        except Exception as e:
-            print(f"DEBUG RAG: Shopify scrape error: {e}")
+        return {
+            'id': f"shopify:{product.get('id') or handle}",
+            'content': content,
+            'url': product_url,
+            'title': title,
+            'category': 'produit',
+            'source': 'shopify',
+            'price': price
+        }
+    
+    def scrape_shopify_products(self, offline=False):
+        """Sync products from Shopify into the local catalog and return them as documents.
+        
+        The catalog is paginated with the Link header, refreshed incrementally with updated_at_min
+        and fully re-synced every SHOPIFY_FULL_SYNC_INTERVAL. With offline=True, or when Shopify
+        is unreachable, documents are rebuilt from the local catalog alone.
+        """
+        print("DEBUG RAG: Starting Shopify scrape...")
+        self.scrape_complete['shopify'] = False
+        
+        token = None if offline else get_shopify_token()
+        if token:
+            headers = {
+                'X-Shopify-Access-Token': token,
+                'Content-Type': 'application/json'
+            }
+            try:
+                downloaded = self._sync_shopify_catalog(headers)
+                self.scrape_complete['shopify'] = True
+                print(f"DEBUG RAG: Shopify sync downloaded {downloaded} products")
+            except Exception as e:
+                print(f"DEBUG RAG: Shopify scrape error: {e}")
+        elif not offline:
+            print("DEBUG RAG: No Shopify token available")
+        
+        products = self.shopify_catalog.products
+        if products and not self.scrape_complete['shopify']:
+            # The cached catalog is the last complete view of the shop
+            print("DEBUG RAG: Using the local Shopify catalog cache")
+            self.scrape_complete['shopify'] = True
         
+        documents = [self._product_to_document(product) for product in products.values()]
         print(f"DEBUG RAG: Shopify scrape complete. {len(documents)} products.")
         return documents
     
-    def add_documents(self, docs):
-        """Add documents to the index"""
-        for doc in docs:
-            doc_id = len(self.documents)
-            self.documents.append(doc)
-            
-            # Index by words
-            words = self._tokenize(doc['content'])
-            for word in set(words):
-                self.index[word].append(doc_id)
-            
-            # Index by title words
-            if doc.get('title'):
-                for word in self._tokenize(doc['title']):
-                    self.index[word].append(doc_id)
-    
-    def update(self):
-        """Update the RAG with fresh data"""
-        if self.is_updating:
+    def apply_changes(self, upserts=(), removals=()):
+        """Add/replace documents (matched on 'id') and remove ids, publishing them atomically"""
+        self.backend.apply_changes(upserts, removals)
+        # Entries for older generations can never be hit again; free them now
+        self.query_cache.clear()
+    
+    def restore(self):
+        """Make previously built data searchable right away (snapshot or shared database)"""
+        return self.backend.restore()
+    
+    def upsert_documents(self, docs):
+        """Add new documents or replace existing ones with the same id"""
+        return self.apply_changes(upserts=docs)
+    
+    def remove_documents(self, doc_ids):
+        """Remove documents by id"""
+        return self.apply_changes(removals=doc_ids)
+    
+    def _acquire_builder_lock(self):
+        """With a shared backend only one worker builds; returns the lock file or None if another holds it"""
+        os.makedirs(RAG_DATA_DIR, exist_ok=True)
+        lock_file = open(RAG_BUILDER_LOCK_PATH, 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except OSError:
+            lock_file.close()
+            return None
+    
+    def update(self, force=False):
+        """Update the RAG with fresh data, re-indexing only documents whose content changed"""
+        if not self._update_lock.acquire(blocking=False):
             print("DEBUG RAG: Update already in progress")
             return
         
+        builder_lock = None
+        if self.backend.is_shared:
+            builder_lock = self._acquire_builder_lock()
+            if builder_lock is None:
+                print("DEBUG RAG: Another worker is building the shared index")
+                self._update_lock.release()
+                return
+            # Another worker may have just finished a build
+            self.backend.refresh_meta()
+            self.crawl_state.load()
+            self.shopify_catalog.load()
+            if not force and not self.needs_update():
+                builder_lock.close()
+                self._update_lock.release()
+                return
+        
         self.is_updating = True
-        print("DEBUG RAG: Starting full RAG update...")
+        print(f"DEBUG RAG: Starting RAG update ({self.backend.name} backend)...")
         
         try:
-            # Clear existing data
-            self.documents = []
-            self.index = defaultdict(list)
-            
-            # Add static FAQ first (most important info)
-            static_faq = self.get_static_faq()
-            self.add_documents(static_faq)
+            # Collect everything off to the side: searches keep using the current generation
+            # Static FAQ first (most important info)
+            docs = self.get_static_faq()
             
             # Scrape website
-            website_docs = self.scrape_website()
-            self.add_documents(website_docs)
+            docs += self.scrape_website()
             
             # Scrape Shopify
-            shopify_docs = self.scrape_shopify_products()
-            self.add_documents(shopify_docs)
+            docs += self.scrape_shopify_products()
+            
+            for doc in docs:
+                doc.setdefault('hash', content_hash(doc))
             
-            self.last_update = datetime.now()
-            print(f"DEBUG RAG: Update complete. Total documents: {len(self.documents)}")
+            # Diff against the published documents
+            current_docs = {doc.get('id'): doc for doc in self.documents}
+            upserts = [doc for doc in docs if current_docs.get(doc['id'], {}).get('hash') != doc['hash']]
+            seen = {doc['id'] for doc in docs}
+            complete_sources = {'faq'} | {source for source, complete in self.scrape_complete.items() if complete}
+            removals = [
+                doc_id for doc_id, doc in current_docs.items()
+                if doc_id not in seen and doc.get('source') in complete_sources
+            ]
+            
+            if upserts or removals:
+                self.apply_changes(upserts, removals)
+            self.crawl_state.save()
+            self.backend.mark_updated(datetime.now())
+            print(f"DEBUG RAG: Update complete. {len(upserts)} changed, {len(removals)} removed, "
+                  f"{len(docs) - len(upserts)} unchanged. Generation {self.generation}, total documents: {self.document_count()}")
         
         except Exception as e:
             print(f"DEBUG RAG: Update error: {e}")
         
         finally:
             self.is_updating = False
+            if builder_lock:
+                builder_lock.close()
+            self._update_lock.release()
     
     def get_static_faq(self):
         """Static FAQ with essential information that must always be available"""
-        return [
-            {
-                'content': """DÉLAIS DE LIVRAISON - DELIVERY TIME - TIEMPO DE ENTREGA - LIEFERZEIT:
-
-SUISSE (Switzerland/Suiza/Schweiz):
-- Délai: 2 à 5 jours ouvrables
-- Frais: CHF 7.90 (GRATUIT dès CHF 80 d'achat)
-
-INTERNATIONAL (tous les autres pays du monde / all other countries / todos los demás países):
-France, Espagne, Allemagne, Italie, USA, Canada, Mexique, Royaume-Uni, Belgique, Pays-Bas, Autriche, Portugal, Japon, Chine, Australie, Brésil, Argentine, Colombie, Chili, et tous les autres pays...
-- Délai: 5 à 10 jours ouvrables
-- Frais de livraison internationale applicables
-
-IMPORTANT: 
-- Toutes les commandes sont expédiées sous 24-48h après validation du paiement
-- Nous livrons dans le monde entier / We ship worldwide / Enviamos a todo el mundo""",
-                'source': 'faq',
-                'url': 'https://marakame.ch/pages/faq'
-            },
-            {
-                'content': """MÉTHODES DE PAIEMENT - PAYMENT METHODS - MÉTODOS DE PAGO:
-- Carte de crédit (Visa, Mastercard, American Express)
-- PayPal
-- TWINT (Suisse uniquement)
-- Virement bancaire
-Toutes les transactions sont sécurisées et cryptées.""",
-                'source': 'faq',
-                'url': 'https://marakame.ch/pages/faq'
-            },
-            {
-                'content': """RETOURS ET ÉCHANGES - RETURNS - DEVOLUCIONES:
-- Retour gratuit sous 14 jours
-- Article non porté, dans son emballage d'origine
-- Remboursement sous 5-7 jours ouvrables après réception
-- Pour initier un retour: info@marakame.ch""",
-                'source': 'faq',
-                'url': 'https://marakame.ch/pages/faq'
-            },
-            {
-                'content': """À PROPOS DE MARAKAME - ABOUT - SOBRE NOSOTROS:
-Marakame est une boutique suisse spécialisée dans les bijoux et accessoires artisanaux faits main.
-Nos bracelets sont créés par des artisans au Mexique, utilisant des techniques traditionnelles.
-Chaque pièce est unique et fabriquée avec amour et savoir-faire.""",
-                'source': 'faq',
-                'url': 'https://marakame.ch/pages/about'
-            },
-            {
-                'content': """CONTACT:
-- Email: info@marakame.ch
-- Site web: https://marakame.ch
-- Basé en Suisse
-Pour toute question sur une commande, fournir le numéro de commande ou l'email utilisé.""",
-                'source': 'faq',
-                'url': 'https://marakame.ch/pages/contact'
-            },
-            {
-                'content': """SUIVI DE COMMANDE - ORDER TRACKING - SEGUIMIENTO:
-Une fois la commande expédiée, vous recevrez un email avec le numéro de suivi.
-Suivez votre colis via le lien dans l'email de confirmation d'expédition.""",
-                'source': 'faq',
-                'url': 'https://marakame.ch/pages/faq'
-            }
-        ]
+        return [dict(doc) for doc in STATIC_FAQ]  # Copies: the update pipeline adds a hash to each
     
     def search(self, query, top_k=5):
         """Search the RAG"""
         # Check if update needed
-        if self.needs_update():
+        if self.needs_update() and not self.is_updating:
             # Run update in background
             threading.Thread(target=self.update).start()
             # If no documents yet, wait a bit for initial load
-            if not self.documents:
+            if not self.document_count():
                 time.sleep(2)
         
-        if not self.documents:
-            return []
+        query_words, boost_products, boost_faq = self._parse_query(query)
         
-        query_words = self._tokenize(query)
-        scores = defaultdict(float)
+        # Ranking only depends on the distinct query words, the boosts, top_k and the index generation
+        cache_key = (tuple(sorted(query_words)), boost_products, boost_faq, top_k, self.generation)
+        cached = self.query_cache.get(cache_key)
+        if cached is not None:
+            return cached
         
-        for word in query_words:
-            if word in self.index:
-                for doc_id in self.index[word]:
-                    scores[doc_id] += 1
+        ranked = self.backend.search(
+            query_words, top_k,
+            shopify_boost=RAG_SHOPIFY_BOOST if boost_products else 1.0,
+            faq_boost=RAG_FAQ_BOOST if boost_faq else 1.0
+        )
+        results = self._format_results(ranked)
+        self.query_cache.set(cache_key, results)
+        return results
+    
+    def search_batch(self, queries, top_k=5):
+        """Search many queries in one call (offline evaluation, cache warm-up).
         
+        Queries not already cached are scored together (a single sparse matrix product with the
+        in-memory backend when numpy/scipy are installed), and their results are cached.
+        """
+        generation = self.generation
+        results = [None] * len(queries)
+        pending = []  # (position, cache key, query words, boosts)
+        for position, query in enumerate(queries):
+            query_words, boost_products, boost_faq = self._parse_query(query)
+            cache_key = (tuple(sorted(query_words)), boost_products, boost_faq, top_k, generation)
+            results[position] = self.query_cache.get(cache_key)
+            if results[position] is None:
+                pending.append((position, cache_key, query_words, boost_products, boost_faq))
+        
+        if pending:
+            ranked_lists = self.backend.search_batch(
+                [query_words for _, _, query_words, _, _ in pending], top_k,
+                [RAG_SHOPIFY_BOOST if boost_products else 1.0 for _, _, _, boost_products, _ in pending],
+                [RAG_FAQ_BOOST if boost_faq else 1.0 for _, _, _, _, boost_faq in pending]
+            )
+            for (position, cache_key, _, _, _), ranked in zip(pending, ranked_lists):
+                results[position] = self._format_results(ranked)
+                self.query_cache.set(cache_key, results[position])
+        return results
+    
+    def _parse_query(self, query):
+        """Distinct query words plus whether the product / FAQ boosts apply"""
         # Boost scores for certain categories based on query
         query_lower = query.lower()
-        for doc_id, score in list(scores.items()):
-            doc = self.documents[doc_id]
-            # Boost product results for product-related queries
-            if any(w in query_lower for w in ['prix', 'price', 'coût', 'combien', 'acheter', 'buy']):
-                if doc.get('source') == 'shopify':
-                    scores[doc_id] *= 1.5
-            # Boost FAQ for question words
-            if any(w in query_lower for w in ['comment', 'pourquoi', 'quand', 'how', 'why', 'when']):
-                if doc.get('category') == 'faq':
-                    scores[doc_id] *= 1.3
-        
-        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        boost_products = any(w in query_lower for w in RAG_PRODUCT_QUERY_WORDS)
+        boost_faq = any(w in query_lower for w in RAG_QUESTION_WORDS)
+        return set(tokenize(query)), boost_products, boost_faq
+    
+    def _format_results(self, ranked):
         results = []
         
-        for doc_id, score in ranked[:top_k]:
-            doc = self.documents[doc_id]
+        for doc, score in ranked:
             results.append({
                 'content': doc['content'],
                 'url': doc.get('url', ''),
                 'title': doc.get('title', ''),
                 'category': doc.get('category', ''),
                 'source': doc.get('source', ''),
+                'offset': doc.get('offset', 0),
                 'score': score
             })
         
         return results
 
-# Initialize RAG
-rag = DynamicRAG()
+# Initialize RAG
+rag = DynamicRAG()
+
+# ==================== SESSION STORAGE ====================
+class MemorySessionStore:
+    """Sessions in this worker's memory, evicted after SESSION_TTL idle seconds or beyond SESSION_MAX_COUNT"""
+    name = 'memory'
+    
+    def __init__(self, ttl=SESSION_TTL, max_count=SESSION_MAX_COUNT):
+        self.ttl = ttl
+        self.max_count = max_count
+        self._sessions = OrderedDict()  # session_id -> (session, touched_at), least recently used first
+        self._lock = threading.Lock()
+        self.evictions = 0
+    
+    def _prune(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._sessions:
+            _, touched_at = next(iter(self._sessions.values()))
+            if touched_at >= cutoff and len(self._sessions) <= self.max_count:
+                break
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+    
+    def get(self, session_id):
+        with self._lock:
+            self._prune()
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            self._sessions[session_id] = (entry[0], time.monotonic())
+            self._sessions.move_to_end(session_id)
+            return entry[0]
+    
+    def save(self, session):
+        with self._lock:
+            self._sessions[session['id']] = (session, time.monotonic())
+            self._sessions.move_to_end(session['id'])
+            self._prune()
+    
+    def stats(self):
+        return {'backend': self.name, 'sessions': len(self._sessions), 'evictions': self.evictions}
+
+class SQLiteSessionStore(SQLiteStore):
+    """Sessions in a SQLite database shared by all workers, so a conversation survives hitting another worker.
+    
+    get() returns a copy: callers save() it back after changing it (last write wins).
+    """
+    name = 'sqlite'
+    DATETIME_FIELDS = ('session_start', 'last_activity')
+    PRUNE_INTERVAL = 60  # Seconds between expiry/cap sweeps
+    
+    def __init__(self, path=SESSION_SQLITE_PATH, ttl=SESSION_TTL, max_count=SESSION_MAX_COUNT):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_count = max_count
+        self._pruned_at = 0
+        self.evictions = 0
+        conn = self._connection()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT, touched_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_touched ON sessions (touched_at)")
+    
+    def get(self, session_id):
+        row = self._connection().execute(
+            "SELECT data FROM sessions WHERE id = ? AND touched_at >= ?", (session_id, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        session = json.loads(row[0])
+        for field in self.DATETIME_FIELDS:
+            session[field] = datetime.fromisoformat(session[field])
+        return session
+    
+    def save(self, session):
+        data = dict(session)
+        for field in self.DATETIME_FIELDS:
+            data[field] = data[field].isoformat()
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT INTO sessions (id, data, touched_at) VALUES (?, ?, ?) "
+                         "ON CONFLICT(id) DO UPDATE SET data = excluded.data, touched_at = excluded.touched_at",
+                         (session['id'], json.dumps(data, ensure_ascii=False), time.time()))
+        if time.monotonic() - self._pruned_at > self.PRUNE_INTERVAL:
+            self._prune()
+    
+    def _prune(self):
+        self._pruned_at = time.monotonic()
+        conn = self._connection()
+        with conn:
+            expired = conn.execute("DELETE FROM sessions WHERE touched_at < ?", (time.time() - self.ttl,)).rowcount
+            over_cap = conn.execute("DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY touched_at DESC LIMIT -1 OFFSET ?)",
+                                    (self.max_count,)).rowcount
+        self.evictions += expired + over_cap
+    
+    def stats(self):
+        count = self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        return {'backend': self.name, 'sessions': count, 'evictions': self.evictions}
+
+def create_session_store():
+    if SESSION_BACKEND == 'sqlite':
+        try:
+            return SQLiteSessionStore()
+        except (OSError, sqlite3.Error) as e:
+            print(f"DEBUG: SQLite session store unavailable ({e}), keeping sessions in memory")
+    return MemorySessionStore()
 
-# ==================== SESSION STORAGE ====================
-sessions = {}
+session_store = create_session_store()
+
+def find_session(session_id):
+    """The session if it exists (and hasn't expired), else None"""
+    if not session_id:
+        return None
+    return session_store.get(session_id)
+
+def save_session(session_data):
+    """Persist changes to a session (needed for the shared store; cheap for the memory one)"""
+    session_store.save(session_data)
 
 def get_session(session_id):
-    if session_id not in sessions:
-        sessions[session_id] = {
+    session_data = session_store.get(session_id)
+    if session_data is None:
+        session_data = {
             'id': session_id,
             'started_at': datetime.now().isoformat(),
             'session_start': datetime.now(),
             'last_activity': datetime.now(),
             'messages': [],
             'message_count': 0,
+            'language': None,
             'visitor_email': None,
             'greeted': False,
             'warning_sent': False,
             'closed': False,
             'close_reason': None
         }
-    return sessions[session_id]
+        session_store.save(session_data)
+    return session_data
 
-def update_session_activity(session_id):
-    if session_id in sessions:
-        sessions[session_id]['last_activity'] = datetime.now()
-        sessions[session_id]['warning_sent'] = False
+def update_session_activity(session_data):
+    session_data['last_activity'] = datetime.now()
+    session_data['warning_sent'] = False
+    save_session(session_data)
 
-def check_session_limits(session_id):
+def check_session_limits(session_data):
     """Check if session has reached message or time limits"""
-    if session_id not in sessions:
+    if session_data is None:
         return None
-    
-    session_data = sessions[session_id]
+    session_id = session_data['id']
     
     if session_data['closed']:
         return {
@@ -786,7 +2752,8 @@ def check_session_limits(session_id):
     if session_data['message_count'] >= MAX_MESSAGES_PER_SESSION:
         session_data['closed'] = True
         session_data['close_reason'] = 'message_limit'
-        threading.Thread(target=send_conversation_copy, args=(session_id,)).start()
+        save_session(session_data)
+        send_conversation_copy(session_id)
         return {
             'limited': True,
             'reason': 'message_limit',
@@ -798,7 +2765,8 @@ def check_session_limits(session_id):
     if session_duration >= MAX_SESSION_DURATION:
         session_data['closed'] = True
         session_data['close_reason'] = 'time_limit'
-        threading.Thread(target=send_conversation_copy, args=(session_id,)).start()
+        save_session(session_data)
+        send_conversation_copy(session_id)
         return {
             'limited': True,
             'reason': 'time_limit',
@@ -818,10 +2786,10 @@ def check_session_limits(session_id):
     return {'limited': False, 'warning': warning}
 
 def check_session_timeout(session_id):
-    if session_id not in sessions:
+    session_data = find_session(session_id)
+    if session_data is None:
         return None
     
-    session_data = sessions[session_id]
     if session_data['closed']:
         return None
     
@@ -829,13 +2797,15 @@ def check_session_timeout(session_id):
     
     if elapsed >= TIMEOUT_CLOSE:
         session_data['closed'] = True
-        threading.Thread(target=send_conversation_copy, args=(session_id,)).start()
+        save_session(session_data)
+        send_conversation_copy(session_id)
         return {
             'type': 'closed',
             'message': "Il semble que vous ne soyez plus connecté. Je ferme cette conversation. Une copie a été envoyée à notre équipe. N'hésitez pas à revenir si vous avez d'autres questions ! 👋"
         }
     elif elapsed >= TIMEOUT_WARNING and not session_data['warning_sent']:
         session_data['warning_sent'] = True
+        save_session(session_data)
         return {
             'type': 'warning',
             'message': "Êtes-vous toujours là ? 🙂"
@@ -844,48 +2814,58 @@ def check_session_timeout(session_id):
     return None
 
 # ==================== EMAIL FUNCTIONS ====================
+def build_email(to_email, subject, body_html):
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = subject
+    msg['From'] = f"Marakame <{SMTP_FROM}>"
+    msg['To'] = to_email
+    msg.attach(MIMEText(body_html, 'html', 'utf-8'))
+    return msg
+
+def smtp_connect():
+    """Open an authenticated SMTP connection according to SMTP_SECURITY"""
+    if SMTP_SECURITY == 'ssl':
+        print(f"DEBUG EMAIL: Using SMTP_SSL on port {SMTP_PORT}...")
+        import ssl
+        context = ssl.create_default_context()
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=30, context=context)
+    else:
+        print(f"DEBUG EMAIL: Using SMTP ({SMTP_SECURITY}) on port {SMTP_PORT}...")
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        if SMTP_SECURITY == 'starttls':
+            server.starttls()
+    
+    if SMTP_PASSWORD:
+        print(f"DEBUG EMAIL: Connected! Logging in as {SMTP_USER}...")
+        server.login(SMTP_USER, SMTP_PASSWORD)
+        print("DEBUG EMAIL: Login OK!")
+    return server
+
+def smtp_configured():
+    if not SMTP_PASSWORD and SMTP_SECURITY != 'none':
+        print("DEBUG EMAIL: ERROR - SMTP_PASSWORD is not configured!")
+        return False
+    return True
+
 def send_email(to_email, subject, body_html):
-    """Send email via SMTP Namecheap - using SSL on port 465"""
+    """Send one email right away on its own connection (used by /test-email; everything else goes through email_outbox)"""
     print(f"DEBUG EMAIL: === Starting send_email ===")
     print(f"DEBUG EMAIL: To: {to_email}")
     print(f"DEBUG EMAIL: SMTP_HOST: {SMTP_HOST}")
     print(f"DEBUG EMAIL: SMTP_PORT: {SMTP_PORT}")
+    print(f"DEBUG EMAIL: SMTP_SECURITY: {SMTP_SECURITY}")
     print(f"DEBUG EMAIL: SMTP_USER: {SMTP_USER}")
     print(f"DEBUG EMAIL: SMTP_PASSWORD set: {bool(SMTP_PASSWORD)}")
     print(f"DEBUG EMAIL: SMTP_FROM: {SMTP_FROM}")
     
-    if not SMTP_PASSWORD:
-        print("DEBUG EMAIL: ERROR - SMTP_PASSWORD is not configured!")
+    if not smtp_configured():
         return False
     
     try:
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = subject
-        msg['From'] = f"Marakame <{SMTP_FROM}>"
-        msg['To'] = to_email
-        
-        html_part = MIMEText(body_html, 'html', 'utf-8')
-        msg.attach(html_part)
-        
-        # Try SSL first (port 465), then TLS (port 587)
-        port = int(SMTP_PORT)
-        
-        if port == 465:
-            print(f"DEBUG EMAIL: Using SMTP_SSL on port 465...")
-            import ssl
-            context = ssl.create_default_context()
-            server = smtplib.SMTP_SSL(SMTP_HOST, 465, timeout=30, context=context)
-        else:
-            print(f"DEBUG EMAIL: Using SMTP with STARTTLS on port {port}...")
-            server = smtplib.SMTP(SMTP_HOST, port, timeout=30)
-            server.starttls()
-        
-        print(f"DEBUG EMAIL: Connected! Logging in as {SMTP_USER}...")
-        server.login(SMTP_USER, SMTP_PASSWORD)
-        print("DEBUG EMAIL: Login OK!")
+        server = smtp_connect()
         
         print(f"DEBUG EMAIL: Sending email...")
-        server.sendmail(SMTP_FROM, to_email, msg.as_string())
+        server.sendmail(SMTP_FROM, to_email, build_email(to_email, subject, body_html).as_string())
         print("DEBUG EMAIL: Send OK!")
         
         server.quit()
@@ -908,6 +2888,171 @@ def send_email(to_email, subject, body_html):
         print(f"DEBUG EMAIL: GENERAL ERROR - {type(e).__name__}: {e}")
         return False
 
+class EmailOutbox(SQLiteStore):
+    """Durable queue of outgoing emails (SQLite), sent by one drainer over a reused SMTP connection.
+    
+    enqueue() only inserts a row, so request handlers never wait on SMTP. In each worker a
+    drainer thread competes for outbox.lock; the holder is the only sender across all workers,
+    keeps one authenticated connection open while there is mail to send, and retries failures
+    with exponential backoff (EMAIL_RETRY_DELAY doubled per attempt, up to EMAIL_MAX_ATTEMPTS).
+    """
+    POLL_INTERVAL = 5  # Seconds between looks at the queue when nothing wakes the drainer
+    BATCH_SIZE = 20
+    KEEP_SENT_DAYS = 7
+    
+    def __init__(self, path=EMAIL_OUTBOX_PATH):
+        super().__init__(path)
+        self.lock_path = path + '.lock'
+        self._wakeup = threading.Event()
+        self._server = None
+        self._server_used_at = 0
+        self._started = False
+        self.is_sender = False
+        conn = self._connection()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY, to_email TEXT, subject TEXT, body_html TEXT,
+                status TEXT DEFAULT 'pending', attempts INTEGER DEFAULT 0, next_attempt_at REAL,
+                last_error TEXT, created_at REAL, sent_at REAL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+    
+    def enqueue(self, to_email, subject, body_html):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT INTO outbox (to_email, subject, body_html, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                         (to_email, subject, body_html, now, now))
+        print(f"DEBUG EMAIL: Queued '{subject}' for {to_email}")
+        self._wakeup.set()
+    
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._drain_loop, name='email-outbox', daemon=True).start()
+    
+    # ---- Sending ----
+    def _drain_loop(self):
+        lock_file = open(self.lock_path, 'a')
+        while True:
+            if not self.is_sender:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.is_sender = True  # Held until this process exits
+                except BlockingIOError:
+                    time.sleep(self.POLL_INTERVAL * 6)
+                    continue
+            try:
+                if not self.drain():
+                    self._close_idle_connection()
+                    self._wakeup.wait(self.POLL_INTERVAL)
+                    self._wakeup.clear()
+            except Exception as e:
+                print(f"DEBUG EMAIL: Outbox error: {e}")
+                self._drop_connection()
+                time.sleep(self.POLL_INTERVAL)
+    
+    def drain(self):
+        """Send the emails that are due; returns how many were attempted"""
+        if not SMTP_PASSWORD and SMTP_SECURITY != 'none':
+            return 0  # Left queued until SMTP is configured
+        conn = self._connection()
+        rows = conn.execute("SELECT id, to_email, subject, body_html, attempts FROM outbox "
+                            "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                            (time.time(), self.BATCH_SIZE)).fetchall()
+        for email_id, to_email, subject, body_html, attempts in rows:
+            try:
+                self._send(to_email, build_email(to_email, subject, body_html).as_string())
+            except Exception as e:
+                attempts += 1
+                failed = attempts >= EMAIL_MAX_ATTEMPTS
+                delay = EMAIL_RETRY_DELAY * 2 ** (attempts - 1)
+                print(f"DEBUG EMAIL: Sending to {to_email} failed (attempt {attempts}): {type(e).__name__}: {e}"
+                      + (" - giving up" if failed else f" - retrying in {delay}s"))
+                with conn:
+                    conn.execute("UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                                 ('failed' if failed else 'pending', attempts, time.time() + delay, f"{type(e).__name__}: {e}", email_id))
+                self._drop_connection()
+                continue
+            print(f"DEBUG EMAIL: === SUCCESS - Email sent to {to_email} ===")
+            with conn:
+                conn.execute("UPDATE outbox SET status = 'sent', attempts = ?, sent_at = ?, last_error = NULL WHERE id = ?",
+                             (attempts + 1, time.time(), email_id))
+        if rows:
+            with conn:
+                conn.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?", (time.time() - self.KEEP_SENT_DAYS * 86400,))
+        return len(rows)
+    
+    def _send(self, to_email, message):
+        if self._server is None:
+            self._server = smtp_connect()
+        try:
+            self._server.sendmail(SMTP_FROM, to_email, message)
+        except smtplib.SMTPServerDisconnected:
+            # The pooled connection went stale: reconnect once
+            self._server = smtp_connect()
+            self._server.sendmail(SMTP_FROM, to_email, message)
+        self._server_used_at = time.monotonic()
+    
+    def _close_idle_connection(self):
+        if self._server is not None and time.monotonic() - self._server_used_at > SMTP_IDLE_TIMEOUT:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+    
+    def _drop_connection(self):
+        if self._server is not None:
+            try:
+                self._server.close()
+            except Exception:
+                pass
+            self._server = None
+    
+    def stats(self):
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return dict({'pending': 0, 'sent': 0, 'failed': 0}, **dict(rows), sender=self.is_sender)
+
+class MemoryEmailQueue:
+    """Fallback when the outbox database can't be created: emails wait in memory (lost on restart)
+    and a background thread sends them one by one with send_email()."""
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.sent = 0
+        self.failed = 0
+        self._started = False
+    
+    def enqueue(self, to_email, subject, body_html):
+        self.queue.put((to_email, subject, body_html))
+        print(f"DEBUG EMAIL: Queued '{subject}' for {to_email} (in memory)")
+    
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._send_loop, name='email-queue', daemon=True).start()
+    
+    def _send_loop(self):
+        while True:
+            to_email, subject, body_html = self.queue.get()
+            if send_email(to_email, subject, body_html):
+                self.sent += 1
+            else:
+                self.failed += 1
+    
+    def stats(self):
+        return {'pending': self.queue.qsize(), 'sent': self.sent, 'failed': self.failed, 'sender': self._started, 'durable': False}
+
+def create_email_outbox():
+    try:
+        return EmailOutbox()
+    except (OSError, sqlite3.Error) as e:
+        print(f"DEBUG EMAIL: Outbox unavailable ({e}), queueing emails in memory")
+        return MemoryEmailQueue()
+
+email_outbox = create_email_outbox()
+
 def format_conversation_html(session_data):
     """Format conversation as HTML for email"""
     messages_html = ""
@@ -945,14 +3090,14 @@ def format_conversation_html(session_data):
     """
 
 def send_conversation_copy(session_id):
-    """Send conversation copy to info@marakame.ch and visitor"""
+    """Queue a conversation copy for info@marakame.ch and the visitor"""
     print(f"DEBUG: send_conversation_copy called for session {session_id}")
     
-    if session_id not in sessions:
+    session_data = find_session(session_id)
+    if session_data is None:
         print(f"DEBUG: Session {session_id} not found")
         return
     
-    session_data = sessions[session_id]
     if not session_data['messages']:
         print("DEBUG: No messages in session")
         return
@@ -961,114 +3106,110 @@ def send_conversation_copy(session_id):
     subject = f"Conversation Taiyari - {session_data['started_at'][:10]}"
     
     # Send to info@marakame.ch
-    print("DEBUG: Sending to info@marakame.ch...")
-    send_email('info@marakame.ch', subject, html_content)
+    print("DEBUG: Queuing copy for info@marakame.ch...")
+    email_outbox.enqueue('info@marakame.ch', subject, html_content)
     
     # Send to visitor if email provided
     if session_data.get('visitor_email'):
-        print(f"DEBUG: Sending to visitor {session_data['visitor_email']}...")
-        send_email(session_data['visitor_email'], "Copie de votre conversation avec Marakame", html_content)
+        print(f"DEBUG: Queuing copy for visitor {session_data['visitor_email']}...")
+        email_outbox.enqueue(session_data['visitor_email'], "Copie de votre conversation avec Marakame", html_content)
 
 # ==================== HUBSPOT FUNCTIONS ====================
-def search_hubspot_contact(email):
-    if not HUBSPOT_API_KEY:
-        return None
+HUBSPOT_EMAIL_PROPERTIES = ['hs_email_subject', 'hs_email_text', 'hs_email_html', 'hs_body_preview', 'hs_timestamp', 'hs_email_direction']
+
+# Contact email address -> list of parsed emails; follow-up messages in a session are served from here
+hubspot_email_cache = LRUCache(HUBSPOT_CACHE_SIZE, ttl=HUBSPOT_CACHE_TTL)
+
+def hubspot_headers():
+    return {
+        'Authorization': f'Bearer {HUBSPOT_API_KEY}',
+        'Content-Type': 'application/json'
+    }
+
+def get_hubspot_contact(email):
+    """Read a contact by email address, together with the ids of its associated emails.
     
-    try:
-        url = "https://api.hubapi.com/crm/v3/objects/contacts/search"
-        headers = {
-            'Authorization': f'Bearer {HUBSPOT_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            "filterGroups": [{
-                "filters": [{
-                    "propertyName": "email",
-                    "operator": "EQ",
-                    "value": email
-                }]
-            }],
-            "properties": ["email", "firstname", "lastname"]
-        }
-        
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('results'):
-                return data['results'][0]
-        return None
-    except Exception as e:
-        print(f"DEBUG: HubSpot contact error: {e}")
+    Returns the contact, None if HubSpot doesn't know the address; raises on API errors so the
+    caller doesn't cache a transient failure.
+    """
+    url = f"https://api.hubapi.com/crm/v3/objects/contacts/{quote(email)}"
+    params = {'idProperty': 'email', 'properties': 'email,firstname,lastname', 'associations': 'emails'}
+    response = requests.get(url, headers=hubspot_headers(), params=params, timeout=10)
+    if response.status_code == 404:
         return None
+    response.raise_for_status()
+    return response.json()
+
+def _parse_hubspot_email(props, firstname):
+    body = props.get('hs_email_text') or props.get('hs_body_preview') or props.get('hs_email_html') or ''
+    
+    if '<' in body and '>' in body:
+        body = re.sub(r'<[^>]+>', ' ', body)
+        body = re.sub(r'\s+', ' ', body).strip()
+    
+    return {
+        'subject': props.get('hs_email_subject', 'Sans sujet'),
+        'body': body[:500] if body else '',
+        'date': props.get('hs_timestamp', ''),
+        'direction': props.get('hs_email_direction', ''),
+        'firstname': firstname
+    }
 
 def get_hubspot_emails(email):
-    """Get emails from HubSpot for a contact"""
+    """Get emails from HubSpot for a contact (two API calls on a cache miss, none on a hit)"""
     if not HUBSPOT_API_KEY:
         return []
     
+    cache_key = email.strip().lower()
+    cached = hubspot_email_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
     try:
-        contact = search_hubspot_contact(email)
+        contact = get_hubspot_contact(cache_key)
         if not contact:
             print(f"DEBUG: No HubSpot contact found for {email}")
+            hubspot_email_cache.set(cache_key, [])
             return []
         
-        contact_id = contact['id']
         firstname = contact.get('properties', {}).get('firstname', '')
-        
-        url = f"https://api.hubapi.com/crm/v3/objects/contacts/{contact_id}/associations/emails"
-        headers = {
-            'Authorization': f'Bearer {HUBSPOT_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        response = requests.get(url, headers=headers, timeout=10)
-        
-        if response.status_code != 200:
-            return []
-        
-        associations = response.json().get('results', [])
-        
-        if not associations:
-            return []
+        associations = contact.get('associations', {}).get('emails', {}).get('results', [])
+        email_ids = []
+        for assoc in associations:
+            email_id = assoc.get('id') or assoc.get('toObjectId')
+            if email_id and str(email_id) not in email_ids:
+                email_ids.append(str(email_id))
+        email_ids = email_ids[:HUBSPOT_MAX_EMAILS]
         
         emails = []
-        for assoc in associations[:5]:
-            email_id = assoc.get('id') or assoc.get('toObjectId')
-            if not email_id:
-                continue
-            
-            email_url = f"https://api.hubapi.com/crm/v3/objects/emails/{email_id}?properties=hs_email_subject,hs_email_text,hs_email_html,hs_body_preview,hs_timestamp,hs_email_direction"
-            email_response = requests.get(email_url, headers=headers, timeout=10)
-            
-            if email_response.status_code == 200:
-                email_data = email_response.json()
-                props = email_data.get('properties', {})
-                
-                body = props.get('hs_email_text') or props.get('hs_body_preview') or props.get('hs_email_html') or ''
-                
-                if '<' in body and '>' in body:
-                    body = re.sub(r'<[^>]+>', ' ', body)
-                    body = re.sub(r'\s+', ' ', body).strip()
-                
-                emails.append({
-                    'subject': props.get('hs_email_subject', 'Sans sujet'),
-                    'body': body[:500] if body else '',
-                    'date': props.get('hs_timestamp', ''),
-                    'direction': props.get('hs_email_direction', ''),
-                    'firstname': firstname
-                })
+        if email_ids:
+            # One batch read for all the email bodies
+            response = requests.post(
+                "https://api.hubapi.com/crm/v3/objects/emails/batch/read",
+                headers=hubspot_headers(),
+                json={'properties': HUBSPOT_EMAIL_PROPERTIES, 'inputs': [{'id': email_id} for email_id in email_ids]},
+                timeout=10
+            )
+            response.raise_for_status()
+            # Results come back in no particular order: keep the association order
+            by_id = {str(result.get('id')): result for result in response.json().get('results', [])}
+            for email_id in email_ids:
+                if email_id in by_id:
+                    emails.append(_parse_hubspot_email(by_id[email_id].get('properties', {}), firstname))
         
+        hubspot_email_cache.set(cache_key, emails)
         return emails
     except Exception as e:
         print(f"DEBUG: HubSpot emails error: {e}")
         return []
 
 # ==================== SHOPIFY TOKEN ====================
-shopify_token_cache = {'access_token': None, 'expires_at': 0}
+shopify_token_cache = LRUCache(maxsize=1)
 
 def get_shopify_token():
-    if shopify_token_cache['access_token'] and time.time() < shopify_token_cache['expires_at'] - 300:
-        return shopify_token_cache['access_token']
+    token = shopify_token_cache.get('access_token')
+    if token:
+        return token
     
     if not SHOPIFY_CLIENT_ID or not SHOPIFY_CLIENT_SECRET:
         return None
@@ -1087,14 +3228,37 @@ def get_shopify_token():
         
         if response.status_code == 200:
             data = response.json()
-            shopify_token_cache['access_token'] = data['access_token']
-            shopify_token_cache['expires_at'] = time.time() + data.get('expires_in', 86399)
+            # Renew 5 minutes before Shopify expires it
+            shopify_token_cache.set('access_token', data['access_token'], ttl=max(data.get('expires_in', 86399) - 300, 0))
             return data['access_token']
     except Exception as e:
         print(f"DEBUG: Shopify token error: {e}")
     return None
 
+# Order name / email -> order, or None for a confirmed miss (kept for SHOPIFY_ORDER_NEGATIVE_TTL)
+shopify_order_cache = LRUCache(SHOPIFY_ORDER_CACHE_SIZE, ttl=SHOPIFY_ORDER_CACHE_TTL)
+shopify_order_flight = SingleFlight()
+_NOT_CACHED = object()
+
+def _shopify_order_key(order_id_or_email):
+    if '@' in order_id_or_email:
+        return 'email:' + order_id_or_email.strip().lower()
+    return 'name:' + order_id_or_email.replace('#', '').replace('MK', '').strip()
+
 def get_shopify_order(order_id_or_email):
+    key = _shopify_order_key(order_id_or_email)
+    order = shopify_order_cache.get(key, _NOT_CACHED)
+    if order is not _NOT_CACHED:
+        return order
+    # Parallel requests for the same order share one Shopify call
+    return shopify_order_flight.do(key, _fetch_shopify_order, order_id_or_email, key)
+
+def _fetch_shopify_order(order_id_or_email, key):
+    # Another request may have filled the cache between our miss and taking the lead
+    order = shopify_order_cache.get(key, _NOT_CACHED)
+    if order is not _NOT_CACHED:
+        return order
+    
     token = get_shopify_token()
     if not token:
         return None
@@ -1112,7 +3276,11 @@ def get_shopify_order(order_id_or_email):
         if response.status_code == 200:
             data = response.json()
             if data.get('orders'):
-                return data['orders'][0]
+                order = data['orders'][0]
+                shopify_order_cache.set(key, order)
+                return order
+            # A definite "no such order" (years, prices, phone numbers...): remember it longer
+            shopify_order_cache.set(key, None, ttl=SHOPIFY_ORDER_NEGATIVE_TTL)
     except Exception as e:
         print(f"DEBUG: Shopify error: {e}")
     return None
@@ -1129,19 +3297,90 @@ def format_order_info(order):
         'created_at': order.get('created_at', '')[:10]
     }
 
-# ==================== TAIYARI PROMPT ====================
-def get_taiyari_prompt(language, context, is_continuing=False, hubspot_email_content=None):
-    continuation_rule = "NE PAS saluer à nouveau - la conversation est déjà en cours." if is_continuing else ""
+# ==================== CHAT LOOKUPS ====================
+lookup_executor = ThreadPoolExecutor(max_workers=CHAT_LOOKUP_WORKERS, thread_name_prefix='chat-lookup')
+lookup_latency = defaultdict(lambda: {'calls': 0, 'dropped': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+lookup_latency_lock = threading.Lock()
+
+def _timed_lookup(name, function, args):
+    started = time.monotonic()
+    try:
+        result = function(*args)
+    finally:
+        # Recorded even for lookups that missed the deadline, so slow backends show up in the stats
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with lookup_latency_lock:
+            stats = lookup_latency[name]
+            stats['calls'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+    return result, elapsed_ms
+
+def run_lookups(lookups, timeout=None):
+    """Run independent lookups concurrently under one shared deadline.
     
-    hubspot_instruction = ""
-    if hubspot_email_content:
-        hubspot_instruction = f"""
-EMAIL DU CLIENT TROUVÉ DANS HUBSPOT:
-{hubspot_email_content}
+    lookups maps a name to (function, args). Returns (results, timings): lookups that failed or
+    missed the deadline are absent from results, and timings gives each lookup's latency in ms
+    (None when it was dropped).
+    """
+    futures = {
+        lookup_executor.submit(_timed_lookup, name, function, args): name
+        for name, (function, args) in lookups.items()
+    }
+    done, late = wait(futures, timeout=CHAT_LOOKUP_DEADLINE if timeout is None else timeout)
+    
+    results, timings = {}, {}
+    for future in done:
+        name = futures[future]
+        try:
+            results[name], timings[name] = future.result()
+        except Exception as e:
+            print(f"DEBUG: Lookup {name} failed: {e}")
+            timings[name] = None
+    for future in late:
+        # Still running: let it finish in the background, but don't wait for it
+        future.cancel()
+        timings[futures[future]] = None
+        with lookup_latency_lock:
+            lookup_latency[futures[future]]['dropped'] += 1
+    
+    if timings:
+        print("DEBUG: Chat lookups: " + ", ".join(
+            f"{name} {ms:.0f}ms" if ms is not None else f"{name} dropped" for name, ms in timings.items()))
+    return results, timings
+
+def lookup_latency_stats():
+    with lookup_latency_lock:
+        return {
+            name: {
+                'calls': stats['calls'],
+                'dropped': stats['dropped'],
+                'avg_ms': round(stats['total_ms'] / stats['calls'], 1) if stats['calls'] else 0.0,
+                'max_ms': round(stats['max_ms'], 1)
+            }
+            for name, stats in lookup_latency.items()
+        }
+
+# ==================== ANTHROPIC CLIENT ====================
+_anthropic_client = None
+_anthropic_client_lock = threading.Lock()
 
-Tu dois RÉPONDRE à cette question en utilisant les informations du CONTEXTE ci-dessous."""
+def get_anthropic_client():
+    """Process-wide Anthropic client, so its connection pool (and TLS sessions) are reused across requests"""
+    global _anthropic_client
+    if _anthropic_client is None:
+        with _anthropic_client_lock:
+            if _anthropic_client is None:
+                _anthropic_client = anthropic.Anthropic(
+                    api_key=ANTHROPIC_KEY,
+                    base_url=ANTHROPIC_BASE_URL,
+                    timeout=ANTHROPIC_TIMEOUT
+                )
+    return _anthropic_client
 
-    return f"""Tu es Taiyari, l'assistant virtuel de Marakame, une boutique suisse de bijoux et accessoires artisanaux faits main.
+# ==================== TAIYARI PROMPT ====================
+# Static instructions, identical for every request: sent first and marked for prompt caching
+TAIYARI_INSTRUCTIONS = """Tu es Taiyari, l'assistant virtuel de Marakame, une boutique suisse de bijoux et accessoires artisanaux faits main.
 
 RÈGLE ABSOLUE DE LANGUE:
 - Tu dois répondre UNIQUEMENT dans la langue du message du visiteur
@@ -1167,17 +3406,51 @@ PERSONNALITÉ:
 
 RÈGLES STRICTES:
 1. NE JAMAIS utiliser le mot "Huichol"
-2. {continuation_rule}
-3. TOUJOURS chercher la réponse dans le CONTEXTE avant de dire que tu ne sais pas
-4. Si la question est GÉNÉRALE, donne un résumé court (2-3 lignes) + le lien vers la page
-5. Si la question est PRÉCISE, réponds directement avec les détails
-6. Ne rediriger vers info@marakame.ch QUE si la réponse n'est PAS dans le contexte
-7. Pour les commandes, demande le numéro ou l'email si non fourni
-8. Inclure les liens URL des sources quand pertinent
-{hubspot_instruction}
+2. TOUJOURS chercher la réponse dans le CONTEXTE avant de dire que tu ne sais pas
+3. Si la question est GÉNÉRALE, donne un résumé court (2-3 lignes) + le lien vers la page
+4. Si la question est PRÉCISE, réponds directement avec les détails
+5. Ne rediriger vers info@marakame.ch QUE si la réponse n'est PAS dans le contexte
+6. Pour les commandes, demande le numéro ou l'email si non fourni
+7. Inclure les liens URL des sources quand pertinent"""
+
+# Everything constant goes in the cached prefix: the provider only caches prefixes of at least 1024
+# tokens (Sonnet), and the instructions alone are about half that
+TAIYARI_CACHED_PROMPT = TAIYARI_INSTRUCTIONS + """
+
+INFORMATIONS ESSENTIELLES (FAQ Marakame, toujours valables):
+
+""" + "\n\n".join(doc['content'] for doc in STATIC_FAQ)
+
+prompt_cache_usage = {'calls': 0, 'cache_read_tokens': 0, 'cache_write_tokens': 0, 'input_tokens': 0}
+prompt_cache_lock = threading.Lock()
+
+def record_prompt_cache_usage(usage):
+    """Count what the API reports for the cached prefix, so /health shows whether caching takes effect"""
+    with prompt_cache_lock:
+        prompt_cache_usage['calls'] += 1
+        prompt_cache_usage['cache_read_tokens'] += getattr(usage, 'cache_read_input_tokens', None) or 0
+        prompt_cache_usage['cache_write_tokens'] += getattr(usage, 'cache_creation_input_tokens', None) or 0
+        prompt_cache_usage['input_tokens'] += getattr(usage, 'input_tokens', None) or 0
+
+def get_taiyari_prompt(language, context, is_continuing=False, hubspot_email_content=None):
+    """System prompt as content blocks: the cached static instructions, then the per-request part"""
+    continuation_rule = "NE PAS saluer à nouveau - la conversation est déjà en cours.\n" if is_continuing else ""
+    
+    hubspot_instruction = ""
+    if hubspot_email_content:
+        hubspot_instruction = f"""
+EMAIL DU CLIENT TROUVÉ DANS HUBSPOT:
+{hubspot_email_content}
 
+Tu dois RÉPONDRE à cette question en utilisant les informations du CONTEXTE ci-dessous.
+"""
+
+    return [
+        {"type": "text", "text": TAIYARI_CACHED_PROMPT, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": f"""{continuation_rule}{hubspot_instruction}
 CONTEXTE (données du site, produits Shopify, FAQ):
-{context}"""
+{context}"""}
+    ]
 
 # ==================== LOGO ====================
 LOGO_BASE64 = "iVBORw0KGgoAAAANSUhEUgAAAFAAAABQCAYAAACOEfKtAAABAGlDQ1BpY2MAABiVY2BgPMEABCwGDAy5eSVFQe5OChGRUQrsDxgYgRAMEpOLCxhwA6Cqb9cgai/r4lGHC3CmpBYnA+kPQKxSBLQcaKQIkC2SDmFrgNhJELYNiF1eUlACZAeA2EUhQc5AdgqQrZGOxE5CYicXFIHU9wDZNrk5pckIdzPwpOaFBgNpDiCWYShmCGJwZ3AC+R+iJH8RA4PFVwYG5gkIsaSZDAzbWxkYJG4hxFQWMDDwtzAwbDuPEEOESUFiUSJYiAWImdLSGBg+LWdg4I1kYBC+wMDAFQ0LCBxuUwC7zZ0hHwjTGXIYUoEingx5DMkMekCWEYMBgyGDGQCm1j8/yRb+6wAAACBjSFJNAAB6JgAAgIQAAPoAAACA6AAAdTAAAOpgAAA6mAAAF3CculE8AAAABmJLR0QA/wD/AP+gvaeTAAAAB3RJTUUH6gEXCg4G8dLZvwAAC81JREFUeNrtnHuUnVV5xn/PPmcuJJMwMxmBBJKYC2hA07RqQwyGUEgXiKBguaWQhECFhVoRorbgrRWhC8RSKqiI4bYUEEO4lJqlJgRzGRIBWRIuSmJCoIyQZC65ze2c7+kfe08ysbSFmDkTh/PMmnXO2WfO2ft7vud9997vu9+BMsooo4wyyiijjDLKKKOMMsooo4y3gNx+Nh4Bo9NjR2qrBUYCrcCBQBHI3u4EChgCjAEKQGdqPwD4PlAHPJ7ajgXOANqBecAqYHt6rzJdQ/HtpvwRwI+AR4DvAvWpfTjwG2BJIhhgFvAgsBA4sdd35IGvApf054WEEvVTAQzr1V87UAV8DehKKgM4FHgeaAHel9oOBj4M/ARY1es7ZwCXAYf0aqvp5QIGFIFHAfcAR6fXLcAaYFoy28rUPho4CGgATk5tDcBqYGwvlzMCmJ3MeWuvfuYCV6cbNqAIbAXGATcCf5HalgMXAhMTSaS/WZ/Me0xS1yDgOuCdvZT698B4YAu7/eFRwOVAc1J1njj5lIzMfYl64IJexFQnBf5bMsWjkr9bCJwEfDuRNQ14VzLBI4HBwITkD6cAxwGHEyeaTwG/BM5NyrwZeBU4Pyl6XvKlh/0pEngw8BRwUyIBosNfksxxQVLH6cnvDX0LSqkiLm0ALgamE2fpu9NNOjORuRP4Crtn/Jr9nbRAXKfl0+urknl9Kb33ceCnyTQ/2EudfwwqE/HnJJ/ZCDwGPAz8LN3IOuJMf8s+6nMP7Mt14NB05ycD64CNyVTr08CXEyeP5em9nfugz55F9RqgDXg38B/AqGTm65LbOAj4r+RvlwPeHwnsSr7ui8mvFZJ5PpgIXEZcHJu+wc7kX7Nkso8AX04K7QS+l/pv29/N+JPASuAG4DngiuSHVMIx5JP/u5fogxuIy6V9jn29lTPwdDKZocA/JjK3lfAmOqkwI04wG4iL80JfdNZXqhgCnAAsZs+F7ptGfeOtCOWxK+jo6ihUBbdNvfitfs0H0jWu7qu7VbItz/+H6p9/DYUqQRXjDuly0/aG4Cz3aezp4MsRv8tlCpmEwqAs62im+dhP9Pu4+53A+lV3gZQjy94P/ggwEnyf0GugB41HANeTcY0C/0Dcxq00uj8QmjrdwbYpF/bb+EO/ktd4G6FzR1CWzRV+SPBFwenBZIa/szwCCcFMAuMNhxhmGv07+N6MwnsqQgUHL5/fb9eQL3WHdavuQCBDdUahU/kDasEnWnF3IbPaok1wChYIHLd9H5ZZiDjLOCc4BDSxrbZuzYHNzYPrG+8oEtxB+yCap585cBUogzLeJ7MwOP99Bz5mfA322TLLDE8YHQEaveszEsBU4Y3A04Iv2JxtvGNoS8s3kRYhfbVo5bPq9oGtQACL4cBxkiptz0JaL3M7cDGmCzHNmMjbLjetjOwlEWZbmiS42WgSUAVC0FqRKbjEXr2kCqxfdishHxB+QfB7R3UFoXHAPwPnP3FL1TpS0MEGG7C3AXdK+U3ASJmbQJOFqpI6AVa1V9HVmVVo+GM/Kp1FlaqjYY/fAVBtNBtnz0i6FHRGzwgMyH4ul3FyITDBcHCA9xqGCZYa7wDWCJ2LuMJRdfGzditwumCsYbWlZ0IxY8sH5wwMBTasuJMsB4bzgBuRTgEeAHcb4ygzLHYUgqaAFgg+mdnXEHJzDAXQvaBvgDqw2LWlNggtwWwD/klws+xDHUqjjZIQmAWjAvWCC4QrBWcBGy0eEEISQp2Y+4SfUQyUPhXEcWTFK8AFUhuwALwaY2Is/9bwrxJ/Y3So4Rjg40jUN/b98qYkk0hy7MOBsYriqTX8NXBZMEuDPaogPYtZYPwOie8YfiV0i+BDoIsMnweGFCmsC86di5iBKQK/kLMKpBMUc8nVhvcXi50hhHw2IAhMxtQFWo69BHgc3Iq1iY7N3y5UDfsMMBfRBPpboznCnzPcBWwEPwu6VvBnOcLZ4ClGfw7MO6Zy1vMrOm8bjcPFiAZilLvFoaLP4mYlJzAzgNYLfwY4WuKzoPHAi8Xq+huAaeDpiAdlngX/2jH1WQdsBx0mtA4Ihm2IExSTU5NWdN11GsqfY9wtWAG+x2hNRTHLuvP5/+1+vpGDNHsRq9wbT1sJHEEMnjp9RwvwuzcawLDG+WBXOORPAi4FpgpVItLkocXgq4F3hswdQAVolQNfBs6JHahF+BLZr2ZiAqgNjAjDLf4FU4lIax5aDfeDv5EP4fmOQsbWPWfjamKeuYEY8grEZNQi9iLktTcKzBE39IMTYSG1rX8jAjMFhKYCdwC1cdmWaJHATAEV7OJDDmEpMBbzOcNUlJbIuC4z05AORJoJvnL70Lqrh7S1/tBE8oRAwlAre65RQ3cxOyuvXWdsetAFPJquvUcAXezl8ZC9IbCdmBx6kxIXiA1p0CcbVWqPCcbbMJ1Gg4ClwHqJp4FNoFG97sh6oFVmtNFva1rb6oC16tlZ72GJrBU8EIrucu5/GFmWLGafoM+XMfnuQYA3GOYAc7GX2t5pg/FOzC3gUyUtIgZgbwCOE9wt+ynZL2N+CGwDVWNfKDgR8TPE0+BHbLptd9l+UebrFifli7rd+ZBtmTLnT3sSef1DZ1DfeBvCNYKcpctADeAxmJdw1ojCdyUmYI8ETQWdaZgnFz8NTEJaJnS38RGCCzI4QngCuN3oPGLS3YINmIPAY6p4dW2nR/T5BFmaYEJ0fMONvql4zGMleElG9xKpoloxHXq/zE8Rm2RTlJ+0whXADOGLZN8e0JGZeAyyXwtNNtpSWXR3d+BZS58AfRZ5CmhBW/Gwn+dC5oFBYJzsW4hLknHgUUaNcuUxEl8CjcS8YNGE+YnhIKx6xAbEWqxOy92271YWNhOYa3Qe8oHdOa00ugo8ETwjucSmfJXtvuevRATakHmjcuER8CXAo0IrLd9pMTHNAeMdZ/b5SNeBXzA+BXSl8BmgGywWg28CLrdcQ5ygTpF5FfgWcCymYFgkm24VBgaBuayCYq5QMFxLPOzzgPDxgom7FhIA1gTkVuT7ZNbJqpUZZemV+BkWW4xG1GjX5wzwUeKuZRHwK7m4AkJJciUlC2cNXfwtKmuG4CyrFWGQxQ9A01PUHgyWnwNmkBW3iNxFiHnAO4BnDF+weDTYpxrdI2l3otwAvlyZfmC5DejYMmV2Sa6rZAHVrcd/is2TZyNCKzHx/h4n23X8acJc19y5rSk4917ElZZGWqq29AHg89g1mf0L4Hrbbe5Zt8sIpuazYnOwS0Ze6Xxgb3cYSRsGqpbZbvxiMr2HZcYOq6iZm4lWxSPBu60bRsscjjRL+H6jRzGnG/+VYIyhtisXqoDuUl5PyQmM/PmXVUVmduXUnMmvWPylrMuQPhLMf2bmegfalA6fJ6WtC6jG8WjvTMFD4PkZuirAu0JGy+uD8zvq2kt7YL9fE+v1j89HUGvl5gOngZC9ETjN4iuYUxX3txn4opBRZ3GtJWS3gc8HLVRmNpcgfN+vPvCN7TlHkdBqcynmRswGYChoEuZWYEfycqttL7c8Hdgk+zHDBbYfNlm/kdfvCuxBXePt2OSDwmFBHmb0SmZvVdD3ZH8UuLCQdf44r8qxkoKhacvk17eOXDacl6ed269j328OF/XGkCfuoqqQYTwSdDhoJdCx5ehZ++NwyyijjDLeDETMR4SBdFGlLHc9ADiemHvoYt/uGMTuYp2uUhJYSjUcSTw7PZndBTJD9oEAKohhsJOIZWAlXVmUUoHF9NtCTBAdQywgXJceYffp+j/M3fZ+XUmMvwwmVjyNBjYnBY4AXiMmvkqCUu6FXyeG8zNiJVEtuyvVj04m/WR6HEfMM28iFhv2EPKbRFpPuWwluxPwTxL3ziUtpCl1yX9PadZ2oCldrIg1docCTxBDXYOSml4mFlaPT2S/lFzBOGBtckHd6fmORGw2kAmkl6l2EGtIisDvgVeI9b8NxMrKDcQCncHp/UIyzywpsZ1Y//Yab8P/mfB/oadUS+l51R+07ZfbzzLKKKOMMsooo4wyyiijjDLKeLvgvwF0O5R7wXjVRgAAAB50RVh0aWNjOmNvcHlyaWdodABHb29nbGUgSW5jLiAyMDE2rAszOAAAABR0RVh0aWNjOmRlc2NyaXB0aW9uAHNSR0K6kHMHAAAAAElFTkSuQmCC"
@@ -1298,27 +3571,78 @@ def home():
             messages.scrollTop = messages.scrollHeight;
             
             try {{
-                const response = await fetch('/chat', {{
+                const response = await fetch('/chat/stream', {{
                     method: 'POST',
                     headers: {{ 'Content-Type': 'application/json' }},
                     body: JSON.stringify({{ message, session_id: sessionId }})
                 }});
-                const data = await response.json();
-                document.getElementById('loading-' + loadingId).remove();
-                
-                if (data.error) {{
+                if (!response.ok) {{
+                    const data = await response.json();
+                    document.getElementById('loading-' + loadingId).remove();
                     messages.innerHTML += '<div class="message error">Erreur: ' + escapeHtml(data.error) + '</div>';
                 }} else {{
-                    messages.innerHTML += '<div class="message bot"><div class="bot-avatar"><img src="' + LOGO + '" alt="T"></div><div class="bot-text">' + formatMessage(data.response) + '</div></div>';
+                    await readStream(response, loadingId);
                 }}
             }} catch (error) {{
-                document.getElementById('loading-' + loadingId).remove();
+                const loading = document.getElementById('loading-' + loadingId);
+                if (loading) loading.remove();
                 messages.innerHTML += '<div class="message error">Erreur de connexion.</div>';
             }}
             messages.scrollTop = messages.scrollHeight;
             startTimeoutChecker();
         }}
         
+        async function readStream(response, loadingId) {{
+            // Server-Sent Events over fetch: tokens are appended to the bubble as they arrive
+            const messages = document.getElementById('messages');
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let text = '';
+            let bubble = null;
+            let failed = false;
+
+            const render = () => {{
+                if (!bubble) {{
+                    document.getElementById('loading-' + loadingId).remove();
+                    messages.innerHTML += '<div class="message bot"><div class="bot-avatar"><img src="' + LOGO + '" alt="T"></div><div class="bot-text" id="stream-' + loadingId + '"></div></div>';
+                    bubble = document.getElementById('stream-' + loadingId);
+                }}
+                bubble.innerHTML = formatMessage(text);
+                messages.scrollTop = messages.scrollHeight;
+            }};
+
+            while (true) {{
+                const {{ done, value }} = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, {{ stream: true }});
+                let boundary;
+                while ((boundary = buffer.indexOf('\\n\\n')) !== -1) {{
+                    const chunk = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    let event = 'message', data = '';
+                    for (const line of chunk.split('\\n')) {{
+                        if (line.startsWith('event: ')) event = line.slice(7);
+                        else if (line.startsWith('data: ')) data += line.slice(6);
+                    }}
+                    if (!data) continue;
+                    const payload = JSON.parse(data);
+                    if (event === 'token') {{
+                        text += payload.text;
+                        render();
+                    }} else if (event === 'warning') {{
+                        text += '\\n\\n' + payload.text;
+                        render();
+                    }} else if (event === 'error') {{
+                        if (!bubble) document.getElementById('loading-' + loadingId).remove();
+                        messages.innerHTML += '<div class="message error">Erreur: ' + escapeHtml(payload.error) + '</div>';
+                        failed = true;
+                    }}
+                }}
+            }}
+            if (!bubble && !failed) render();
+        }}
+
         async function endChat() {{
             if (confirm('Voulez-vous terminer cette conversation ?')) {{
                 try {{
@@ -1352,15 +3676,27 @@ def health():
     return jsonify({
         'status': 'healthy', 
         'service': 'Taiyari',
-        'rag_documents': len(rag.documents),
-        'rag_last_update': rag.last_update.isoformat() if rag.last_update else None
+        'rag_documents': rag.document_count(),
+        'rag_last_update': rag.last_update.isoformat() if rag.last_update else None,
+        'chat_lookups': lookup_latency_stats(),
+        'prompt_cache': dict(prompt_cache_usage),
+        'hubspot_cache': hubspot_email_cache.stats(),
+        'shopify_order_cache': dict(shopify_order_cache.stats(), coalesced=shopify_order_flight.coalesced),
+        'ip_country_cache': ip_country_cache.stats(),
+        'analytics_log': analytics_log.stats(),
+        'dashboard_cache': dashboard_cache.stats(),
+        'sessions': session_store.stats(),
+        'email_outbox': email_outbox.stats()
     })
 
 @app.route('/rag-status')
 def rag_status():
     """Check RAG status and trigger update if needed"""
     return jsonify({
-        'documents': len(rag.documents),
+        'documents': rag.document_count(),
+        'generation': rag.generation,
+        'backend': rag.backend.name,
+        'query_cache': rag.query_cache.stats(),
         'last_update': rag.last_update.isoformat() if rag.last_update else None,
         'is_updating': rag.is_updating,
         'needs_update': rag.needs_update()
@@ -1371,7 +3707,7 @@ def rag_update():
     """Manually trigger RAG update"""
     if rag.is_updating:
         return jsonify({'status': 'already_updating'})
-    threading.Thread(target=rag.update).start()
+    threading.Thread(target=rag.update, kwargs={'force': True}).start()
     return jsonify({'status': 'update_started'})
 
 @app.route('/check-timeout', methods=['POST'])
@@ -1393,16 +3729,18 @@ def end_chat():
     send_copy = data.get('send_copy', False)
     visitor_email = data.get('visitor_email')
     
-    if session_id and session_id in sessions:
-        sessions[session_id]['closed'] = True
+    session_data = find_session(session_id)
+    if session_data is not None:
+        session_data['closed'] = True
         
         # Update visitor email if provided
         if visitor_email:
-            sessions[session_id]['visitor_email'] = visitor_email
+            session_data['visitor_email'] = visitor_email
+        save_session(session_data)
         
         # Send email copy only if requested
-        if send_copy and sessions[session_id].get('visitor_email'):
-            threading.Thread(target=send_conversation_copy, args=(session_id,)).start()
+        if send_copy and session_data.get('visitor_email'):
+            send_conversation_copy(session_id)
         
         return jsonify({
             'success': True, 
@@ -1436,20 +3774,22 @@ def test_email():
     )
     return jsonify({'success': result})
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    # Get client IP and check if blocked
-    client_ip = get_client_ip()
+def prepare_chat(data, client_ip):
+    """Everything /chat does before calling Claude.
+    
+    Returns (early_response, chat_context): early_response is a (payload, status) pair when the
+    request is answered without the LLM (blocked, limited, misconfigured), else chat_context
+    holds what is needed for the completion and for finish_chat().
+    """
     if is_ip_blocked(client_ip):
-        return jsonify({
+        return ({
             'error': 'Service not available in your region',
             'blocked': True
-        }), 403
+        }, 403), None
     
     if not ANTHROPIC_KEY:
-        return jsonify({'error': 'ANTHROPIC_API_KEY not configured'}), 500
+        return ({'error': 'ANTHROPIC_API_KEY not configured'}, 500), None
     
-    data = request.json
     user_message = data.get('message', '')
     session_id = data.get('session_id', str(uuid.uuid4()))
     
@@ -1463,16 +3803,16 @@ def chat():
     track_visitor(client_ip, session_id)
     
     # Check session limits BEFORE processing
-    limit_check = check_session_limits(session_id)
+    limit_check = check_session_limits(session_data)
     if limit_check and limit_check.get('limited'):
-        return jsonify({
+        return ({
             'response': limit_check['message'],
             'limited': True,
             'reason': limit_check['reason'],
             'session_id': session_id
-        })
+        }, 200), None
     
-    update_session_activity(session_id)
+    update_session_activity(session_data)
     
     # Increment message count
     session_data['message_count'] += 1
@@ -1486,7 +3826,8 @@ def chat():
     })
     
     # Detect language more comprehensively
-    language = detect_language(user_message)
+    language = detect_language(user_message, session_data.get('language'))
+    session_data['language'] = language
     
     # Translate query to French for RAG search if not French
     search_query = user_message
@@ -1497,35 +3838,48 @@ def chat():
     email_match = re.search(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', user_message)
     if email_match:
         session_data['visitor_email'] = email_match.group()
+    save_session(session_data)
     
+    # HubSpot, Shopify and RAG lookups are independent: run them side by side
+    lookups = {
+        # RAG search - use translated query for better matching
+        'rag': (rag.search, (search_query, 5))
+    }
     # Check for HubSpot email request
-    hubspot_email_content = None
-    if any(word in user_message.lower() for word in ['email', 'mail', 'envoyé', 'sent', 'message', 'écrit']):
-        if email_match:
-            emails = get_hubspot_emails(email_match.group())
-            if emails:
-                for email in emails:
-                    if email['body']:
-                        hubspot_email_content = f"De: {email_match.group()}\nSujet: {email['subject']}\nContenu: {email['body']}"
-                        break
-    
-    # Check for Shopify order
-    order_info = None
+    if email_match and any(word in user_message.lower() for word in ['email', 'mail', 'envoyé', 'sent', 'message', 'écrit']):
+        lookups['hubspot'] = (get_hubspot_emails, (email_match.group(),))
+    # Check for Shopify order; the email is only looked up when there is no order number to try first
     for pattern in [r'#?\d{4,}', r'MK-?\d+']:
-        match = re.search(pattern, user_message)
-        if match:
-            order_info = get_shopify_order(match.group())
+        order_match = re.search(pattern, user_message)
+        if order_match:
+            break
+    if order_match:
+        lookups['shopify_order'] = (get_shopify_order, (order_match.group(),))
+    elif email_match:
+        lookups['shopify_email'] = (get_shopify_order, (email_match.group(),))
+    
+    started = time.monotonic()
+    results, _ = run_lookups(lookups)
+    if order_match and email_match and not results.get('shopify_order'):
+        # Unknown order number: fall back to the email's latest order within what is left of the deadline
+        remaining = CHAT_LOOKUP_DEADLINE - (time.monotonic() - started)
+        if remaining > 0:
+            results.update(run_lookups({'shopify_email': (get_shopify_order, (email_match.group(),))}, remaining)[0])
+    
+    hubspot_email_content = None
+    for email in results.get('hubspot') or []:
+        if email['body']:
+            hubspot_email_content = f"De: {email_match.group()}\nSujet: {email['subject']}\nContenu: {email['body']}"
             break
-    if email_match and not order_info:
-        order_info = get_shopify_order(email_match.group())
     
-    # RAG search - use translated query for better matching
-    context_docs = rag.search(search_query, top_k=5)
+    order_info = results.get('shopify_order') or results.get('shopify_email')
+    
+    context_docs = results.get('rag') or []
     context_parts = []
     for doc in context_docs:
         source = f"[{doc['source'].upper()}]" if doc.get('source') else ""
         url = doc.get('url', '')
-        context_parts.append(f"{source} {doc['content'][:1000]}\nURL: {url}")
+        context_parts.append(f"{source} {doc['content']}\nURL: {url}")
     context = "\n\n---\n\n".join(context_parts)
     
     if order_info:
@@ -1541,38 +3895,232 @@ def chat():
             "content": msg['content']
         })
     
-    client = anthropic.Anthropic(api_key=ANTHROPIC_KEY)
-    response = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=500,
-        system=get_taiyari_prompt(language, context, is_continuing, hubspot_email_content),
-        messages=claude_messages
-    )
-    
-    bot_response = response.content[0].text
+    return None, {
+        'session_id': session_id,
+        'session_data': session_data,
+        'language': language,
+        'request': {
+            'model': ANTHROPIC_MODEL,
+            'max_tokens': 500,
+            'system': get_taiyari_prompt(language, context, is_continuing, hubspot_email_content),
+            'messages': claude_messages
+        }
+    }
+
+def finish_chat(chat_context, bot_response):
+    """Session bookkeeping once the completion is known. Returns (response text, warning, messages remaining)"""
+    session_data = chat_context['session_data']
     
     session_data['messages'].append({
         'role': 'assistant',
         'content': bot_response,
         'timestamp': datetime.now().strftime('%H:%M')
     })
+    save_session(session_data)
     
     # Check for warnings after response
-    limit_check = check_session_limits(session_id)
+    limit_check = check_session_limits(session_data)
     warning = limit_check.get('warning') if limit_check else None
     
     # Add warning to response if needed
     if warning:
         bot_response = bot_response + "\n\n" + warning
     
+    return bot_response, warning, MAX_MESSAGES_PER_SESSION - session_data['message_count']
+
+def sse_event(event, data):
+    """Format one Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    early_response, chat_context = prepare_chat(request.json, get_client_ip())
+    if early_response:
+        payload, status = early_response
+        return jsonify(payload), status
+    
+    response = get_anthropic_client().messages.create(**chat_context['request'])
+    record_prompt_cache_usage(response.usage)
+    
+    bot_response, _, messages_remaining = finish_chat(chat_context, response.content[0].text)
+    
     return jsonify({
         'response': bot_response, 
-        'language': language, 
-        'session_id': session_id,
-        'messages_remaining': MAX_MESSAGES_PER_SESSION - session_data['message_count']
+        'language': chat_context['language'], 
+        'session_id': chat_context['session_id'],
+        'messages_remaining': messages_remaining
     })
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Same as /chat, but relays Claude's tokens as Server-Sent Events.
+    
+    Events: 'token' {text} for each streamed chunk, then 'warning' {text} if the session is
+    close to its limits, then 'done' {session_id, language, messages_remaining, response}.
+    Limited sessions get their message as a single token followed by 'done' with limited=true;
+    failures mid-stream are reported as 'error'.
+    """
+    early_response, chat_context = prepare_chat(request.json, get_client_ip())
+    if early_response:
+        payload, status = early_response
+        if status != 200:
+            return jsonify(payload), status
+        
+        def limited_events():
+            yield sse_event('token', {'text': payload['response']})
+            yield sse_event('done', payload)
+        return Response(limited_events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    
+    def generate():
+        chunks = []
+        try:
+            with get_anthropic_client().messages.stream(**chat_context['request']) as stream:
+                for text in stream.text_stream:
+                    chunks.append(text)
+                    yield sse_event('token', {'text': text})
+                record_prompt_cache_usage(stream.get_final_message().usage)
+        except Exception as e:
+            print(f"DEBUG: Streaming error: {e}")
+            yield sse_event('error', {'error': 'Erreur lors de la génération de la réponse'})
+            if not chunks:
+                return
+        
+        bot_response, warning, messages_remaining = finish_chat(chat_context, ''.join(chunks))
+        if warning:
+            yield sse_event('warning', {'text': warning})
+        yield sse_event('done', {
+            'response': bot_response,
+            'language': chat_context['language'],
+            'session_id': chat_context['session_id'],
+            'messages_remaining': messages_remaining
+        })
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # ==================== ANALYTICS DASHBOARD ====================
+def analytics_summary(analytics, now):
+    """Every number the dashboard and /api/analytics show, computed in one pass over the analytics state"""
+    empty = {'visitors': set(), 'messages': 0, 'sessions': 0}
+    today = now.strftime('%Y-%m-%d')
+    current_month = now.strftime('%Y-%m')
+    
+    def totals(data):
+        return {'visitors': visitor_count(data['visitors']), 'messages': data['messages'], 'sessions': data['sessions']}
+    
+    # Last 7 days, oldest first
+    week_days = []
+    last_7_days = []
+    for i in range(6, -1, -1):
+        day = (now - timedelta(days=i)).strftime('%Y-%m-%d')
+        day_data = analytics['daily'].get(day, empty)
+        if day in analytics['daily']:
+            week_days.append(day_data)
+        last_7_days.append(dict(totals(day_data), date=day))
+    
+    # Last 6 months
+    last_6_months = []
+    for i in range(5, -1, -1):
+        month = (now - timedelta(days=i*30)).strftime('%Y-%m')
+        last_6_months.append(dict(totals(analytics['monthly'].get(month, empty)), month=month))
+    
+    # Country stats (top 10)
+    top_countries = heapq.nlargest(10, (
+        {'country': country, 'visitors': visitor_count(data['visitors']), 'messages': data['messages']}
+        for country, data in analytics['countries'].items()
+    ), key=lambda x: x['visitors'])
+    
+    # CSAT (copied: the analytics state keeps changing after this returns)
+    csat_total = dict(analytics['csat']['total'])
+    csat_today = dict(analytics['csat']['daily'].get(today, {'1': 0, '2': 0, '3': 0}))
+    
+    def csat_average(counts):
+        count = counts['1'] + counts['2'] + counts['3']
+        return round((counts['1'] * 1 + counts['2'] * 2 + counts['3'] * 3) / count, 2) if count else 0
+    
+    return {
+        'updated': now.strftime('%d/%m/%Y %H:%M'),
+        'today': totals(analytics['daily'].get(today, empty)),
+        'month': totals(analytics['monthly'].get(current_month, empty)),
+        # Unique visitors over the week: merge the daily sets/sketches rather than adding up their counts
+        'last_7_days': {
+            'visitors': visitor_count(merge_visitors(day['visitors'] for day in week_days)),
+            'messages': sum(day['messages'] for day in week_days),
+            'sessions': sum(day['sessions'] for day in week_days)
+        },
+        'total': {
+            'visitors': visitor_count(analytics['total_visitors']),
+            'messages': analytics['total_messages'],
+            'sessions': analytics['total_sessions']
+        },
+        'days': last_7_days,
+        'months': last_6_months,
+        'blocked_today': sum(v for k, v in analytics['blocked_ips'].items() if k.startswith(today)),
+        'top_countries': top_countries,
+        'csat_total': csat_total,
+        'csat_count': csat_total['1'] + csat_total['2'] + csat_total['3'],
+        'csat_avg': csat_average(csat_total),
+        'csat_today': csat_today,
+        'csat_today_count': csat_today['1'] + csat_today['2'] + csat_today['3'],
+        'csat_today_avg': csat_average(csat_today)
+    }
+
+class DashboardCache:
+    """Dashboard numbers and page for the current DASHBOARD_CACHE_SECONDS window (per worker).
+    
+    The first request of a window refreshes the analytics view and recomputes the summary while
+    the others wait for it; the page is rendered once per window, on the first dashboard request.
+    Every other request costs a lookup (or a 304: the ETag only changes when the page does).
+    """
+    def __init__(self, seconds):
+        self.seconds = max(1, seconds)
+        self._lock = threading.Lock()
+        self._window = None
+        self._summary = None
+        self._page = None  # (html, etag)
+        self.hits = 0
+        self.refreshes = 0
+        self.renders = 0
+        self.last_refresh_seconds = 0.0
+    
+    def _refresh(self):
+        window = int(time.time() // self.seconds)
+        if window == self._window:
+            self.hits += 1
+            return
+        started = time.monotonic()
+        self._summary = analytics_summary(analytics_log.view(), datetime.now())
+        self._page = None
+        self._window = window
+        self.refreshes += 1
+        self.last_refresh_seconds = time.monotonic() - started
+    
+    def summary(self):
+        with self._lock:
+            self._refresh()
+            return self._summary
+    
+    def page(self):
+        with self._lock:
+            self._refresh()
+            if self._page is None:
+                html = render_dashboard(self._summary)
+                self._page = (html, hashlib.sha1(html.encode('utf-8')).hexdigest())
+                self.renders += 1
+            return self._page
+    
+    def stats(self):
+        return {
+            'seconds': self.seconds,
+            'hits': self.hits,
+            'refreshes': self.refreshes,
+            'renders': self.renders,
+            'last_refresh_ms': round(self.last_refresh_seconds * 1000, 1)
+        }
+
+dashboard_cache = DashboardCache(DASHBOARD_CACHE_SECONDS)
+
 @app.route('/dashboard')
 def dashboard():
     """Analytics dashboard - password protected"""
@@ -1601,75 +4149,30 @@ def dashboard():
         </html>
         ''', 401
     
-    # Get current date info
-    today = datetime.now().strftime('%Y-%m-%d')
-    current_month = datetime.now().strftime('%Y-%m')
-    
-    # Get last 7 days data
-    last_7_days = []
-    for i in range(6, -1, -1):
-        day = (datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d')
-        day_data = analytics['daily'].get(day, {'visitors': set(), 'messages': 0, 'sessions': 0})
-        last_7_days.append({
-            'date': day,
-            'visitors': len(day_data['visitors']) if isinstance(day_data['visitors'], set) else day_data['visitors'],
-            'messages': day_data['messages'],
-            'sessions': day_data['sessions']
-        })
-    
-    # Get last 6 months data
-    last_6_months = []
-    for i in range(5, -1, -1):
-        month_date = datetime.now() - timedelta(days=i*30)
-        month = month_date.strftime('%Y-%m')
-        month_data = analytics['monthly'].get(month, {'visitors': set(), 'messages': 0, 'sessions': 0})
-        last_6_months.append({
-            'month': month,
-            'visitors': len(month_data['visitors']) if isinstance(month_data['visitors'], set) else month_data['visitors'],
-            'messages': month_data['messages'],
-            'sessions': month_data['sessions']
-        })
-    
-    # Today's stats
-    today_data = analytics['daily'].get(today, {'visitors': set(), 'messages': 0, 'sessions': 0})
-    today_visitors = len(today_data['visitors']) if isinstance(today_data['visitors'], set) else today_data['visitors']
-    today_messages = today_data['messages']
-    today_sessions = today_data['sessions']
-    
-    # This month's stats
-    month_data = analytics['monthly'].get(current_month, {'visitors': set(), 'messages': 0, 'sessions': 0})
-    month_visitors = len(month_data['visitors']) if isinstance(month_data['visitors'], set) else month_data['visitors']
-    month_messages = month_data['messages']
-    month_sessions = month_data['sessions']
-    
-    # Blocked IPs stats
-    blocked_today = sum(v for k, v in analytics['blocked_ips'].items() if k.startswith(today))
-    
-    # Country stats (top 10)
-    country_stats = []
-    for country, data in analytics['countries'].items():
-        visitor_count = len(data['visitors']) if isinstance(data['visitors'], set) else data['visitors']
-        country_stats.append({
-            'country': country,
-            'visitors': visitor_count,
-            'messages': data['messages']
-        })
-    country_stats.sort(key=lambda x: x['visitors'], reverse=True)
-    top_countries = country_stats[:10]
-    
-    # CSAT stats
-    csat_total = analytics['csat']['total']
-    csat_count = csat_total['1'] + csat_total['2'] + csat_total['3']
-    csat_avg = 0
-    if csat_count > 0:
-        csat_avg = round((csat_total['1'] * 1 + csat_total['2'] * 2 + csat_total['3'] * 3) / csat_count, 2)
-    
-    # CSAT today
-    csat_today = analytics['csat']['daily'].get(today, {'1': 0, '2': 0, '3': 0})
-    csat_today_count = csat_today['1'] + csat_today['2'] + csat_today['3']
-    csat_today_avg = 0
-    if csat_today_count > 0:
-        csat_today_avg = round((csat_today['1'] * 1 + csat_today['2'] * 2 + csat_today['3'] * 3) / csat_today_count, 2)
+    html, etag = dashboard_cache.page()
+    response = Response(html, mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'  # Browsers revalidate and get a 304 until the next refresh
+    return response.make_conditional(request)
+
+def render_dashboard(summary):
+    """The dashboard page for an analytics_summary()"""
+    last_7_days = summary['days']
+    last_6_months = summary['months']
+    today_visitors = summary['today']['visitors']
+    today_messages = summary['today']['messages']
+    today_sessions = summary['today']['sessions']
+    month_visitors = summary['month']['visitors']
+    month_messages = summary['month']['messages']
+    month_sessions = summary['month']['sessions']
+    blocked_today = summary['blocked_today']
+    top_countries = summary['top_countries']
+    csat_total = summary['csat_total']
+    csat_count = summary['csat_count']
+    csat_avg = summary['csat_avg']
+    csat_today = summary['csat_today']
+    csat_today_count = summary['csat_today_count']
+    csat_today_avg = summary['csat_today_avg']
     
     # Generate chart data
     chart_labels = json.dumps([d['date'][-5:] for d in last_7_days])
@@ -1729,7 +4232,7 @@ def dashboard():
         <div class="header">
             <button class="refresh-btn" onclick="location.reload()">🔄 Actualiser</button>
             <h1>📊 Dashboard Taiyari</h1>
-            <p>Analytics du chatbot - Mis à jour: {datetime.now().strftime('%d/%m/%Y %H:%M')}</p>
+            <p>Analytics du chatbot - Mis à jour: {summary['updated']}</p>
         </div>
         
         <div class="stats-grid">
@@ -1946,37 +4449,23 @@ def api_analytics():
     if password != DASHBOARD_PASSWORD:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    today = datetime.now().strftime('%Y-%m-%d')
-    current_month = datetime.now().strftime('%Y-%m')
-    
-    today_data = analytics['daily'].get(today, {'visitors': set(), 'messages': 0, 'sessions': 0})
-    month_data = analytics['monthly'].get(current_month, {'visitors': set(), 'messages': 0, 'sessions': 0})
-    
-    return jsonify({
-        'today': {
-            'visitors': len(today_data['visitors']) if isinstance(today_data['visitors'], set) else today_data['visitors'],
-            'messages': today_data['messages'],
-            'sessions': today_data['sessions']
-        },
-        'month': {
-            'visitors': len(month_data['visitors']) if isinstance(month_data['visitors'], set) else month_data['visitors'],
-            'messages': month_data['messages'],
-            'sessions': month_data['sessions']
-        },
-        'total': {
-            'visitors': len(analytics['total_visitors']),
-            'messages': analytics['total_messages'],
-            'sessions': analytics['total_sessions']
-        }
-    })
+    summary = dashboard_cache.summary()
+    response = jsonify({key: summary[key] for key in ('today', 'last_7_days', 'month', 'total')})
+    response.add_etag()
+    return response.make_conditional(request)
 
 # Initialize RAG on startup
 def init_rag():
     print("DEBUG: Initializing RAG on startup...")
+    # Serve from the last snapshot / shared database right away, then refresh in the background
+    rag.restore()
     threading.Thread(target=rag.update).start()
 
-# Run initialization
-init_rag()
+# Run initialization (offline tools such as bench.py import this module with TAIYARI_OFFLINE=1)
+if os.environ.get('TAIYARI_OFFLINE') != '1':
+    init_rag()
+    analytics_log.start()
+    email_outbox.start()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))